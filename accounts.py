@@ -0,0 +1,297 @@
+# accounts.py
+# In-memory account repository shared by all routes.
+#
+# users.json stays the snapshot on disk. Every change after that is appended
+# to a small journal (one compact JSON record per line) instead of rewriting
+# the whole file, and the journal is folded back into the snapshot once it
+# grows past `compact_every` records. Other worker processes pick up changes
+# by tailing the journal, so a lookup costs a stat() plus a dict access.
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+from fileutil import atomic_write, file_sig, fsync_file, locked
+
+INDEXED_FIELDS = ("email", "phone")
+
+
+class DuplicateAccount(KeyError):
+    def __init__(self, field, value):
+        super().__init__(f"{field} {value} already exists")
+        self.field = field
+        self.value = value
+
+
+class AccountStore:
+    def __init__(self, path, journal_path=None, compact_every=500, indexed_fields=INDEXED_FIELDS,
+                 durable=False):
+        self.path = path
+        self.durable = durable  # fsync every journal append
+        self.indexed_fields = tuple(indexed_fields)
+        base = os.path.splitext(path)[0]
+        self.journal_path = journal_path or base + ".journal"
+        self.lock_path = base + ".lock"
+        self.compact_every = compact_every
+        self._lock = threading.RLock()
+        self._users = {}
+        self._index = {field: {} for field in self.indexed_fields}
+        self._snapshot_sig = None
+        self._journal_offset = 0
+        self._journal_records = 0
+        self._loaded = False
+        self._listeners = []
+
+    # -----------------------------
+    # Loading / refreshing
+    # -----------------------------
+    def _read_snapshot(self):
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, "r") as f:
+            try:
+                return json.load(f)
+            except json.JSONDecodeError:
+                return []
+
+    def _load(self):
+        self._users = {}
+        self._index = {field: {} for field in self.indexed_fields}
+        self._snapshot_sig = file_sig(self.path)
+        for u in self._read_snapshot():
+            self._put(u)
+        self._journal_offset = 0
+        self._journal_records = 0
+        self._replay_journal()
+        self._loaded = True
+
+    def _replay_journal(self):
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, "rb") as f:
+            f.seek(self._journal_offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # partially written record, pick it up next time
+                self._journal_offset += len(line)
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                self._put(record)
+                self._journal_records += 1
+
+    def _refresh(self):
+        if not self._loaded or file_sig(self.path) != self._snapshot_sig:
+            self._load()
+            return
+        try:
+            size = os.path.getsize(self.journal_path)
+        except FileNotFoundError:
+            size = 0
+        if size < self._journal_offset:
+            self._load()  # journal was compacted by another process
+        elif size > self._journal_offset:
+            self._replay_journal()
+
+    def refresh(self):
+        with self._lock:
+            self._refresh()
+
+    # -----------------------------
+    # Index maintenance
+    # -----------------------------
+    def _unindex(self, user):
+        uid = user.get("unique_id")
+        for field in self.indexed_fields:
+            key = str(user.get(field, ""))
+            owners = self._index[field].get(key)
+            if owners:
+                owners.discard(uid)
+                if not owners:
+                    del self._index[field][key]
+
+    def _put(self, user):
+        uid = user.get("unique_id")
+        if uid is None:
+            return
+        old = self._users.get(uid)
+        if old is not None:
+            self._unindex(old)
+        self._users[uid] = user
+        for field in self.indexed_fields:
+            key = str(user.get(field, ""))
+            if key:
+                self._index[field].setdefault(key, set()).add(uid)
+        for fn in self._listeners:
+            fn(user)
+
+    def subscribe(self, fn, replay=True):
+        # fn(record) runs for every record this store (re)loads or writes,
+        # including changes picked up from other processes' journal entries.
+        with self._lock:
+            self._listeners.append(fn)
+            if replay:
+                self._refresh()
+                for u in list(self._users.values()):
+                    fn(u)
+
+    # -----------------------------
+    # Persistence
+    # -----------------------------
+    @contextmanager
+    def _write_lock(self):
+        # Serialises writers across threads and worker processes; the state is
+        # refreshed inside the lock so read-modify-write never loses updates.
+        with self._lock, locked(self.lock_path):
+            self._refresh()
+            yield
+
+    def _append_journal(self, records):
+        if not records:
+            return
+        data = "".join(json.dumps(r, separators=(",", ":")) + "\n" for r in records)
+        with open(self.journal_path, "a") as f:
+            f.write(data)
+            if self.durable:
+                f.flush()
+                os.fsync(f.fileno())
+        self._journal_offset += len(data.encode())
+        self._journal_records += len(records)
+        if self._journal_records >= self.compact_every:
+            self._compact()
+
+    def _compact(self):
+        # One compact record per line: fast to write, still diff-friendly
+        atomic_write(self.path, "[\n" + ",\n".join(
+            json.dumps(u, separators=(",", ":")) for u in self._users.values()) + "\n]\n")
+        open(self.journal_path, "w").close()
+        self._snapshot_sig = file_sig(self.path)
+        self._journal_offset = 0
+        self._journal_records = 0
+
+    def compact(self):
+        with self._write_lock():
+            self._compact()
+
+    def sync(self):
+        # Puts every journal append so far (by any worker) on disk; the
+        # snapshot is always written with atomic_write
+        fsync_file(self.journal_path)
+
+    # -----------------------------
+    # Public API (returns copies; write back with update/add)
+    # -----------------------------
+    def get(self, uid):
+        with self._lock:
+            self._refresh()
+            u = self._users.get(str(uid)) if uid is not None else None
+            return dict(u) if u is not None else None
+
+    def __contains__(self, uid):
+        with self._lock:
+            self._refresh()
+            return str(uid) in self._users
+
+    def __len__(self):
+        with self._lock:
+            self._refresh()
+            return len(self._users)
+
+    def find_by(self, field, value):
+        with self._lock:
+            self._refresh()
+            owners = self._index[field].get(str(value))
+            if not owners:
+                return None
+            return dict(self._users[next(iter(owners))])
+
+    def find_by_email(self, email):
+        return self.find_by("email", email)
+
+    def find_by_phone(self, phone):
+        return self.find_by("phone", phone)
+
+    def all(self):
+        with self._lock:
+            self._refresh()
+            return [dict(u) for u in self._users.values()]
+
+    def iter_all(self):
+        # Copies one record at a time instead of the whole user base
+        with self._lock:
+            self._refresh()
+            users = list(self._users.values())
+        for u in users:
+            yield dict(u)
+
+    def _taken(self, field, value):
+        if field == "unique_id":
+            return value in self._users
+        return bool(self._index[field].get(value))
+
+    def add(self, user, unique=()):
+        return self.add_many([user], unique)[0][0]
+
+    def add_many(self, users, unique=(), skip_duplicates=False):
+        # Inserts new records with one journal write. unique_id and every
+        # field in `unique` (which must be indexed) are checked against the
+        # store and the rest of the batch under the write lock, so two
+        # concurrent signups can't both claim the same email. Returns
+        # (added, skipped); skipped holds (record, DuplicateAccount) pairs and
+        # is only non-empty with skip_duplicates, otherwise the first conflict
+        # raises and nothing is written.
+        added, skipped = [], []
+        with self._write_lock():
+            claimed = {field: set() for field in ("unique_id",) + tuple(unique)}
+            for user in users:
+                record = dict(user)
+                try:
+                    for field, seen in claimed.items():
+                        value = str(record.get(field, ""))
+                        if value and (value in seen or self._taken(field, value)):
+                            raise DuplicateAccount(field, value)
+                except DuplicateAccount as e:
+                    if not skip_duplicates:
+                        raise
+                    skipped.append((record, e))
+                    continue
+                for field, seen in claimed.items():
+                    seen.add(str(record.get(field, "")))
+                added.append(record)
+            for record in added:
+                self._put(record)
+            self._append_journal(added)
+        return [dict(r) for r in added], skipped
+
+    def update(self, uid, fields, remove=()):
+        return self.update_many({uid: fields}, remove).get(uid)
+
+    def update_many(self, changes, remove=()):
+        # changes: {unique_id: {field: value}}; one journal write for all of them.
+        # Fields named in `remove` are dropped from every changed record.
+        updated = {}
+        with self._write_lock():
+            for uid, fields in changes.items():
+                current = self._users.get(uid)
+                if current is None:
+                    continue
+                record = dict(current)
+                record.update(fields)
+                for field in remove:
+                    record.pop(field, None)
+                self._put(record)
+                updated[uid] = record
+            self._append_journal(list(updated.values()))
+        return {uid: dict(u) for uid, u in updated.items()}
+
+    def replace_all(self, users):
+        # Bulk replace: only records that differ are written.
+        with self._write_lock():
+            changed = []
+            for u in users:
+                if self._users.get(u.get("unique_id")) != u:
+                    record = dict(u)
+                    self._put(record)
+                    changed.append(record)
+            self._append_journal(changed)
@@ -1,27 +1,50 @@
 # app.py
 from flask import (
     Flask, render_template, request, redirect, url_for,
-    session, flash, jsonify
+    session, flash, jsonify, g, Response, abort,
+    before_render_template, template_rendered
 )
+from werkzeug.exceptions import RequestEntityTooLarge
+import hmac
+import ipaddress
 import json
+import math
 import os
 import random
-import string
-from datetime import datetime, timedelta
-from collections import defaultdict
-from facenet_pytorch import InceptionResnetV1
+import time
+from datetime import datetime
+import numpy as np
+import face_service
+import metrics
+from accounts import DuplicateAccount
+from assets import AssetManifest
+from credentials import CredentialVerifier, VerifierBusy, make_hash
+from dataio import backfill_defaults
+from face_index import FaceIndex
+from faces import FaceStore, digest_of, migrate_inline_faces
+from feed import FeedFull, FeedHub
+from payments import PaymentEngine, PaymentError
+from ratelimit import RateLimited, RateLimiter, open_limit_store
+from rewards import RewardAggregates
+from onboarding import IdAllocator, new_account
+from rollups import SpendingRollups
+from sessions import ProfileCache, ServerSessionInterface, open_session_store
+from storage import open_storage
 
 app = Flask(__name__)
 app.secret_key = "unipay_secret_123"
 
-model = InceptionResnetV1(pretrained='vggface2').eval()
-
 # -----------------------------
 # Files (absolute path to avoid path issues)
 # -----------------------------
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-USERS_FILE = os.path.join(BASE_DIR, "users.json")
-TRANSACTIONS_FILE = os.path.join(BASE_DIR, "transactions.json")
+DATA_DIR = os.environ.get("UNIPAY_DATA_DIR", BASE_DIR)  # e.g. a scratch dir for benchmarks
+USERS_FILE = os.path.join(DATA_DIR, "users.json")
+TRANSACTIONS_FILE = os.path.join(DATA_DIR, "transactions.json")
+PAYMENTS_WAL = os.path.join(DATA_DIR, "payments.wal")
+MERCHANT_CATEGORIES_FILE = os.path.join(BASE_DIR, "merchant_categories.json")
+LOCKS_DIR = os.path.join(DATA_DIR, "locks")
+FACES_DIR = os.path.join(DATA_DIR, "faces")
 
 # -----------------------------
 # Ensure JSON files exist
@@ -29,60 +52,93 @@ TRANSACTIONS_FILE = os.path.join(BASE_DIR, "transactions.json")
 for path, default in [(USERS_FILE, []), (TRANSACTIONS_FILE, [])]:
     if not os.path.exists(path):
         with open(path, "w") as fh:
-            json.dump(default, fh, indent=4)
+            json.dump(default, fh)
+
+# Storage backend: "json" (flat files, default) or "sqlite" (unipay.db, WAL).
+# Run `python manage.py migrate-sqlite` once before switching to sqlite.
+STORAGE_BACKEND = os.environ.get("UNIPAY_STORAGE", "json")
+# Durability: "group" (default) lets concurrent payments share one fsync of
+# the payment log, account journal and ledger every few ms; "strict" fsyncs
+# each write on its own.
+DURABILITY = os.environ.get("UNIPAY_DURABILITY", "group")
+GROUP_COMMIT_MS = float(os.environ.get("UNIPAY_GROUP_COMMIT_MS", "2"))
+storage = open_storage(STORAGE_BACKEND, DATA_DIR, indexed_fields=("email", "phone", "face_id_ref"),
+                       durability=DURABILITY)
+
+# Accounts indexed by unique_id / email / phone (in memory for json)
+accounts = metrics.instrument(storage.accounts, "accounts", (
+    "get", "find_by", "all", "add", "update_many", "replace_all", "refresh"))
+
+# Append-only ledger; transactions.json is imported once on first start
+ledger = metrics.instrument(storage.ledger, "ledger", (
+    "append_many", "for_user", "page_for_user", "iter_all", "refresh"))
+
+# Balance changes go through the payment engine (per-account locks + WAL)
+payments = PaymentEngine(accounts, ledger, PAYMENTS_WAL, LOCKS_DIR, atomic=storage.atomic,
+                         sync=storage.sync, durability=DURABILITY, group_window=GROUP_COMMIT_MS / 1000.0)
+
+# Per-(payer, merchant) reward totals, updated as payments commit
+reward_aggregates = RewardAggregates(ledger)
+
+# Per-user all-time / monthly / daily spending buckets for /spendingsummary
+spending_rollups = SpendingRollups(ledger, MERCHANT_CATEGORIES_FILE)
+
+# Incoming-payment events for merchants' live feeds (/merchant/feed)
+feed_hub = FeedHub(ledger, max_subscribers=int(os.environ.get("UNIPAY_FEED_MAX", 200)))
+
+# Sessions live server-side: "memory" (one worker) or "sqlite" (shared by
+# every worker, sessions.db). The cookie only carries a random session id.
+SESSION_STORE = os.environ.get("UNIPAY_SESSION_STORE", "memory")
+app.session_interface = ServerSessionInterface(
+    open_session_store(SESSION_STORE, os.path.join(DATA_DIR, "sessions.db")),
+    ttl=int(os.environ.get("UNIPAY_SESSION_TTL", 12 * 3600)))
+
+# Password / PIN hashing: verification runs on a bounded pool (UNIPAY_HASH_WORKERS)
+verifier = CredentialVerifier(workers=int(os.environ.get("UNIPAY_HASH_WORKERS", 0)) or None)
+
+@app.errorhandler(VerifierBusy)
+def verifier_busy(e):
+    if request.is_json:
+        return jsonify({"success": False, "message": str(e)}), 503, {"Retry-After": "2"}
+    return str(e), 503, {"Retry-After": "2"}
+
+# Token-bucket limits on PIN and face endpoints: (capacity, period seconds).
+# Buckets are shared by every worker with UNIPAY_RATELIMIT_STORE=sqlite
+# (ratelimit.db); it defaults to the session store's kind.
+RATE_LIMITS = {
+    "pin": (3, 900),      # wrong PINs per account: 3, then one more try every 5 minutes
+    "pin_ip": (20, 900),  # wrong PINs from one address, across accounts
+    "face": (10, 30),     # face scans per account: bursts of 10, then one every 3 s
+    "face_ip": (30, 30),
+}
+limiter = RateLimiter(open_limit_store(os.environ.get("UNIPAY_RATELIMIT_STORE", SESSION_STORE),
+                                       os.path.join(DATA_DIR, "ratelimit.db")), RATE_LIMITS)
+
+@app.errorhandler(RateLimited)
+def rate_limited(e):
+    headers = {"Retry-After": str(e.retry_after)}
+    if request.endpoint == "check_balance":
+        return render_template("lockout.html", remaining=e.retry_after), 429, headers
+    # The JSON endpoints report failures under either key
+    return jsonify({"success": False, "error": str(e), "message": str(e)}), 429, headers
+
+# unique_id allocation for signups and bulk pre-registration
+id_allocator = IdAllocator(accounts, os.path.join(DATA_DIR, "unique_ids.seq"))
+
+# Logged-in users' records for page rendering, evicted on any account change
+profiles = ProfileCache(ttl=int(os.environ.get("UNIPAY_PROFILE_TTL", 30)))
+accounts.subscribe(profiles.invalidate, replay=False)
+
+# Face payloads live outside users.json; records keep only the digest
+faces = FaceStore(FACES_DIR)
+
+# Normalised enrollment embeddings, kept in sync with the account store
+face_index = FaceIndex()
+FACE_MATCH_THRESHOLD = 0.9  # cosine similarity threshold (you can tweak)
 
 # -----------------------------
 # Helpers
 # -----------------------------
-def load_users():
-    if not os.path.exists(USERS_FILE):
-        return []
-    with open(USERS_FILE, "r") as f:
-        try:
-            return json.load(f)
-        except json.JSONDecodeError:
-            return []
-
-def save_users(users):
-    with open(USERS_FILE, "w") as f:
-        json.dump(users, f, indent=4)
-
-def load_transactions():
-    if not os.path.exists(TRANSACTIONS_FILE):
-        return []
-    with open(TRANSACTIONS_FILE, "r") as f:
-        try:
-            data = json.load(f)
-            return data
-        except json.JSONDecodeError:
-            return []
-def save_transactions(transactions):
-    with open(TRANSACTIONS_FILE, "w") as f:
-        json.dump(transactions, f, indent=4)
-
-def calculate_rewards(transactions, threshold=5, min_amount=50, discount_per_threshold=25):
-    merchant_stats = defaultdict(lambda: {'count':0,'total':0,'points':0,'discount':0})
-    
-    for t in transactions:
-        merchant = t['to_name']  # reward applies per merchant
-        merchant_stats[merchant]['count'] += 1
-        merchant_stats[merchant]['total'] += t['amount']
-
-    for m, stats in merchant_stats.items():
-        stats['points'] = stats['count']
-        qualifying_tx = sum(1 for t in transactions if t['to_name']==m and t['amount']>=min_amount)
-        stats['discount'] = (qualifying_tx // threshold) * discount_per_threshold
-
-    return merchant_stats.items()
-
-def generate_unique_id(length=6):
-    chars = string.ascii_letters + string.digits
-    return ''.join(random.choices(chars, k=length))
-
-def generate_txn_id(length=10):
-    chars = string.ascii_letters + string.digits
-    return ''.join(random.choices(chars, k=length))
-
 def random_starting_balance():
     return round(random.uniform(800.0, 1200.0), 2)
 
@@ -90,9 +146,118 @@ def calculate_discount(transactions, merchant_name, threshold=5, min_amount=50,
     count = sum(1 for t in transactions if t['merchant_name'] == merchant_name and t['amount'] >= min_amount)
     discount = (count // threshold) * discount_per_threshold
     return discount
+def check_secret(user, field, secret):
+    # Hash check runs on the credentials pool; plaintext or outdated hashes
+    # are replaced with a current one on the first successful check
+    ok, new_hash = verifier.verify(user.get(field), secret, kind="pin" if field == "pin" else "password")
+    if ok and new_hash:
+        accounts.update(user["unique_id"], {field: new_hash})
+    return ok
+
+def client_ip():
+    return request.remote_addr or "-"
+
+def throttle(rule, uid):
+    # Spends one request from the account's and the client address's bucket
+    wait = max(limiter.take(rule, uid), limiter.take(rule + "_ip", client_ip()))
+    if wait:
+        raise RateLimited(wait, "Too many requests, please slow down")
+
+def check_pin(user, pin):
+    # check_secret for PINs behind a lockout. Every attempt spends a token
+    # from the client address's and the account's bucket before the PIN is
+    # checked, so concurrent guesses can't all slip in ahead of the count;
+    # a correct PIN gives them back. Once either bucket is empty no PIN is
+    # checked at all until it refills.
+    uid, ip = user["unique_id"], client_ip()
+    wait = limiter.take("pin_ip", ip)
+    if not wait:
+        wait = limiter.take("pin", uid)
+        if wait:
+            limiter.refund("pin_ip", ip)  # turned away, so it cost the address nothing
+    if wait:
+        raise RateLimited(wait, "Too many incorrect PINs. Try again later.")
+    try:
+        ok = check_secret(user, "pin", pin)
+    except VerifierBusy:
+        limiter.refund("pin", uid)  # never checked
+        limiter.refund("pin_ip", ip)
+        raise
+    if ok:
+        limiter.reset("pin", uid)
+        limiter.refund("pin_ip", ip)
+    return ok
+
 def find_user_by_unique(uid):
-    users = load_users()
-    return next((u for u in users if str(u.get("unique_id")) == str(uid)), None)
+    # Cached copy of the record for display; evicted whenever it changes
+    return profiles.get(uid, accounts.get)
+
+# -----------------------------
+# Face embeddings
+# -----------------------------
+# The model is loaded lazily (or lives in the shared face service process)
+# and concurrent requests are batched into one forward pass.
+@app.errorhandler(face_service.FaceUnavailable)
+def face_unavailable(e):
+    return jsonify({"success": False, "error": str(e)}), 503, {"Retry-After": "5"}
+
+def compute_face_embedding(face_data):
+    # face_data is a data URL ("data:image/...;base64,....")
+    with metrics.timed("face.embed"):
+        return face_service.embed_data_url(face_data)
+
+FACE_UPLOAD_MAX = int(os.environ.get("UNIPAY_FACE_UPLOAD_MAX", 2 * 1024 * 1024))
+FACE_UPLOAD_TYPES = ("multipart/form-data", "application/octet-stream", "image/jpeg", "image/png", "image/webp")
+
+def submit_face_upload():
+    # Starts the embedding for the posted face and returns (future, data_url).
+    # Preferred: the image as binary, either as a multipart "face" file or as
+    # the raw body. It is size-limited and decoded straight down to model
+    # resolution. Legacy JSON {"face_image": data URL} still works and also
+    # returns the data URL. (None, None) means no image was sent.
+    if request.mimetype in FACE_UPLOAD_TYPES:
+        request.max_content_length = FACE_UPLOAD_MAX
+        if request.mimetype == "multipart/form-data":
+            upload = request.files.get("face")
+            data = upload.read() if upload else b""
+        else:
+            data = request.get_data(cache=False)
+        if not data:
+            return None, None
+        return face_service.submit_upload(data), None
+    face_data = (request.get_json(silent=True) or {}).get("face_image")
+    if not face_data:
+        return None, None
+    return face_service.submit_data_url(face_data), face_data
+
+def sync_face_index(user):
+    uid = user["unique_id"]
+    ref = user.get("face_vector_ref")
+    if not ref:
+        face_index.remove(uid)
+    elif face_index.ref_of(uid) != ref:
+        data = faces.get(ref)
+        if data:
+            face_index.add(uid, np.frombuffer(data, dtype=np.float32), ref=ref)
+
+_face_vectors_backfilled = False
+
+def backfill_face_vectors():
+    # Users enrolled before embeddings were stored only have the image.
+    # Runs on the first face request so other workers never load the model.
+    global _face_vectors_backfilled
+    if _face_vectors_backfilled:
+        return
+    _face_vectors_backfilled = True
+    changes = {}
+    for u in accounts.all():
+        if u.get("face_embedding_ref") and not u.get("face_vector_ref"):
+            image = faces.get_text(u["face_embedding_ref"])
+            if image:
+                vector = compute_face_embedding(image)
+                changes[u["unique_id"]] = {"face_vector_ref": faces.put(vector.tobytes())}
+    if changes:
+        accounts.update_many(changes)
 from flask import Flask, render_template
 from datetime import datetime
 
@@ -105,26 +270,90 @@ def datetimeformat(value):
     except:
         return value
 
+# Fingerprinted, precompressed static files from `manage.py build-assets`;
+# url_for('static', ...) picks up the hashed names when a build exists
+static_assets = AssetManifest(app.static_folder)
+app.url_defaults(static_assets.url_defaults)
+app.view_functions["static"] = static_assets.serve
+
 # -----------------------------
 # Ensure consistent user fields
 # -----------------------------
-def ensure_user_fields():
-    users = load_users()
-    updated = False
-    for u in users:
-        if "bank_linked" not in u:
-            u["bank_linked"] = False
-            updated = True
-        if "pin" not in u:
-            u["pin"] = ""
-            updated = True
-        if "balance" not in u:
-            u["balance"] = 0.0
-            updated = True
-    if updated:
-        save_users(users)
-
-ensure_user_fields()
+backfill_defaults(accounts)  # bank_linked / pin / balance on old records
+migrate_inline_faces(accounts, faces)
+payments.recover()  # finish any payment interrupted by a crash
+accounts.subscribe(sync_face_index)
+
+# -----------------------------
+# Instrumentation: per-route request and template timings
+# -----------------------------
+@app.before_request
+def start_request_timer():
+    g.metrics_start = time.perf_counter()
+    g.metrics_route = metrics.current_route.set(request.endpoint or "-")
+
+@app.teardown_request
+def stop_request_timer(exc=None):
+    start = g.pop("metrics_start", None)
+    if start is not None:
+        metrics.registry.observe(metrics.REQUEST_METRIC, request.method, time.perf_counter() - start)
+    token = g.pop("metrics_route", None)
+    if token is not None:
+        metrics.current_route.reset(token)
+
+def _template_started(sender, template, context, **extra):
+    g.render_start = time.perf_counter()
+
+def _template_finished(sender, template, context, **extra):
+    start = g.pop("render_start", None)
+    if start is not None:
+        metrics.registry.observe(metrics.OP_METRIC, "render_template", time.perf_counter() - start)
+
+before_render_template.connect(_template_started, app)
+template_rendered.connect(_template_finished, app)
+
+if os.environ.get("UNIPAY_PROFILE") == "1":
+    metrics.profiler.start()
+
+def check_metrics_access():
+    # Ops endpoints are closed by default: with UNIPAY_METRICS_TOKEN set the
+    # token is required, otherwise only loopback clients (a scraper on the
+    # same host) get in
+    token = os.environ.get("UNIPAY_METRICS_TOKEN")
+    if token:
+        given = request.args.get("token", request.headers.get("X-Metrics-Token")) or ""
+        if not hmac.compare_digest(given.encode(), token.encode()):
+            abort(403)
+        return
+    try:
+        if ipaddress.ip_address(request.remote_addr or "").is_loopback:
+            return
+    except ValueError:
+        pass
+    abort(403)
+
+@app.route("/metrics")
+def metrics_endpoint():
+    check_metrics_access()
+    return Response(metrics.registry.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/metrics/profile", methods=["GET", "POST"])
+def metrics_profile():
+    # POST ?action=start|stop|reset toggles the sampler; GET returns collapsed stacks
+    check_metrics_access()
+    if request.method == "POST":
+        action = request.args.get("action", "")
+        if action == "start":
+            metrics.profiler.start()
+        elif action == "stop":
+            metrics.profiler.stop()
+        elif action == "reset":
+            metrics.profiler.reset()
+        else:
+            return jsonify({"success": False, "error": "action must be start, stop or reset"}), 400
+        return jsonify({"success": True, "running": metrics.profiler.running,
+                        "samples": metrics.profiler.samples})
+    return Response(metrics.profiler.collapsed(), mimetype="text/plain")
 
 # -----------------------------
 # Routes
@@ -154,36 +383,16 @@ def signup():
             flash("Passwords do not match!", "error")
             return render_template("signup.html")
 
-        users = load_users()
-        if any(str(u.get("email")) == email for u in users):
-            flash("Email already exists!", "error")
-            return render_template("signup.html")
-        if any(str(u.get("phone")) == phone for u in users):
-            flash("Phone already exists!", "error")
-            return render_template("signup.html")
+        # Merchant ids start with "M", user ids never do; both are collision-free
+        uid = id_allocator.allocate("merchant" if user_type == "merchant" else "user")
 
-        # Generate unique ID based on type
-        if user_type == "merchant":
-            uid = "M" + ''.join(random.choices(string.ascii_letters + string.digits, k=5))
-        else:
-            # Normal user: ensure it never starts with 'M'
-            while True:
-                uid = generate_unique_id()  # your existing function
-                if not uid.startswith("M"):
-                    break
-
-        users.append({
-            "name": name,
-            "email": email,
-            "phone": phone,
-            "password": password,
-            "unique_id": uid,
-            "balance": 0.0,
-            "bank_linked": False,
-            "pin": "",
-            "user_type": user_type  # store type
-        })
-        save_users(users)
+        # Email / phone uniqueness is checked atomically with the insert
+        try:
+            accounts.add(new_account(uid, name, email, phone, password, user_type),
+                         unique=("email", "phone"))
+        except DuplicateAccount as e:
+            flash(f"{e.field.capitalize()} already exists!", "error")
+            return render_template("signup.html")
         flash(f"Account created! Your Unique ID: {uid}", "success")
         return render_template("signup.html", success=True, uid=uid)
 
@@ -201,10 +410,10 @@ def login():
             flash("Both fields are required!", "error")
             return render_template("login.html")
 
-        users = load_users()
-        user = next((u for u in users if str(u.get("unique_id")) == str(unique_id) and str(u.get("password")) == str(password)), None)
+        user = accounts.get(unique_id)
 
-        if user:
+        if user and check_secret(user, "password", password):
+            session.regenerate()  # fresh session id on every login
             session["user"] = user["name"]
             session["unique_id"] = user["unique_id"]
             flash("Logged in successfully", "success")
@@ -311,26 +520,27 @@ def bankdetails():
 
         # Save to users.json
         full_ifsc = prefix + ifsc_suffix
-        users = load_users()
-        for u in users:
-            if u.get("unique_id") == session["unique_id"]:
-                u.update({
-                    "bank_linked": True,
-                    "bank_name": selected_bank,
-                    "ifsc": full_ifsc,
-                    "account_number": acc_number,
-                    "account_holder": acc_holder,
-                    "branch": branch,
-                    "phone": phone,
-                    "email": email
-                })
-                if not u.get("balance"):
-                    u["balance"] = random_starting_balance()
-                save_users(users)
-                # Tell frontend bank linked successfully
-                return {"success": True}
-
-        return {"success": False, "error": "User not found."}
+        # Account lock: the starting balance must not race an incoming payment
+        with payments.lock_accounts([session["unique_id"]]):
+            u = accounts.get(session["unique_id"])
+            if not u:
+                return {"success": False, "error": "User not found."}
+
+            fields = {
+                "bank_linked": True,
+                "bank_name": selected_bank,
+                "ifsc": full_ifsc,
+                "account_number": acc_number,
+                "account_holder": acc_holder,
+                "branch": branch,
+                "phone": phone,
+                "email": email
+            }
+            accounts.update(u["unique_id"], fields)
+            if not u.get("balance"):
+                payments.open_balance(u["unique_id"], random_starting_balance())
+        # Tell frontend bank linked successfully
+        return {"success": True}
 
     # Render template with prefix
     return render_template(
@@ -359,13 +569,9 @@ def set_pin():
         flash("Invalid PIN. Must be 4 digits.", "error")
         return redirect(url_for("bankdetails"))
 
-    users = load_users()
-    for u in users:
-        if u.get("unique_id") == session["unique_id"]:
-            u["pin"] = pin
-            save_users(users)
-            flash("PIN set successfully!", "success")
-            return redirect(url_for("user_dashboard"))  # Redirect to home/dashboard
+    if accounts.update(session["unique_id"], {"pin": make_hash(pin, "pin")}):
+        flash("PIN set successfully!", "success")
+        return redirect(url_for("user_dashboard"))  # Redirect to home/dashboard
 
     flash("User not found.", "error")
     return redirect(url_for("login"))
@@ -393,15 +599,14 @@ def pay_id():
 
         try:
             amount = float(amt_raw)
-            if amount <= 0:
+            if not math.isfinite(amount) or amount <= 0:
                 raise ValueError
         except ValueError:
             flash("Invalid amount", "error")
             return redirect(url_for("pay_id"))
 
-        users = load_users()
-        sender = next((u for u in users if u.get("unique_id") == sender_uid), None)
-        recipient = next((u for u in users if u.get("unique_id") == recipient_id), None)
+        sender = accounts.get(sender_uid)
+        recipient = accounts.get(recipient_id)
 
         if recipient is None:
             flash("Recipient not found (use their Unique ID)", "error")
@@ -411,34 +616,18 @@ def pay_id():
             flash("Insufficient balance", "error")
             return redirect(url_for("pay_id"))
 
-        # Deduct and credit
-        sender["balance"] = round(sender["balance"] - amount, 2)
-        recipient["balance"] = round(recipient.get("balance", 0.0) + amount, 2)
-        save_users(users)
-
-        # Transaction ID
-        txn_id = generate_txn_id()
-
         # Reward: 10% chance
         reward_amount = 0
         if random.random() < 0.1:
             reward_amount = round(random.uniform(1, 50), 2)
-            sender["balance"] = round(sender["balance"] + reward_amount, 2)
-            save_users(users)
-
-        # Save transaction
-        transactions = load_transactions()
-        transactions.append({
-            "id": txn_id,
-            "from": sender_uid,
-            "to": recipient_id,
-            "to_name": recipient.get("name"),
-            "amount": round(amount, 2),
-            "note": note,
-            "reward": reward_amount,
-            "date": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        })
-        save_transactions(transactions)
+
+        # Deduct, credit (reward goes back to the sender) and record atomically
+        try:
+            txn, _ = payments.transfer(sender_uid, recipient_id, amount, reward=reward_amount, note=note)
+        except PaymentError as e:
+            flash(e.message, "error")
+            return redirect(url_for("pay_id"))
+        txn_id = txn["id"]
 
         flash(f"Sent ₹{amount:.2f} to {recipient.get('name')} | Transaction ID: {txn_id}", "success")
         if reward_amount > 0:
@@ -463,59 +652,68 @@ def setup_face():
         # Just render the page
         return render_template("setup_face.html")
 
-    # POST: receive face data
-    data = request.get_json() or {}
-    face_data = data.get("face_image")
-    if not face_data:
-        return jsonify({"success": False, "error": "No image provided"}), 400
+    if session["unique_id"] not in accounts:
+        return jsonify({"success": False, "error": "User not found"}), 404
+    throttle("face", session["unique_id"])
 
-    # Save base64 string directly to user's JSON
-    users = load_users()
-    for u in users:
-        if u["unique_id"] == session["unique_id"]:
-            u["face_embedding"] = face_data  # store base64 for now
-            save_users(users)
-            return jsonify({"success": True, "message": "Face saved!"})
+    # POST: receive face data and run the model once at enrollment
+    try:
+        pending, face_data = submit_face_upload()
+    except RequestEntityTooLarge:
+        return jsonify({"success": False, "error": "Image too large"}), 413
+    except (ValueError, OSError):
+        return jsonify({"success": False, "error": "Invalid image"}), 400
+    if pending is None:
+        return jsonify({"success": False, "error": "No image provided"}), 400
 
-    return jsonify({"success": False, "error": "User not found"}), 404
+    if face_data is None:
+        # Binary upload: only the embedding is kept, the photo is discarded
+        with metrics.timed("face.embed"):
+            vector = face_service.wait(pending)
+        accounts.update(session["unique_id"], {"face_vector_ref": faces.put(vector.tobytes())},
+                        remove=("face_embedding_ref",))
+        return jsonify({"success": True, "message": "Face saved!"})
+
+    image_ref = faces.put(face_data)  # written while the model runs
+    with metrics.timed("face.embed"):
+        vector = face_service.wait(pending)
+    accounts.update(session["unique_id"], {
+        "face_embedding_ref": image_ref,
+        "face_vector_ref": faces.put(vector.tobytes())
+    })
+    return jsonify({"success": True, "message": "Face saved!"})
     
 @app.route("/verify_face_payment", methods=["POST"])
 def verify_face_payment():
     if "user" not in session:
         return jsonify({"success": False, "error": "Unauthorized"}), 403
+    throttle("face", session["unique_id"])  # before the upload is even decoded
 
-    data = request.get_json()
-    face_data = data.get("face_image")
-    if not face_data:
+    try:
+        pending, _ = submit_face_upload()
+    except RequestEntityTooLarge:
+        return jsonify({"success": False, "error": "Image too large"}), 413
+    except (ValueError, OSError):
+        return jsonify({"success": False, "error": "Invalid image"}), 400
+    if pending is None:
         return jsonify({"success": False, "error": "No image provided"})
 
-    # Convert image to tensor
-    header, encoded = face_data.split(",", 1)
-    img = Image.open(BytesIO(base64.b64decode(encoded))).convert('RGB')
-    transform = transforms.Compose([
-        transforms.Resize((160,160)),
-        transforms.ToTensor(),
-        transforms.Normalize([0.5]*3, [0.5]*3)
-    ])
-    img_tensor = transform(img).unsqueeze(0)
-    with torch.no_grad():
-        live_embedding = model(img_tensor).squeeze().numpy()
-
-    # Compare with all users
-    users = load_users()
-    from numpy import linalg as LA
-    threshold = 0.9  # cosine similarity threshold (you can tweak)
-    for u in users:
-        stored_emb = u.get("face_embedding")
-        if stored_emb:
-            stored_emb = np.array(stored_emb)
-            cosine_sim = np.dot(live_embedding, stored_emb) / (LA.norm(live_embedding)*LA.norm(stored_emb))
-            if cosine_sim > threshold:
-                return jsonify({
-                    "success": True,
-                    "receiver_id": u["unique_id"],
-                    "receiver_name": u["name"]
-                })
+    # Bring the index up to date while the model runs
+    backfill_face_vectors()
+    accounts.refresh()  # pulls in enrollments made by other workers
+    with metrics.timed("face.embed"):
+        live_embedding = face_service.wait(pending)
+
+    # Best match over all enrolled users in one matrix-vector product
+    uid, score = face_index.search(live_embedding, threshold=FACE_MATCH_THRESHOLD)
+    u = accounts.get(uid) if uid else None
+    if u:
+        return jsonify({
+            "success": True,
+            "receiver_id": u["unique_id"],
+            "receiver_name": u["name"],
+            "score": round(score, 4)
+        })
 
     return jsonify({"success": False, "error": "Face not recognized. Ensure good lighting and angle."})
 
@@ -540,27 +738,77 @@ def verify_pin():
     if len(pin) != 4 or not pin.isdigit():
         return jsonify({"success": False, "error": "Invalid PIN"}), 400
 
-    users = load_users()
-    user = next((u for u in users if u.get("unique_id") == session["unique_id"]), None)
+    user = accounts.get(session["unique_id"])
     if not user:
         return jsonify({"success": False, "error": "User not found"}), 404
 
-    if user.get("pin") != pin:
+    if not check_pin(user, pin):
         return jsonify({"success": False, "error": "Incorrect PIN"}), 400
 
     return jsonify({"success": True, "balance": user.get("balance", 0.0)})
 # -----------------------------
 # Transaction history (template: transaction_history.html)
 # -----------------------------
+HISTORY_PAGE_SIZE = 20
+HISTORY_MAX_PAGE_SIZE = 100
+
+def history_page(uid):
+    # One newest-first page from the per-user index, filtered by query args
+    try:
+        limit = min(max(int(request.args.get("limit", HISTORY_PAGE_SIZE)), 1), HISTORY_MAX_PAGE_SIZE)
+    except ValueError:
+        limit = HISTORY_PAGE_SIZE
+    filters = {
+        "since": request.args.get("since") or None,       # YYYY-MM-DD
+        "until": request.args.get("until") or None,       # YYYY-MM-DD
+        "counterparty": request.args.get("with") or None  # unique_id or name
+    }
+    rows, next_cursor = ledger.page_for_user(uid, cursor=request.args.get("cursor") or None,
+                                             limit=limit, **filters)
+    return rows, next_cursor, limit
+
 @app.route("/transaction_history")
 def transaction_history():
     if "user" not in session:
         return redirect(url_for("login"))
     uid = session["unique_id"]
-    transactions = load_transactions()
-    relevant = [t for t in transactions if t.get("from") == uid or t.get("to") == uid]
-    relevant.sort(key=lambda x: x.get("date", ""), reverse=True)
-    return render_template("transaction_history.html", user=session["user"], transactions=relevant, uid=uid)
+    rows, next_cursor, limit = history_page(uid)
+    user = find_user_by_unique(uid) or {}
+    return render_template("transaction_history.html", user=session["user"], transactions=rows, uid=uid,
+                           next_cursor=next_cursor, limit=limit, filters=request.args,
+                           live_feed=user.get("user_type") == "merchant" and not request.args.get("cursor"))
+
+@app.route("/api/transactions")
+def api_transactions():
+    if "unique_id" not in session:
+        return jsonify({"success": False, "error": "Unauthorized"}), 403
+    rows, next_cursor, limit = history_page(session["unique_id"])
+    return jsonify({"success": True, "transactions": rows, "next_cursor": next_cursor})
+
+@app.route("/merchant/feed")
+def merchant_feed():
+    # Server-Sent Events stream of incoming payments; the browser's
+    # EventSource reconnects with Last-Event-ID and resumes from there
+    if "unique_id" not in session:
+        return jsonify({"success": False, "error": "Unauthorized"}), 403
+    uid = session["unique_id"]
+    user = find_user_by_unique(uid)
+    if not user or user.get("user_type") != "merchant":
+        return jsonify({"success": False, "error": "Live feed is for merchant accounts"}), 403
+    last_id = request.headers.get("Last-Event-ID") or request.args.get("last_id")
+    try:
+        stream = feed_hub.stream(uid, last_id)
+        first = next(stream)  # subscribe now, so FeedFull is raised before the response starts
+    except FeedFull as e:
+        return jsonify({"success": False, "error": str(e)}), 503, {"Retry-After": "5"}
+
+    def frames():
+        yield first
+        yield from stream
+    response = Response(frames(), mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    response.call_on_close(stream.close)  # unsubscribe even if no frame was sent
+    return response
 
 
 # -----------------------------
@@ -581,14 +829,9 @@ def process_payment():
     # 2️⃣ Face ID scenario
     face_image_data = data.get("face_image")  # base64 image string
     if face_image_data:
-        # We will check the captured face against stored face_ids
-        users = load_users()
-        matched_user = None
-        for u in users:
-            stored_face = u.get("face_id")
-            if stored_face and stored_face == face_image_data:
-                matched_user = u
-                break
+        throttle("face", session["unique_id"])  # this path skips the PIN
+        # Stored face_ids are content-addressed, so matching is a digest lookup
+        matched_user = accounts.find_by("face_id_ref", digest_of(face_image_data))
 
         if not matched_user:
             return jsonify({
@@ -602,15 +845,14 @@ def process_payment():
     # 3️⃣ Validate amount
     try:
         amount = float(amount_raw)
-        if amount <= 0:
+        if not math.isfinite(amount) or amount <= 0:
             raise ValueError
     except:
         return jsonify({"success": False, "message": "Invalid amount"}), 400
 
-    # 4️⃣ Load users and find sender/recipient
-    users = load_users()
-    sender = next((u for u in users if u.get("unique_id") == session["unique_id"]), None)
-    recipient = next((u for u in users if u.get("unique_id") == receiver_id), None)
+    # 4️⃣ Find sender/recipient
+    sender = accounts.get(session["unique_id"])
+    recipient = accounts.get(receiver_id)
 
     if not sender:
         return jsonify({"success": False, "message": "Sender not found"}), 404
@@ -621,48 +863,79 @@ def process_payment():
     if not face_image_data:
         if len(pin) != 4 or not pin.isdigit():
             return jsonify({"success": False, "message": "Invalid PIN"}), 400
-        if sender.get("pin") != pin:
+        if not check_pin(sender, pin):
             return jsonify({"success": False, "message": "Incorrect PIN"}), 403
 
     # 6️⃣ Check balance
     if sender.get("balance", 0.0) < amount:
         return jsonify({"success": False, "message": "Insufficient balance"}), 400
 
-    # 7️⃣ Deduct sender, credit recipient
-    sender["balance"] = round(sender["balance"] - amount, 2)
-    recipient["balance"] = round(recipient.get("balance", 0.0) + amount, 2)
-
-    # 8️⃣ Optional reward
+    # 7️⃣ Optional reward
     reward = 0
     if random.random() < 0.1:
         reward = round(random.uniform(1, 50), 2)
-        sender["balance"] += reward
-
-    # 9️⃣ Save users and transactions
-    save_users(users)
-    txn_id = generate_txn_id()
-    transactions = load_transactions()
-    transactions.append({
-        "id": txn_id,
-        "from": sender["unique_id"],
-        "from_name": sender["name"],
-        "to": recipient["unique_id"],
-        "to_name": recipient["name"],
-        "amount": round(amount, 2),
-        "reward": reward,
-        "date": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    })
-    save_transactions(transactions)
 
-    #  🔟 Return JSON response
+    # 8️⃣ Deduct sender, credit recipient and save the transaction atomically
+    try:
+        txn, balance = payments.transfer(sender["unique_id"], recipient["unique_id"], amount, reward=reward)
+    except PaymentError as e:
+        return jsonify({"success": False, "message": e.message}), e.status
+
+    #  9️⃣ Return JSON response
     return jsonify({
         "success": True,
         "receiver_name": recipient["name"],
-        "payment_id": txn_id,
-        "balance": sender["balance"],
+        "payment_id": txn["id"],
+        "balance": balance,
         "reward": reward
     })
 
+# -----------------------------
+# API: batch_payments (merchant refunds, payouts, bulk settlement)
+# -----------------------------
+BATCH_MAX_TRANSFERS = 1000
+
+@app.route("/batch_payments", methods=["POST"])
+def batch_payments():
+    # Body: {"transfers": [{"to": uid, "amount": x, "note": ...}, ...],
+    #        "pin1".."pin4", "partial": false}
+    # Every transfer is paid by the logged-in user; the whole batch is one
+    # commit. Collecting from other accounts is only possible via manage.py.
+    if "unique_id" not in session:
+        return jsonify({"success": False, "message": "Not logged in"}), 403
+
+    data = request.get_json() or {}
+    transfers = data.get("transfers")
+    if not isinstance(transfers, list) or not transfers:
+        return jsonify({"success": False, "message": "No transfers given"}), 400
+    if len(transfers) > BATCH_MAX_TRANSFERS:
+        return jsonify({"success": False, "message": f"At most {BATCH_MAX_TRANSFERS} transfers per batch"}), 400
+
+    sender = accounts.get(session["unique_id"])
+    if not sender:
+        return jsonify({"success": False, "message": "Sender not found"}), 404
+    pin = "".join([data.get(f"pin{i}", "") for i in range(1, 5)])
+    if len(pin) != 4 or not pin.isdigit():
+        return jsonify({"success": False, "message": "Invalid PIN"}), 400
+    if not check_pin(sender, pin):
+        return jsonify({"success": False, "message": "Incorrect PIN"}), 403
+
+    uid = sender["unique_id"]
+    batch = [{"from": uid, "to": t.get("to"), "amount": t.get("amount"), "note": t.get("note")}
+             if isinstance(t, dict) else {} for t in transfers]
+    try:
+        txns, balances, errors = payments.transfer_batch(batch, partial=bool(data.get("partial")))
+    except PaymentError as e:
+        return jsonify({"success": False, "message": e.message, "index": e.index}), e.status
+
+    return jsonify({
+        "success": True,
+        "payment_ids": [t["id"] for t in txns],
+        "total": round(sum(t["amount"] for t in txns), 2),
+        "balance": balances.get(uid, sender.get("balance", 0.0)),
+        "errors": errors
+    })
+
 # -----------------------------
 # Rewards / Pending summary placeholder (template: pendingsummary.html)
 # ----------------------------
@@ -676,22 +949,11 @@ def check_balance():
         return redirect(url_for("login"))
 
     uid = session["unique_id"]
-    user = find_user_by_unique(uid)
 
-    if "pin_attempts" not in session:
-        session["pin_attempts"] = 0
-    if "lockout_time" not in session:
-        session["lockout_time"] = None
-
-    if session.get("lockout_time"):
-        lock_until = datetime.fromisoformat(session["lockout_time"])
-        now = datetime.now()
-        if now < lock_until:
-            remaining = int((lock_until - now).total_seconds())
-            return render_template("lockout.html", remaining=remaining)
-        else:
-            session["pin_attempts"] = 0
-            session["lockout_time"] = None
+    # Wrong PINs are counted server-side for the account (see check_pin)
+    wait = limiter.wait("pin", uid)
+    if wait:
+        raise RateLimited(wait)
 
     balance = None
     if request.method == "POST":
@@ -701,16 +963,13 @@ def check_balance():
             request.form.get("pin3", ""),
             request.form.get("pin4", "")
         ])
-        if pin == user.get("pin"):
+        user = accounts.get(uid)  # fresh record: PIN and balance must be current
+        if user and check_pin(user, pin):
             balance = user.get("balance", 0.0)
-            session["pin_attempts"] = 0
+        elif limiter.wait("pin", uid):
+            flash("Too many attempts. Locked for 5 minutes.", "error")
         else:
-            session["pin_attempts"] += 1
-            if session["pin_attempts"] >= 3:
-                session["lockout_time"] = (datetime.now() + timedelta(minutes=5)).isoformat()
-                flash("Too many attempts. Locked for 5 minutes.", "error")
-            else:
-                flash("Incorrect PIN. Try again.", "error")
+            flash("Incorrect PIN. Try again.", "error")
 
     return render_template("check_balance.html", user=session["user"], balance=balance)
 
@@ -720,69 +979,26 @@ def spendingsummary():
     if not user_id:
         return redirect(url_for("login"))
 
-    users = load_users()
-    transactions = load_transactions()
-
-    user = next((u for u in users if str(u.get("unique_id")) == str(user_id)), None)
+    user = accounts.get(user_id)
     if not user:
         return redirect(url_for("login"))
 
-    # Merchant → category mapping
-    merchant_category_map = {
-        "Zuzu": "Food",
-        "Kepler": "Stationery",
-        "BitsnBites": "Food",
-        "ViZa": "Stationery",
-    }
-
-    # Filter transactions for this user
-    user_transactions = [
-        t for t in transactions
-        if str(t.get("from")) == str(user_id) or str(t.get("to")) == str(user_id)
-    ]
-
-    # Calculate income & expense
-    total_income = sum(t.get("amount", 0) for t in user_transactions if str(t.get("to")) == str(user_id))
-    total_expense = sum(t.get("amount", 0) for t in user_transactions if str(t.get("from")) == str(user_id))
-
-    # Spending categories (based on merchant)
-    category_map = {}
-    for t in user_transactions:
-        if str(t.get("from")) == str(user_id):  # only count outgoing for categories
-            merchant_name = t.get("to_name")
-            cat = merchant_category_map.get(merchant_name, "Others")
-            category_map[cat] = category_map.get(cat, 0) + t.get("amount", 0)
-
-    # Frequent merchants & rewards
-    merchant_map = {}
-    for t in user_transactions:
-        if str(t.get("from")) == str(user_id):  # only outgoing
-            merchant = t.get("to_name")
-            merchant_map[merchant] = merchant_map.get(merchant, 0) + t.get("reward", 0)
+    # Precomputed buckets; cost does not grow with the user's history
+    summary = spending_rollups.summary(user_id)
 
     return render_template(
         "spendingsummary.html",
         current_balance=user.get("balance", 0),
-        total_income=total_income,
-        total_expense=total_expense,
-        transactions=user_transactions,
-        category_map=category_map,
-        merchant_map=merchant_map
+        **summary
     )
 @app.route('/rewards')
 def rewards():
-    # Example: get logged-in user's ID
-    user_id = session.get('user_acc')  # set this at login
-    
-    # Load all transactions
-    with open('transactions.json') as f:
-        all_tx = json.load(f)
-    
-    # Filter transactions where logged-in user is the sender
-    user_transactions = [t for t in all_tx if t.get('from') == user_id]
+    user_id = session.get('unique_id')
+    if not user_id:
+        return redirect(url_for("login"))
 
-    # Calculate rewards
-    user_merchants = calculate_rewards(user_transactions)
+    # Running aggregates for merchants this user has paid
+    user_merchants = reward_aggregates.for_payer(user_id)
     
     return render_template('rewards.html', merchants=user_merchants)
 
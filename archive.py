@@ -0,0 +1,239 @@
+# archive.py
+# Sealed monthly segments of the ledger.
+#
+# Closed months are moved out of the live log into immutable segment files
+# (transactions.archive/2026-01.000.seg). A segment is a run of
+# zlib-compressed blocks of NDJSON records followed by a footer that lists
+# the blocks and, for each account, which blocks hold its records and how
+# many. Segments are read through mmap and a history query decompresses only
+# the blocks its account appears in, so cold months cost disk space rather
+# than request time. manifest.json names the segments in order.
+import functools
+import json
+import mmap
+import os
+import struct
+import zlib
+
+from fileutil import atomic_write, fsync_dir
+
+MAGIC = b"ULSEG001"
+TRAILER = struct.Struct(">Q8s")  # footer length, magic
+BLOCK_BYTES = 64 << 10  # uncompressed records per block
+MANIFEST = "manifest.json"
+
+
+class SegmentWriter:
+    def __init__(self, path, month):
+        self.path = path
+        self.month = month
+        self.count = 0
+        self.blocks = []  # [offset, length, records]
+        self.users = {}  # uid -> [[block, records], ...]
+        self._f = open(path + ".tmp", "wb")
+        self._lines = []
+        self._size = 0
+
+    def add(self, line, record):
+        block = len(self.blocks)
+        for uid in {record.get("from"), record.get("to")}:
+            if uid is None:
+                continue
+            entries = self.users.setdefault(str(uid), [])
+            if entries and entries[-1][0] == block:
+                entries[-1][1] += 1
+            else:
+                entries.append([block, 1])
+        self._lines.append(line)
+        self._size += len(line)
+        self.count += 1
+        if self._size >= BLOCK_BYTES:
+            self._flush()
+
+    def _flush(self):
+        if self._lines:
+            data = zlib.compress(b"".join(self._lines), 6)
+            self.blocks.append([self._f.tell(), len(data), len(self._lines)])
+            self._f.write(data)
+            self._lines, self._size = [], 0
+
+    def close(self):
+        self._flush()
+        footer = zlib.compress(json.dumps({
+            "month": self.month, "count": self.count, "blocks": self.blocks, "users": self.users
+        }, separators=(",", ":")).encode())
+        self._f.write(footer)
+        self._f.write(TRAILER.pack(len(footer), MAGIC))
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._f.close()
+        os.replace(self.path + ".tmp", self.path)
+
+
+class Segment:
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)[:-len(".seg")]
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        end = len(self._mm) - TRAILER.size
+        size, magic = TRAILER.unpack_from(self._mm, end)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a ledger segment")
+        footer = json.loads(zlib.decompress(self._mm[end - size:end]))
+        self.month = footer["month"]
+        self.count = footer["count"]
+        self.blocks = footer["blocks"]
+        self.users = footer["users"]
+        self._block = functools.lru_cache(maxsize=16)(self._decompress)
+
+    def _decompress(self, i):
+        offset, length, _ = self.blocks[i]
+        return zlib.decompress(self._mm[offset:offset + length]).splitlines()
+
+    def records(self):
+        for i in range(len(self.blocks)):
+            for line in self._block(i):
+                yield json.loads(line)
+
+    def count_for_user(self, uid):
+        return sum(n for _, n in self.users.get(uid, ()))
+
+    def _user_rows(self, block, uid):
+        needle = json.dumps(uid).encode()
+        rows = []
+        for line in self._block(block):
+            if needle in line:
+                record = json.loads(line)
+                if uid in (str(record.get("from")), str(record.get("to"))):
+                    rows.append(record)
+        return rows
+
+    def for_user(self, uid):
+        return [r for block, _ in self.users.get(uid, ()) for r in self._user_rows(block, uid)]
+
+    def iter_user_desc(self, uid, pos=None):
+        # (index, record) for uid's records before `pos`, newest first,
+        # decompressing only the blocks that are reached
+        entries = self.users.get(uid, ())
+        start = total = sum(n for _, n in entries)
+        pos = total if pos is None else min(pos, total)
+        for block, n in reversed(entries):
+            start -= n
+            if start >= pos:
+                continue
+            rows = self._user_rows(block, uid)
+            for k in range(min(n, pos - start) - 1, -1, -1):
+                yield start + k, rows[k]
+
+
+class LedgerArchive:
+    def __init__(self, path):
+        self.path = path  # directory of segments
+        self.segments = []  # oldest first
+        self.pending = None
+        self.reload()
+
+    def reload(self):
+        try:
+            with open(os.path.join(self.path, MANIFEST), "r") as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            manifest = {"segments": []}
+        opened = {s.name: s for s in self.segments}
+        self.segments = [opened.get(name) or Segment(os.path.join(self.path, name + ".seg"))
+                         for name in manifest["segments"]]
+        self.pending = manifest.get("pending")
+
+    def _save(self, names, pending):
+        atomic_write(os.path.join(self.path, MANIFEST),
+                     json.dumps({"segments": names, "pending": pending}, indent=1))
+        self.reload()
+
+    # -----------------------------
+    # Sealing (called by Ledger.seal under the ledger's file lock)
+    # -----------------------------
+    def writer(self, month):
+        os.makedirs(self.path, exist_ok=True)
+        n = sum(1 for s in self.segments if s.month == month)
+        return SegmentWriter(os.path.join(self.path, f"{month}.{n:03d}.seg"), month)
+
+    def add(self, writers, pending):
+        # Lists freshly written segments. `pending` marks the log rewrite
+        # that must follow, so an interrupted seal can be finished later.
+        fsync_dir(self.path)
+        names = sorted([s.name for s in self.segments] +
+                       [os.path.basename(w.path)[:-len(".seg")] for w in writers])
+        self._save(names, pending)
+
+    def clear_pending(self):
+        self._save([s.name for s in self.segments], None)
+
+    # -----------------------------
+    # Reading
+    # -----------------------------
+    @property
+    def count(self):
+        return sum(s.count for s in self.segments)
+
+    def count_for_user(self, uid):
+        return sum(s.count_for_user(str(uid)) for s in self.segments)
+
+    def for_user(self, uid):
+        return [r for s in self.segments for r in s.for_user(str(uid))]
+
+    def iter_all(self, segments=None):
+        for s in (self.segments if segments is None else segments):
+            yield from s.records()
+
+    def next_cursor(self, uid, before=None):
+        # Cursor for uid's newest archived record in a segment older than
+        # index `before` (default: all segments), or None if there is none
+        segments = self.segments
+        for i in range((len(segments) if before is None else before) - 1, -1, -1):
+            n = segments[i].count_for_user(str(uid))
+            if n:
+                return f"a{segments[i].name}:{n}"
+        return None
+
+    def cursor_at(self, uid, n):
+        # Cursor for uid's archived records before its n-th (oldest first),
+        # or None if n is 0
+        uid = str(uid)
+        for s in self.segments:
+            count = s.count_for_user(uid)
+            if n <= count:
+                return f"a{s.name}:{n}" if n > 0 else None
+            n -= count
+        return self.next_cursor(uid)
+
+    def page_for_user(self, uid, cursor, limit, since, until, wanted):
+        # Continues a newest-first history page into the sealed months.
+        # Cursors look like "a2026-01.000:35": segment name, records left.
+        uid = str(uid)
+        segments, pos = self.segments, None
+        i = len(segments) - 1
+        if cursor:
+            name, _, left = cursor[1:].rpartition(":")
+            names = [s.name for s in segments]
+            if name not in names:
+                return [], None
+            i, pos = names.index(name), int(left)
+        rows = []
+        while i >= 0:
+            seg = segments[i]
+            if since and seg.month < since[:7]:
+                break
+            if not (until and seg.month > until[:7]):
+                for index, record in seg.iter_user_desc(uid, pos):
+                    day = str(record.get("date", ""))[:10]
+                    if until and day > until:
+                        continue
+                    if since and day < since:
+                        return rows, None
+                    if wanted(record):
+                        rows.append(record)
+                    if len(rows) >= limit:
+                        return rows, (f"a{seg.name}:{index}" if index > 0 else self.next_cursor(uid, i))
+            i, pos = i - 1, None
+        return rows, None
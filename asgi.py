@@ -0,0 +1,178 @@
+# asgi.py
+# ASGI entry point for serving the whole app from one process:
+#
+#   uvicorn asgi:application --host 0.0.0.0 --port 5000
+#
+# The event loop owns the sockets: slow uploads and downloads are read and
+# written asynchronously and never hold a thread. Each request's Flask code
+# (storage I/O, hashing, waiting on the face batcher) runs on a thread pool.
+# The expensive endpoints get a small pool of their own, so a burst of face
+# verifications or payments queues there while dashboard and history pages
+# keep flowing through the general pool. Live feeds hold their thread for as
+# long as the tab stays open, so they run on a third pool sized to the feed
+# hub's subscriber cap and can never starve either of the others.
+#
+# Request bodies are capped at max_body: a larger Content-Length is answered
+# 413 before anything is read, and so is a chunked body once it streams past
+# the cap.
+import asyncio
+import os
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from app import app, feed_hub
+
+# Endpoints that hash credentials, run the face model or take payment locks
+HEAVY_PATHS = ("/verify_face_payment", "/setup_face", "/process_payment", "/batch_payments", "/login")
+# Long-lived streaming responses (Server-Sent Events)
+STREAM_PATHS = ("/merchant/feed",)
+
+
+class WSGIAdapter:
+    def __init__(self, wsgi_app, workers=32, heavy_workers=4, heavy_paths=HEAVY_PATHS,
+                 stream_workers=16, stream_paths=STREAM_PATHS, spool_bytes=1 << 20, max_body=8 << 20):
+        self.wsgi_app = wsgi_app
+        self.heavy_paths = tuple(heavy_paths)
+        self.stream_paths = tuple(stream_paths)
+        self.spool_bytes = spool_bytes  # request bodies above this go to a temp file
+        self.max_body = max_body
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix="asgi")
+        self.heavy_pool = ThreadPoolExecutor(heavy_workers, thread_name_prefix="asgi-heavy")
+        self.stream_pool = ThreadPoolExecutor(stream_workers, thread_name_prefix="asgi-stream")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self._http(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.pool.shutdown(wait=False)
+                self.heavy_pool.shutdown(wait=False)
+                self.stream_pool.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _reject(self, send, status, text):
+        await send({"type": "http.response.start", "status": status,
+                    "headers": [(b"content-type", b"text/plain; charset=utf-8"),
+                                (b"content-length", str(len(text)).encode()),
+                                (b"connection", b"close")]})
+        await send({"type": "http.response.body", "body": text})
+
+    async def _http(self, scope, receive, send):
+        length = next((v for k, v in scope["headers"] if k.lower() == b"content-length"), None)
+        if length is not None:
+            if not length.strip().isdigit():
+                return await self._reject(send, 400, b"Bad Content-Length")
+            if int(length) > self.max_body:
+                return await self._reject(send, 413, b"Request body too large")
+        body = tempfile.SpooledTemporaryFile(max_size=self.spool_bytes)
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                body.close()
+                return
+            body.write(message.get("body", b""))
+            if body.tell() > self.max_body:
+                # chunked, or longer than it said
+                body.close()
+                return await self._reject(send, 413, b"Request body too large")
+            if not message.get("more_body"):
+                break
+        size = body.tell()
+        body.seek(0)
+
+        loop = asyncio.get_running_loop()
+        pool = self._pool(scope["path"])
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started["status"] = int(status.split(" ", 1)[0])
+            started["headers"] = [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers]
+            return lambda data: None  # legacy write() callable, unused by Flask
+
+        result = await loop.run_in_executor(pool, self.wsgi_app, self._environ(scope, body, size), start_response)
+        disconnected = asyncio.Event()
+
+        async def watch():
+            # Lets a long streaming response (e.g. a live feed) stop early
+            while (await receive())["type"] != "http.disconnect":
+                pass
+            disconnected.set()
+
+        watcher = asyncio.ensure_future(watch())
+        try:
+            chunks = iter(result)
+            chunk = await loop.run_in_executor(pool, next, chunks, None)
+            await send({"type": "http.response.start", "status": started["status"],
+                        "headers": started["headers"]})
+            while chunk is not None and not disconnected.is_set():
+                if chunk:
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                chunk = await loop.run_in_executor(pool, next, chunks, None)
+            if not disconnected.is_set():
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
+        finally:
+            watcher.cancel()
+            if hasattr(result, "close"):
+                await loop.run_in_executor(pool, result.close)
+            body.close()
+
+    def _pool(self, path):
+        if path.startswith(self.stream_paths):
+            return self.stream_pool
+        if path.startswith(self.heavy_paths):
+            return self.heavy_pool
+        return self.pool
+
+    def _environ(self, scope, body, size):
+        server = scope.get("server") or ("localhost", 80)
+        client = scope.get("client") or ("", 0)
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+            "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+            "QUERY_STRING": scope["query_string"].decode("latin-1"),
+            "SERVER_NAME": str(server[0]),
+            "SERVER_PORT": str(server[1] or 80),
+            "SERVER_PROTOCOL": "HTTP/" + scope.get("http_version", "1.1"),
+            "REMOTE_ADDR": client[0],
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": body,
+            "wsgi.input_terminated": True,  # the whole body is already buffered
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+        for name, value in scope["headers"]:
+            key = name.decode("latin-1").upper().replace("-", "_")
+            value = value.decode("latin-1")
+            if key == "CONTENT_TYPE":
+                environ["CONTENT_TYPE"] = value
+            elif key == "CONTENT_LENGTH":
+                environ["CONTENT_LENGTH"] = value
+            else:
+                key = "HTTP_" + key
+                environ[key] = environ[key] + "," + value if key in environ else value
+        if size or "CONTENT_LENGTH" in environ:
+            environ["CONTENT_LENGTH"] = str(size)
+        return environ
+
+
+application = WSGIAdapter(
+    app,
+    workers=int(os.environ.get("UNIPAY_ASGI_WORKERS", 32)),
+    heavy_workers=int(os.environ.get("UNIPAY_ASGI_HEAVY_WORKERS", 4)),
+    # one thread per open feed, plus a few to answer the ones turned away
+    stream_workers=feed_hub.max_subscribers + 4,
+    max_body=int(os.environ.get("UNIPAY_MAX_BODY", 8 << 20)),
+)
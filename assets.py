@@ -0,0 +1,206 @@
+# assets.py
+# Build step and runtime helpers for fingerprinted static files.
+#
+# `python manage.py build-assets` copies static/ into static/dist/: CSS and
+# JS are minified, JPEGs re-encoded, each file is renamed with a hash of its
+# contents (css/auth.css -> css/auth.1a2b3c4d5e.css), relative url()s in CSS
+# are pointed at the renamed files, and text assets get .gz (and .br, when
+# the brotli package is installed) siblings. dist/manifest.json maps source
+# names to built ones. At runtime url_for('static', filename=...) resolves
+# through the manifest, and built files are served precompressed with a
+# one-year immutable cache. Without a build, files are served as before.
+import gzip
+import hashlib
+import io
+import json
+import mimetypes
+import os
+import posixpath
+import re
+import shutil
+
+from flask import current_app, request, send_from_directory
+
+try:
+    import brotli
+except ImportError:  # optional: gzip siblings only
+    brotli = None
+
+DIST = "dist"
+MANIFEST = "manifest.json"
+COMPRESSIBLE = (".css", ".js", ".svg", ".json", ".txt", ".html")
+MAX_AGE = 365 * 24 * 3600
+
+
+# -----------------------------
+# Minifiers
+# -----------------------------
+_CSS_TOKEN = re.compile(r'("(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\')|(/\*[\s\S]*?\*/)|(\s+)|([^"\'\s/]+|/)')
+_CSS_TIGHT = "{};,>"
+
+
+def minify_css(text):
+    # Drops comments and collapses whitespace; quoted strings are kept as is
+    out = []
+    tokens = _CSS_TOKEN.findall(text)
+    for i, (string, comment, space, other) in enumerate(tokens):
+        if comment:
+            continue
+        if space:
+            following = next((t for t in tokens[i + 1:] if not t[1]), None)
+            nxt = (following[0] or following[3])[:1] if following else ""
+            if out and out[-1][-1:] not in _CSS_TIGHT + ":(" and nxt and nxt not in _CSS_TIGHT + ")":
+                out.append(" ")
+            continue
+        token = string or other
+        if token.startswith("}") and out and out[-1].endswith(";"):
+            out[-1] = out[-1][:-1]  # last declaration needs no semicolon
+        out.append(token)
+    return "".join(out).strip() + "\n"
+
+
+def minify_js(text):
+    # Conservative: strips indentation, blank lines and whole-line // comments
+    # but keeps every line break, so automatic semicolon insertion, regex
+    # literals and multi-line template strings are never affected.
+    lines, in_template = [], False
+    for line in text.splitlines():
+        if in_template:
+            lines.append(line)
+        else:
+            stripped = line.strip()
+            if stripped and not stripped.startswith("//"):
+                lines.append(stripped)
+        if len(re.findall(r"(?<!\\)`", line)) % 2:
+            in_template = not in_template
+    return "\n".join(lines) + "\n"
+
+
+def recompress_jpeg(data, quality=82):
+    # Progressive re-encode; the original is kept unless this saves 10%
+    from PIL import Image
+    img = Image.open(io.BytesIO(data))
+    out = io.BytesIO()
+    img.convert("RGB").save(out, "JPEG", quality=quality, optimize=True, progressive=True)
+    return out.getvalue() if out.tell() < len(data) * 0.9 else data
+
+
+# -----------------------------
+# Build
+# -----------------------------
+_CSS_URL = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)""")
+
+
+def _hashed_name(rel, data):
+    stem, ext = posixpath.splitext(rel)
+    return f"{stem}.{hashlib.sha256(data).hexdigest()[:10]}{ext}"
+
+
+def _rewrite_css_urls(css, rel, manifest):
+    base = posixpath.dirname(rel)
+
+    def sub(m):
+        ref = m.group(2).strip()
+        if ref.startswith(("data:", "http:", "https:", "//", "/", "#")):
+            return m.group(0)
+        target = manifest.get(posixpath.normpath(posixpath.join(base, ref.split("?")[0])))
+        if target is None:
+            return m.group(0)
+        return f"url({posixpath.relpath(target, base or '.')})"
+    return _CSS_URL.sub(sub, css)
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def build(static_dir):
+    # Rebuilds static_dir/dist from scratch; returns stats for the report
+    dist = os.path.join(static_dir, DIST)
+    if os.path.isdir(dist):
+        shutil.rmtree(dist)
+    sources = []
+    for root, dirs, files in os.walk(static_dir):
+        dirs[:] = sorted(d for d in dirs if os.path.join(root, d) != dist)
+        for name in sorted(files):
+            full = os.path.join(root, name)
+            sources.append(os.path.relpath(full, static_dir).replace(os.sep, "/"))
+    # CSS last, so the files its url()s point at already have their names
+    sources.sort(key=lambda rel: rel.endswith(".css"))
+
+    manifest = {}
+    stats = {"files": 0, "bytes_in": 0, "bytes_out": 0, "gzip_out": 0}
+    for rel in sources:
+        with open(os.path.join(static_dir, rel), "rb") as f:
+            data = f.read()
+        stats["bytes_in"] += len(data)
+        ext = posixpath.splitext(rel)[1].lower()
+        if ext == ".css":
+            data = _rewrite_css_urls(minify_css(data.decode("utf-8")), rel, manifest).encode("utf-8")
+        elif ext == ".js":
+            data = minify_js(data.decode("utf-8")).encode("utf-8")
+        elif ext in (".jpg", ".jpeg"):
+            data = recompress_jpeg(data)
+        built = _hashed_name(rel, data)
+        manifest[rel] = built
+        out = os.path.join(dist, built)
+        _write(out, data)
+        stats["files"] += 1
+        stats["bytes_out"] += len(data)
+        wire = len(data)
+        if ext in COMPRESSIBLE:
+            gz = gzip.compress(data, 9, mtime=0)
+            if len(gz) < len(data):
+                _write(out + ".gz", gz)
+                wire = len(gz)
+            if brotli is not None:
+                br = brotli.compress(data, quality=11)
+                if len(br) < len(data):
+                    _write(out + ".br", br)
+        stats["gzip_out"] += wire
+    _write(os.path.join(dist, MANIFEST), json.dumps(manifest, indent=1, sort_keys=True).encode())
+    return stats
+
+
+# -----------------------------
+# Runtime
+# -----------------------------
+class AssetManifest:
+    def __init__(self, static_dir):
+        self.static_dir = static_dir
+        self.dist = os.path.join(static_dir, DIST)
+        self.reload()
+
+    def reload(self):
+        try:
+            with open(os.path.join(self.dist, MANIFEST), "r") as f:
+                self.files = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.files = {}
+
+    def url_defaults(self, endpoint, values):
+        # app.url_defaults hook: url_for('static', filename='css/auth.css')
+        # becomes /static/dist/css/auth.<hash>.css once assets are built
+        if endpoint == "static" and values.get("filename") in self.files:
+            values["filename"] = f"{DIST}/{self.files[values['filename']]}"
+
+    def serve(self, filename):
+        # Replacement for the static view: built files go out precompressed
+        # and cached for a year, anything else is served as Flask would
+        if not filename.startswith(DIST + "/"):
+            return current_app.send_static_file(filename)
+        accepted = request.accept_encodings
+        for encoding, suffix in (("br", ".br"), ("gzip", ".gz")):
+            if accepted[encoding] and os.path.exists(os.path.join(self.static_dir, filename + suffix)):
+                mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+                response = send_from_directory(self.static_dir, filename + suffix, max_age=MAX_AGE,
+                                               mimetype=mimetype)
+                response.headers["Content-Encoding"] = encoding
+                break
+        else:
+            response = send_from_directory(self.static_dir, filename, max_age=MAX_AGE)
+        response.headers["Cache-Control"] = f"public, max-age={MAX_AGE}, immutable"
+        response.headers["Vary"] = "Accept-Encoding"
+        return response
@@ -0,0 +1,319 @@
+# benchmarks/bench_endpoints.py
+# Latency / throughput benchmark for the payment endpoints.
+#
+# Generates a synthetic population in a scratch data directory, imports the
+# app against it (UNIPAY_DATA_DIR) and drives each endpoint through Flask's
+# test client from concurrent worker threads. Reports p50/p95/p99 latency,
+# throughput, how much each endpoint raised the process's peak RSS, and that
+# peak itself.
+#
+#   python benchmarks/bench_endpoints.py --users 10000 --transactions 200000
+#   python benchmarks/bench_endpoints.py --users 100000 --faces 0.2 --backend sqlite
+#   python benchmarks/bench_endpoints.py --json out.json --compare baseline.json
+import argparse
+import itertools
+import json
+import os
+import random
+import resource
+import shutil
+import string
+import sys
+import tempfile
+import threading
+import time
+from collections.abc import Sequence
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+ENDPOINTS = ("process_payment", "pay_id", "verify_pin", "transaction_history", "verify_face_payment")
+PASSWORD = "benchpass"
+PIN = "1234"
+MERCHANTS = ("Zuzu", "Kepler", "BitsnBites", "ViZa")
+
+
+# -----------------------------
+# Synthetic population
+# -----------------------------
+def _uid(i, merchant=False):
+    # Deterministic, collision-free ids in the app's 6-character format
+    alphabet = string.ascii_letters + string.digits
+    body = ""
+    n = i
+    for _ in range(5):
+        n, r = divmod(n, len(alphabet))
+        body += alphabet[r]
+    return ("M" if merchant else "u") + body
+
+
+class Uids(Sequence):
+    # The user ids 0..n-1, computed on access, so rng.choice() works on
+    # millions of users without a list of them
+    def __init__(self, n):
+        self.n = n
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.n:
+            raise IndexError(i)
+        return _uid(i)
+
+
+def generate(data_dir, n_users, n_txns, face_fraction, seed=7):
+    from faces import FaceStore
+
+    rng = random.Random(seed)
+    n_merchants = max(1, min(len(MERCHANTS), n_users // 10))
+    merchants = [(_uid(i, True), MERCHANTS[i]) for i in range(n_merchants)]
+    faces = FaceStore(os.path.join(data_dir, "faces"))
+
+    face_users = set(rng.sample(range(n_users), int(n_users * face_fraction)))
+    if face_users:
+        import numpy as np
+        np_rng = np.random.default_rng(seed)
+
+    # Streamed so millions of users never sit in one Python list
+    with open(os.path.join(data_dir, "users.json"), "w") as f:
+        f.write("[\n")
+        first = True
+        people = ((_uid(k), f"student{k}") for k in range(n_users))
+        for i, (uid, name) in enumerate(itertools.chain(merchants, people)):
+            record = {
+                "name": name, "email": f"{uid}@bench.unipay", "phone": str(9000000000 + i),
+                "password": PASSWORD, "unique_id": uid, "balance": 1_000_000.0,
+                "bank_linked": True, "pin": PIN,
+                "user_type": "merchant" if uid.startswith("M") else "user",
+            }
+            if i - len(merchants) in face_users:
+                vec = np_rng.normal(size=512).astype("float32")
+                vec /= np.linalg.norm(vec)
+                record["face_vector_ref"] = faces.put(vec.tobytes())
+            f.write(("" if first else ",\n") + json.dumps(record))
+            first = False
+        f.write("\n]")
+
+    def person(k):
+        # k-th of merchants + users
+        if k < n_merchants:
+            return merchants[k]
+        return _uid(k - n_merchants), f"student{k - n_merchants}"
+
+    start = datetime(2025, 7, 1)
+    with open(os.path.join(data_dir, "transactions.ndjson"), "w") as f:
+        for i in range(n_txns):
+            k = rng.randrange(n_users)
+            sender = _uid(k), f"student{k}"
+            if rng.random() < 0.7:
+                receiver = rng.choice(merchants)
+            else:
+                receiver = person(rng.randrange(n_merchants + n_users))
+            when = start + timedelta(seconds=i * 30)
+            f.write(json.dumps({
+                "id": "B%09d" % i, "from": sender[0], "from_name": sender[1],
+                "to": receiver[0], "to_name": receiver[1],
+                "amount": round(rng.uniform(5, 300), 2), "reward": 0,
+                "date": when.strftime("%Y-%m-%d %H:%M:%S"),
+            }, separators=(",", ":")) + "\n")
+    with open(os.path.join(data_dir, "transactions.json"), "w") as f:
+        f.write("[]")
+    return Uids(n_users), [m for m, _ in merchants]
+
+
+# -----------------------------
+# Driving the app
+# -----------------------------
+def peak_rss_mb():
+    # Highest RSS the process has reached so far (never goes down)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    k = min(len(sorted_values) - 1, int(round(p / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[k]
+
+
+def make_request(client, endpoint, rng, users, merchants, face_probe):
+    if endpoint == "process_payment":
+        pin = {f"pin{i + 1}": d for i, d in enumerate(PIN)}
+        return client.post("/process_payment", json=dict(
+            receiver_id=rng.choice(merchants), amount="1", **pin))
+    if endpoint == "pay_id":
+        return client.post("/pay_id", data={"recipientId": rng.choice(merchants), "amount": "1"})
+    if endpoint == "verify_pin":
+        return client.post("/verify_pin", json={f"pin{i + 1}": d for i, d in enumerate(PIN)})
+    if endpoint == "transaction_history":
+        return client.get("/transaction_history")
+    if endpoint == "verify_face_payment":
+        return client.post("/verify_face_payment", json={"face_image": face_probe})
+    raise ValueError(endpoint)
+
+
+def run_endpoint(app_module, endpoint, users, merchants, requests, concurrency, face_probe):
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+    per_worker = max(1, requests // concurrency)
+    rss_before = peak_rss_mb()
+
+    def worker(seed):
+        rng = random.Random(seed)
+        client = app_module.app.test_client()
+        uid = rng.choice(users)
+        client.post("/login", data={"unique_id": uid, "password": PASSWORD})
+        local = []
+        for _ in range(per_worker):
+            t0 = time.perf_counter()
+            resp = make_request(client, endpoint, rng, users, merchants, face_probe)
+            local.append(time.perf_counter() - t0)
+            if not 200 <= resp.status_code < 400:  # a 429 or 400 is not a fast success
+                with lock:
+                    errors[0] += 1
+        with lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - t0
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors[0],
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "throughput_rps": len(latencies) / wall if wall else 0.0,
+        "rss_growth_mb": peak_rss_mb() - rss_before,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def face_probe_image():
+    # A small JPEG data URL; the route runs the real model on it
+    import base64
+    from io import BytesIO
+    from PIL import Image
+    buf = BytesIO()
+    Image.new("RGB", (320, 240), (180, 140, 120)).save(buf, format="JPEG")
+    return "data:image/jpeg;base64," + base64.b64encode(buf.getvalue()).decode()
+
+
+def have_face_model():
+    try:
+        import facenet_pytorch  # noqa: F401
+        import torch  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+# -----------------------------
+# Reporting
+# -----------------------------
+def print_report(meta, results):
+    print(f"\nUniPay endpoint benchmark  users={meta['users']} transactions={meta['transactions']} "
+          f"faces={meta['face_fraction']:.0%} backend={meta['backend']} concurrency={meta['concurrency']}")
+    print(f"data generation {meta['generate_s']:.1f}s, app import {meta['import_s']:.2f}s, "
+          f"RSS after import {meta['import_rss_mb']:.0f} MB")
+    # err: responses outside 2xx/3xx; their latencies are included.
+    # +MB: how far this endpoint raised the process's peak RSS; peak MB: that
+    # peak so far, for the whole process, not this endpoint alone.
+    header = (f"{'endpoint':<22}{'reqs':>7}{'err':>5}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>10}"
+              f"{'+MB':>8}{'peak MB':>10}")
+    print(header)
+    print("-" * len(header))
+    for name, r in results.items():
+        if r is None:
+            print(f"{name:<22}  skipped (face model not installed)")
+            continue
+        print(f"{name:<22}{r['requests']:>7}{r['errors']:>5}{r['p50_ms']:>10.2f}{r['p95_ms']:>10.2f}"
+              f"{r['p99_ms']:>10.2f}{r['throughput_rps']:>10.1f}{r['rss_growth_mb']:>8.0f}{r['peak_rss_mb']:>10.0f}")
+
+
+def compare(results, baseline_path, tolerance):
+    with open(baseline_path) as f:
+        baseline = json.load(f)["results"]
+    regressions = []
+    for name, r in results.items():
+        base = baseline.get(name)
+        if r is None or base is None:
+            continue
+        for key in ("p95_ms", "p99_ms"):
+            if base[key] > 0 and r[key] > base[key] * (1 + tolerance):
+                regressions.append(f"{name} {key}: {base[key]:.2f} -> {r[key]:.2f}")
+    for line in regressions:
+        print("REGRESSION", line)
+    return not regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark UniPay payment endpoints")
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--transactions", type=int, default=20000)
+    parser.add_argument("--faces", type=float, default=0.0, help="fraction of users with a face enrolled")
+    parser.add_argument("--requests", type=int, default=400, help="requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--backend", choices=("json", "sqlite"), default="json")
+    parser.add_argument("--endpoints", default=",".join(ENDPOINTS))
+    parser.add_argument("--data-dir", help="reuse/keep this data directory instead of a temp one")
+    parser.add_argument("--json", help="write results as JSON to this path")
+    parser.add_argument("--compare", help="baseline JSON; exit 1 if p95/p99 regress")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="unipay-bench-")
+    os.makedirs(data_dir, exist_ok=True)
+    try:
+        t0 = time.perf_counter()
+        users, merchants = generate(data_dir, args.users, args.transactions, args.faces)
+        generate_s = time.perf_counter() - t0
+
+        os.environ["UNIPAY_DATA_DIR"] = data_dir
+        os.environ["UNIPAY_STORAGE"] = args.backend
+        if args.backend == "sqlite":
+            from storage import migrate_json_to_sqlite
+            migrate_json_to_sqlite(data_dir)
+        t0 = time.perf_counter()
+        import app as app_module
+        import_s = time.perf_counter() - t0
+        # Every client is 127.0.0.1 and keeps hitting the same account, so the
+        # face and PIN limits would turn most requests into 429s. The buckets
+        # are still consulted on every request, they just never run dry.
+        for rule in app_module.RATE_LIMITS:
+            app_module.limiter.rules[rule] = (10 ** 9, 1)
+        meta = {
+            "users": args.users, "transactions": args.transactions, "face_fraction": args.faces,
+            "backend": args.backend, "concurrency": args.concurrency,
+            "generate_s": generate_s, "import_s": import_s, "import_rss_mb": peak_rss_mb(),
+        }
+
+        face_probe = face_probe_image()
+        results = {}
+        for endpoint in [e for e in args.endpoints.split(",") if e]:
+            if endpoint == "verify_face_payment" and not have_face_model():
+                results[endpoint] = None
+                continue
+            results[endpoint] = run_endpoint(app_module, endpoint, users, merchants,
+                                             args.requests, args.concurrency, face_probe)
+
+        print_report(meta, results)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump({"meta": meta, "results": results}, f, indent=4)
+        if args.compare and not compare(results, args.compare, args.tolerance):
+            sys.exit(1)
+    finally:
+        if not args.data_dir:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
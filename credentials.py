@@ -0,0 +1,122 @@
+# credentials.py
+# Salted password / PIN hashes and a bounded verification pool.
+#
+# Stored form is "<scheme>$<cost>$<salt>$<hash>" (base64 salt and hash), with
+# pbkdf2_sha256 (cost = iterations) or scrypt (cost = log2 N). Records still
+# holding a plaintext secret verify by constant-time comparison and come
+# back with a fresh hash for the caller to store, as do hashes made with an
+# older scheme or cost. Verification runs on a small thread pool (hashlib
+# releases the GIL while hashing), so a burst of logins is queued there
+# instead of pinning every request thread, and a successful check is cached
+# for a short while so repeated PIN entries don't pay the full cost again.
+import base64
+import hashlib
+import hmac
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from sessions import LRUCache
+
+SCHEME = os.environ.get("UNIPAY_HASH_SCHEME", "pbkdf2_sha256")
+DEFAULT_COSTS = {
+    "pbkdf2_sha256": {"password": 200000, "pin": 50000},
+    "scrypt": {"password": 14, "pin": 12},
+}
+COSTS = {
+    "password": int(os.environ.get("UNIPAY_PASSWORD_COST", DEFAULT_COSTS[SCHEME]["password"])),
+    "pin": int(os.environ.get("UNIPAY_PIN_COST", DEFAULT_COSTS[SCHEME]["pin"])),
+}
+
+
+class VerifierBusy(Exception):
+    pass
+
+
+def _b64(data):
+    return base64.b64encode(data).decode()
+
+
+def _derive(scheme, cost, secret, salt):
+    if scheme == "pbkdf2_sha256":
+        return hashlib.pbkdf2_hmac("sha256", secret.encode(), salt, cost)
+    if scheme == "scrypt":
+        return hashlib.scrypt(secret.encode(), salt=salt, n=2 ** cost, r=8, p=1, maxmem=2 ** (cost + 11))
+    raise ValueError(f"Unknown hash scheme: {scheme}")
+
+
+def make_hash(secret, kind="password"):
+    salt = os.urandom(16)
+    return f"{SCHEME}${COSTS[kind]}${_b64(salt)}${_b64(_derive(SCHEME, COSTS[kind], str(secret), salt))}"
+
+
+def hash_many(secrets, kind="password"):
+    # Bulk imports hash on every core. Running them with a low
+    # UNIPAY_PASSWORD_COST is fine: check() upgrades the hash at first login.
+    with ThreadPoolExecutor(min(8, os.cpu_count() or 1)) as pool:
+        return list(pool.map(lambda s: make_hash(s, kind), secrets))
+
+
+def is_hashed(stored):
+    return isinstance(stored, str) and stored.split("$", 1)[0] in DEFAULT_COSTS and stored.count("$") == 3
+
+
+def check(stored, secret, kind="password"):
+    # (ok, new_hash): new_hash is set when the stored value should be upgraded
+    if not stored or not secret:
+        return False, None
+    if not is_hashed(stored):
+        ok = hmac.compare_digest(str(stored).encode(), str(secret).encode())
+        return ok, (make_hash(secret, kind) if ok else None)
+    scheme, cost, salt, digest = stored.split("$")
+    ok = hmac.compare_digest(_derive(scheme, int(cost), str(secret), base64.b64decode(salt)),
+                             base64.b64decode(digest))
+    stale = ok and (scheme != SCHEME or int(cost) != COSTS[kind])
+    return ok, (make_hash(secret, kind) if stale else None)
+
+
+class CredentialVerifier:
+    def __init__(self, workers=None, max_pending=256, cache_ttl=60, wait=10.0):
+        self.workers = workers or min(8, os.cpu_count() or 1)
+        self.wait = wait
+        self._pool = None
+        self._pid = None
+        self._pool_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._cache = LRUCache(maxsize=10000, ttl=cache_ttl)
+        self._cache_key = os.urandom(32)  # cache keys are useless outside this process
+
+    def _executor(self):
+        with self._pool_lock:
+            if self._pool is None or self._pid != os.getpid():
+                self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix="credentials")
+                self._pid = os.getpid()
+            return self._pool
+
+    def _key(self, stored, secret):
+        return hmac.new(self._cache_key, f"{stored}\0{secret}".encode(), hashlib.sha256).digest()
+
+    def verify_async(self, stored, secret, kind="password"):
+        # Future resolving to (ok, new_hash); raises VerifierBusy when the
+        # queue is full for longer than `wait` seconds.
+        key = self._key(stored, secret)
+        if self._cache.get(key):
+            future = Future()
+            future.set_result((True, None))
+            return future
+        if not self._slots.acquire(timeout=self.wait):
+            raise VerifierBusy("Too many sign-ins in progress, try again shortly")
+
+        def run():
+            try:
+                ok, new_hash = check(stored, secret, kind)
+                if ok and new_hash is None:
+                    self._cache.set(key, True)
+                return ok, new_hash
+            finally:
+                self._slots.release()
+        return self._executor().submit(run)
+
+    def verify(self, stored, secret, kind="password"):
+        return self.verify_async(stored, secret, kind).result()
+
@@ -0,0 +1,282 @@
+# dataio.py
+# Streaming import / export of accounts and the ledger.
+#
+# Records are read and written one at a time (CSV, NDJSON, or a JSON array
+# parsed incrementally), and imports are upserted in chunks with one store
+# write per chunk, so neither side ever holds a whole cohort, or the face
+# payloads of one, in memory.
+import base64
+import csv
+import json
+import sys
+from contextlib import contextmanager
+
+from credentials import hash_many, is_hashed
+from faces import FACE_FIELDS
+from onboarding import new_account
+
+DEFAULT_FIELDS = {"bank_linked": False, "pin": "", "balance": 0.0}
+
+USER_CSV_FIELDS = ("unique_id", "name", "email", "phone", "password", "user_type", "balance",
+                   "bank_linked", "pin", "bank_name", "ifsc", "account_number", "account_holder", "branch")
+LEDGER_CSV_FIELDS = ("id", "date", "kind", "from", "from_name", "to", "to_name", "amount", "reward", "note")
+
+# Export-only inline form of the binary face vector
+VECTOR_FIELDS = ("face_vector", "face_vector_ref")
+
+
+def guess_format(path, fmt=None):
+    if fmt:
+        return fmt
+    if path.endswith(".csv"):
+        return "csv"
+    if path.endswith(".json"):
+        return "json"
+    return "ndjson"
+
+
+# -----------------------------
+# Reading
+# -----------------------------
+def iter_json_array(f, chunk_size=1 << 16):
+    # Yields the elements of a top-level JSON array without loading it whole
+    decoder = json.JSONDecoder()
+    buf = ""
+    started = False
+    while True:
+        data = f.read(chunk_size)
+        buf += data
+        pos = 0
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n,":
+                pos += 1
+            if not started:
+                if pos < len(buf):
+                    if buf[pos] != "[":
+                        raise ValueError("expected a JSON array")
+                    started = True
+                    pos += 1
+                    continue
+                break
+            if pos < len(buf) and buf[pos] == "]":
+                return
+            try:
+                obj, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                break  # element continues in the next chunk
+            if end == len(buf) and data:
+                break  # a bare number could still be cut short
+            yield obj
+            pos = end
+        buf = buf[pos:]
+        if not data:
+            if buf.strip():
+                raise ValueError("truncated JSON array")
+            return
+
+
+def read_records(f, fmt):
+    if fmt == "csv":
+        for row in csv.DictReader(f):
+            yield {k: v for k, v in row.items() if k and v not in (None, "")}
+    elif fmt == "json":
+        yield from iter_json_array(f)
+    else:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+@contextmanager
+def open_path(path, mode):
+    # "-" means stdin / stdout
+    if path == "-":
+        yield sys.stdout if "w" in mode else sys.stdin
+    else:
+        with open(path, mode, newline="" if path.endswith(".csv") else None) as f:
+            yield f
+
+
+# -----------------------------
+# Importing users
+# -----------------------------
+def _coerce(record):
+    # CSV gives strings; bring known fields back to their stored types
+    if "balance" in record:
+        record["balance"] = round(float(record["balance"]), 2)
+    if isinstance(record.get("bank_linked"), str):
+        record["bank_linked"] = record["bank_linked"].strip().lower() in ("1", "true", "yes")
+    for field in ("unique_id", "email", "phone", "pin", "password"):
+        if field in record and record[field] is not None:
+            record[field] = str(record[field]).strip()
+    return record
+
+
+def _store_faces(record, faces):
+    # Inline face payloads go to the blob store, like migrate_inline_faces
+    for field, ref_field in FACE_FIELDS.items():
+        payload = record.pop(field, None)
+        if isinstance(payload, str) and payload and faces is not None:
+            record[ref_field] = faces.put(payload)
+    vector = record.pop(VECTOR_FIELDS[0], None)
+    if vector and faces is not None:
+        record[VECTOR_FIELDS[1]] = faces.put(base64.b64decode(vector))
+    return record
+
+
+def with_defaults(record):
+    for k, v in DEFAULT_FIELDS.items():
+        record.setdefault(k, v)
+    return record
+
+
+def import_users(accounts, allocator, records, faces=None, chunk=1000):
+    # Upserts: records whose unique_id exists are merged into it, everything
+    # else is created (with a freshly allocated id if it has none). An
+    # existing account's balance is left alone: balances only move through
+    # the payment engine, under its locks and with a ledger record. Returns
+    # {"inserted": n, "updated": n, "balances_ignored": n,
+    #  "skipped": [(line, reason)]}.
+    stats = {"inserted": 0, "updated": 0, "balances_ignored": 0, "skipped": []}
+    batch = []
+
+    def flush():
+        updates, inserts, balances = {}, [], {}
+        for line, record in batch:
+            uid = record.get("unique_id")
+            if uid and uid in accounts:
+                if "balance" in record:
+                    balances[uid] = record.pop("balance")
+                updates.setdefault(uid, {}).update(record)
+            elif not all(record.get(k) for k in ("name", "email", "phone", "password")):
+                stats["skipped"].append((line, "new accounts need name, email, phone and password"))
+            else:
+                inserts.append((line, record))
+        # Changed emails / phones must not collide with another account
+        current = {uid: accounts.get(uid) or {} for uid in updates}
+        stats["balances_ignored"] += sum(1 for uid, b in balances.items()
+                                         if uid in current and b != current[uid].get("balance"))
+        for uid, fields in list(updates.items()):
+            for field in ("email", "phone"):
+                if not fields.get(field) or fields[field] == current[uid].get(field):
+                    continue
+                owner = accounts.find_by(field, fields[field])
+                if owner and owner["unique_id"] != uid:
+                    stats["skipped"].append((uid, f"{field} {fields[field]} already exists"))
+                    del updates[uid]
+                    break
+        if updates:
+            updated = accounts.update_many({
+                uid: {**{k: v for k, v in DEFAULT_FIELDS.items() if k not in current[uid]}, **fields}
+                for uid, fields in updates.items()})
+            stats["updated"] += len(updated)
+        if inserts:
+            missing = [r for _, r in inserts if not r.get("unique_id")]
+            by_kind = {}
+            for r in missing:
+                by_kind.setdefault("merchant" if r.get("user_type") == "merchant" else "user", []).append(r)
+            for kind, rows in by_kind.items():
+                for uid, r in zip(allocator.allocate_many(len(rows), kind), rows):
+                    r["unique_id"] = uid
+            records = []
+            for _, r in inserts:
+                # hash_secrets() already hashed plaintext; exported hashes pass through
+                base = new_account(r["unique_id"], r["name"], r["email"], r["phone"], r["password"],
+                                   "merchant" if r.get("user_type") == "merchant" else "user", hashed=True)
+                records.append(with_defaults({**base, **r}))
+            added, dupes = accounts.add_many(records, unique=("email", "phone"), skip_duplicates=True)
+            stats["inserted"] += len(added)
+            stats["skipped"].extend((r.get("email"), str(e.args[0])) for r, e in dupes)
+        batch.clear()
+
+    def hash_secrets():
+        # Plaintext passwords / PINs in the input are stored hashed
+        for field, kind in (("password", "password"), ("pin", "pin")):
+            todo = [r for _, r in batch if r.get(field) and not is_hashed(r[field])]
+            for r, hashed in zip(todo, hash_many([r[field] for r in todo], kind)):
+                r[field] = hashed
+
+    for line, record in enumerate(records, 1):
+        try:
+            record = _store_faces(_coerce(dict(record)), faces)
+        except (TypeError, ValueError) as e:
+            stats["skipped"].append((line, f"invalid record: {e}"))
+            continue
+        batch.append((line, record))
+        if len(batch) >= chunk:
+            hash_secrets()
+            flush()
+    if batch:
+        hash_secrets()
+        flush()
+    return stats
+
+
+def backfill_defaults(accounts, chunk=1000):
+    # Adds any missing default fields, streaming the store and writing chunks
+    changes, total = {}, 0
+    for u in accounts.iter_all():
+        missing = {k: v for k, v in DEFAULT_FIELDS.items() if k not in u}
+        if missing:
+            changes[u["unique_id"]] = missing
+        if len(changes) >= chunk:
+            total += len(accounts.update_many(changes))
+            changes = {}
+    if changes:
+        total += len(accounts.update_many(changes))
+    return total
+
+
+# -----------------------------
+# Exporting
+# -----------------------------
+class RecordWriter:
+    # Writes records one by one as CSV, NDJSON or a JSON array
+    def __init__(self, f, fmt, csv_fields=None):
+        self.f = f
+        self.fmt = fmt
+        self.count = 0
+        if fmt == "csv":
+            self._csv = csv.DictWriter(f, fieldnames=csv_fields, extrasaction="ignore")
+            self._csv.writeheader()
+        elif fmt == "json":
+            f.write("[\n")
+
+    def write(self, record):
+        if self.fmt == "csv":
+            self._csv.writerow(record)
+        elif self.fmt == "json":
+            self.f.write(("" if self.count == 0 else ",\n") + json.dumps(record, separators=(",", ":")))
+        else:
+            self.f.write(json.dumps(record, separators=(",", ":")) + "\n")
+        self.count += 1
+
+    def close(self):
+        if self.fmt == "json":
+            self.f.write("\n]\n")
+
+
+def export_users(accounts, f, fmt, faces=None):
+    # With a face store, face payloads are inlined so the export is portable
+    fields = USER_CSV_FIELDS + ((tuple(FACE_FIELDS) + VECTOR_FIELDS[:1]) if faces is not None else ())
+    out = RecordWriter(f, fmt, fields)
+    for u in accounts.iter_all():
+        if faces is not None:
+            for field, ref_field in FACE_FIELDS.items():
+                if u.get(ref_field):
+                    u[field] = faces.get_text(u.pop(ref_field))
+            if u.get(VECTOR_FIELDS[1]):
+                data = faces.get(u.pop(VECTOR_FIELDS[1]))
+                if data is not None:
+                    u[VECTOR_FIELDS[0]] = base64.b64encode(data).decode()
+        out.write(u)
+    out.close()
+    return out.count
+
+
+def export_ledger(ledger, f, fmt, uid=None):
+    out = RecordWriter(f, fmt, LEDGER_CSV_FIELDS)
+    for t in (ledger.for_user(uid) if uid else ledger.iter_all()):
+        out.write(t)
+    out.close()
+    return out.count
@@ -0,0 +1,157 @@
+# face_index.py
+# Nearest-neighbour index over enrolled face embeddings.
+#
+# Vectors are L2-normalised float32 rows of one contiguous matrix, so cosine
+# similarity against every enrolled user is a single matrix-vector product.
+# Above `partition_threshold` rows the index also keeps a coarse partitioning
+# (spherical k-means) and only scores the `nprobe` closest partitions plus any
+# rows added since the partitions were built.
+import threading
+
+import numpy as np
+
+EMBEDDING_DIM = 512
+
+
+def normalize(vector):
+    v = np.asarray(vector, dtype=np.float32).reshape(-1)
+    norm = np.linalg.norm(v)
+    return v / norm if norm > 0 else v
+
+
+class FaceIndex:
+    def __init__(self, dim=EMBEDDING_DIM, partition_threshold=20000, nprobe=8,
+                 rebuild_fraction=0.1):
+        self.dim = dim
+        self.partition_threshold = partition_threshold
+        self.nprobe = nprobe
+        self.rebuild_fraction = rebuild_fraction
+        self._lock = threading.RLock()
+        self._matrix = np.zeros((64, dim), dtype=np.float32)
+        self._rows = 0           # rows in use, including tombstones
+        self._ids = []           # row -> unique_id (None for removed rows)
+        self._pos = {}           # unique_id -> row
+        self._refs = {}          # unique_id -> blob digest the row came from
+        self._tombstones = 0
+        self._centroids = None
+        self._lists = None
+        self._built_rows = 0
+        self._pending = set()    # rows overwritten since the partitions were built
+
+    def __len__(self):
+        return len(self._pos)
+
+    # -----------------------------
+    # Mutation
+    # -----------------------------
+    def add(self, uid, vector, ref=None):
+        v = normalize(vector)
+        with self._lock:
+            row = self._pos.get(uid)
+            if row is None:
+                if self._rows == len(self._matrix):
+                    grown = np.zeros((len(self._matrix) * 2, self.dim), dtype=np.float32)
+                    grown[:self._rows] = self._matrix[:self._rows]
+                    self._matrix = grown
+                row = self._rows
+                self._rows += 1
+                self._ids.append(uid)
+                self._pos[uid] = row
+            elif row < self._built_rows:
+                self._pending.add(row)
+            self._matrix[row] = v
+            self._refs[uid] = ref
+
+    def remove(self, uid):
+        with self._lock:
+            row = self._pos.pop(uid, None)
+            self._refs.pop(uid, None)
+            if row is None:
+                return
+            self._matrix[row] = 0.0
+            self._ids[row] = None
+            self._pending.discard(row)
+            self._tombstones += 1
+            if self._tombstones > max(64, self._rows // 2):
+                self._compact()
+
+    def ref_of(self, uid):
+        return self._refs.get(uid)
+
+    def _compact(self):
+        keep = [row for row, uid in enumerate(self._ids) if uid is not None]
+        ids = [self._ids[row] for row in keep]
+        matrix = np.zeros((max(64, len(keep) * 2), self.dim), dtype=np.float32)
+        matrix[:len(keep)] = self._matrix[keep]
+        self._matrix = matrix
+        self._ids = ids
+        self._rows = len(ids)
+        self._pos = {uid: row for row, uid in enumerate(ids)}
+        self._tombstones = 0
+        self._centroids = self._lists = None
+        self._built_rows = 0
+        self._pending = set()
+
+    # -----------------------------
+    # Coarse partitioning (approximate search for large populations)
+    # -----------------------------
+    def _needs_partitions(self):
+        if len(self._pos) < self.partition_threshold:
+            return False
+        if self._centroids is None:
+            return True
+        stale = (self._rows - self._built_rows) + len(self._pending)
+        return stale > self.rebuild_fraction * len(self._pos)
+
+    def _build_partitions(self, iterations=8, seed=0):
+        data = self._matrix[:self._rows]
+        k = max(1, int(np.sqrt(len(self._pos))))
+        rng = np.random.default_rng(seed)
+        live = np.array([row for row, uid in enumerate(self._ids) if uid is not None])
+        centroids = data[rng.choice(live, size=k, replace=False)].copy()
+        for _ in range(iterations):
+            assign = np.argmax(data[live] @ centroids.T, axis=1)
+            for c in range(k):
+                members = data[live[assign == c]]
+                if len(members):
+                    centroids[c] = normalize(members.sum(axis=0))
+        assign = np.argmax(data[live] @ centroids.T, axis=1)
+        self._centroids = centroids
+        self._lists = [live[assign == c] for c in range(k)]
+        self._built_rows = self._rows
+        self._pending = set()
+
+    def _candidates(self, v):
+        probe = min(self.nprobe, len(self._centroids))
+        nearest = np.argpartition(-(self._centroids @ v), probe - 1)[:probe]
+        parts = [self._lists[c] for c in nearest]
+        parts.append(np.arange(self._built_rows, self._rows))
+        if self._pending:
+            parts.append(np.fromiter(self._pending, dtype=np.int64))
+        return np.unique(np.concatenate(parts))
+
+    # -----------------------------
+    # Search
+    # -----------------------------
+    def search(self, vector, threshold=None):
+        # Returns (unique_id, score) of the best match, or (None, best_score)
+        # when nothing clears `threshold`.
+        v = normalize(vector)
+        with self._lock:
+            if not self._pos:
+                return None, 0.0
+            if self._needs_partitions():
+                self._build_partitions()
+            if self._centroids is not None and len(self._pos) >= self.partition_threshold:
+                rows = self._candidates(v)
+                scores = self._matrix[rows] @ v
+                best = int(np.argmax(scores))
+                row, score = int(rows[best]), float(scores[best])
+            else:
+                scores = self._matrix[:self._rows] @ v
+                row = int(np.argmax(scores))
+                score = float(scores[row])
+            uid = self._ids[row]
+        if uid is None or (threshold is not None and score < threshold):
+            return None, score
+        return uid, score
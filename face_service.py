@@ -0,0 +1,282 @@
+# face_service.py
+# Face inference service: lazy model loading and micro-batched forward passes.
+#
+# InceptionResnetV1 is only loaded the first time an embedding is requested,
+# so workers that never serve a face route never pay for it. Concurrent
+# requests are queued and a single worker thread runs them as one batch under
+# torch.no_grad(). Setting UNIPAY_FACE_SERVICE=host:port makes web workers send
+# their tensors to one shared process started with `python face_service.py`
+# instead of each holding its own copy of the model. Requests and replies are
+# raw float32 bytes, never pickles, and the service only listens beyond
+# loopback if UNIPAY_FACE_SERVICE_KEY is set (clients then use the same key).
+import base64
+import ipaddress
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from io import BytesIO
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+
+import metrics
+from face_index import normalize
+
+FACE_INPUT_SIZE = 160
+FACE_SERVICE_ADDR = os.environ.get("UNIPAY_FACE_SERVICE", "")
+FACE_SERVICE_KEY = os.environ.get("UNIPAY_FACE_SERVICE_KEY", "").encode() or None
+INPUT_BYTES = 3 * FACE_INPUT_SIZE * FACE_INPUT_SIZE * 4  # one CHW float32 input
+FACE_TIMEOUT = float(os.environ.get("UNIPAY_FACE_TIMEOUT", 30))  # seconds a request waits for its vector
+
+
+class FaceUnavailable(Exception):
+    # The model failed to load or run, or didn't answer within FACE_TIMEOUT
+    pass
+
+
+# -----------------------------
+# Preprocessing (no torch needed)
+# -----------------------------
+def decode_data_url(face_data):
+    from PIL import Image
+    header, encoded = face_data.split(",", 1)
+    return Image.open(BytesIO(base64.b64decode(encoded))).convert('RGB')
+
+
+def decode_upload(data, max_pixels=40_000_000):
+    # Raw JPEG/PNG bytes straight to a small RGB image. For JPEG, draft()
+    # makes libjpeg decode at 1/2, 1/4 or 1/8 scale, so a full camera frame
+    # is never expanded to full resolution in memory.
+    from PIL import Image
+    img = Image.open(BytesIO(data))
+    if img.width * img.height > max_pixels:
+        raise ValueError("Image too large")
+    img.draft("RGB", (FACE_INPUT_SIZE, FACE_INPUT_SIZE))
+    return img.convert("RGB")
+
+
+def to_input_array(img):
+    # Same as Resize(160) + ToTensor() + Normalize([0.5]*3, [0.5]*3), CHW float32
+    from PIL import Image
+    img = img.resize((FACE_INPUT_SIZE, FACE_INPUT_SIZE), Image.BILINEAR)
+    arr = np.asarray(img, dtype=np.float32) / 255.0
+    return ((arr - 0.5) / 0.5).transpose(2, 0, 1).copy()
+
+
+# -----------------------------
+# In-process batched embedder
+# -----------------------------
+class FaceEmbedder:
+    def __init__(self, max_batch=16, max_wait_ms=5, num_threads=None):
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self.num_threads = num_threads or int(os.environ.get(
+            "UNIPAY_TORCH_THREADS", min(4, os.cpu_count() or 1)))
+        self._model = None
+        self._model_lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._worker = None
+        self._worker_lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self._model is not None
+
+    def _load_model(self):
+        with self._model_lock:
+            if self._model is None:
+                import torch
+                from facenet_pytorch import InceptionResnetV1
+                torch.set_num_threads(self.num_threads)
+                self._model = InceptionResnetV1(pretrained='vggface2').eval()
+        return self._model
+
+    def _ensure_worker(self):
+        if self._worker is None:
+            with self._worker_lock:
+                if self._worker is None:
+                    self._worker = threading.Thread(target=self._run, name="face-batcher", daemon=True)
+                    self._worker.start()
+
+    def _next_batch(self):
+        # First request blocks; then gather whatever arrives within max_wait
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                # Inside the try: if torch or the model can't be loaded, the
+                # batch fails and the next one tries again
+                import torch
+                model = self._load_model()
+                inputs = torch.from_numpy(np.stack([arr for arr, _ in batch]))
+                start = time.perf_counter()
+                with torch.no_grad():
+                    out = model(inputs).numpy()
+                metrics.registry.observe(metrics.OP_METRIC, "face.forward",
+                                         time.perf_counter() - start, route="face_batcher")
+                for (_, fut), vec in zip(batch, out):
+                    fut.set_result(normalize(vec))
+            except Exception as exc:
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(exc)
+
+    def submit(self, arr):
+        fut = Future()
+        self._ensure_worker()
+        self._queue.put((np.asarray(arr, dtype=np.float32), fut))
+        return fut
+
+    def embed(self, arr, timeout=None):
+        return self.submit(arr).result(timeout)
+
+
+# -----------------------------
+# Shared worker process
+# -----------------------------
+def _parse_addr(addr):
+    host, port = addr.rsplit(":", 1)
+    return host, int(port)
+
+
+class RemoteFaceEmbedder:
+    # Same submit/embed interface, but inference happens in the face service
+    # process; one connection per calling thread.
+    def __init__(self, addr, authkey=FACE_SERVICE_KEY):
+        self.address = _parse_addr(addr)
+        self.authkey = authkey
+        self._local = threading.local()
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self.loaded = True
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = Client(self.address, authkey=self.authkey)
+        return conn
+
+    def embed(self, arr, timeout=None):
+        # Reply: b"\0" + float32 vector, or b"\1" + error message
+        conn = self._conn()
+        try:
+            conn.send_bytes(np.asarray(arr, dtype=np.float32).tobytes())
+            if not conn.poll(FACE_TIMEOUT if timeout is None else timeout):
+                raise TimeoutError("Face service did not answer")
+            reply = conn.recv_bytes()
+        except (EOFError, OSError):  # TimeoutError included: the reply would arrive out of turn
+            self._local.conn = None
+            conn.close()
+            raise
+        if reply[:1] != b"\0":
+            raise RuntimeError(reply[1:].decode("utf-8", "replace"))
+        return np.frombuffer(reply[1:], dtype=np.float32).copy()
+
+    def submit(self, arr):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="face-client")
+        return self._pool.submit(self.embed, arr)
+
+
+def _is_loopback(host):
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def serve(addr, embedder=None, authkey=FACE_SERVICE_KEY):
+    host, port = _parse_addr(addr)
+    if authkey is None and not _is_loopback(host):
+        raise SystemExit(f"Set UNIPAY_FACE_SERVICE_KEY to listen on {addr}")
+    embedder = embedder or FaceEmbedder()
+    embedder._load_model()
+
+    def handle(conn):
+        with conn:
+            while True:
+                try:
+                    # Anything but exactly one input closes the connection
+                    data = conn.recv_bytes(INPUT_BYTES)
+                    if len(data) != INPUT_BYTES:
+                        return
+                except (EOFError, OSError):
+                    return
+                arr = np.frombuffer(data, dtype=np.float32).reshape(3, FACE_INPUT_SIZE, FACE_INPUT_SIZE)
+                try:
+                    reply = b"\0" + np.asarray(embedder.embed(arr), dtype=np.float32).tobytes()
+                except Exception as exc:
+                    reply = b"\1" + str(exc).encode()
+                conn.send_bytes(reply)
+
+    with Listener((host, port), authkey=authkey) as listener:
+        print(f"UniPay face service listening on {addr}")
+        while True:
+            try:
+                conn = listener.accept()
+            except (AuthenticationError, OSError):
+                continue  # wrong key or a client that hung up mid-handshake
+            threading.Thread(target=handle, args=(conn,), daemon=True).start()
+
+
+_embedder = None
+_embedder_lock = threading.Lock()
+
+
+def get_embedder():
+    global _embedder
+    if _embedder is None:
+        with _embedder_lock:
+            if _embedder is None:
+                _embedder = RemoteFaceEmbedder(FACE_SERVICE_ADDR) if FACE_SERVICE_ADDR else FaceEmbedder()
+    return _embedder
+
+
+def wait(fut, timeout=FACE_TIMEOUT):
+    # Vector from a submit() future, or FaceUnavailable
+    try:
+        return fut.result(timeout)
+    except Exception as exc:
+        raise FaceUnavailable("Face recognition is unavailable right now, try again shortly") from exc
+
+
+def embed_image(img):
+    return wait(get_embedder().submit(to_input_array(img)))
+
+
+def embed_data_url(face_data):
+    return embed_image(decode_data_url(face_data))
+
+
+def submit_data_url(face_data):
+    # Decodes now (bad images raise here) and returns a Future for the
+    # vector, so the caller can do other work while the model runs
+    return get_embedder().submit(to_input_array(decode_data_url(face_data)))
+
+
+def submit_upload(data):
+    # Same for a binary upload; only the 160x160 input array outlives this call
+    return get_embedder().submit(to_input_array(decode_upload(data)))
+
+
+if __name__ == "__main__":
+    serve(FACE_SERVICE_ADDR or "127.0.0.1:5055")
@@ -0,0 +1,77 @@
+# faces.py
+# Content-addressed blob store for face payloads.
+#
+# Face images are hundreds of KB of base64 each, so they live in their own
+# files under faces/ named by the SHA-256 of the payload. The user record only
+# keeps the digest (e.g. "face_embedding_ref"), which keeps users.json small
+# and means identical uploads are stored once.
+import hashlib
+import os
+
+# Inline payload field -> pointer field stored in the user record
+FACE_FIELDS = {
+    "face_embedding": "face_embedding_ref",
+    "face_id": "face_id_ref",
+}
+
+
+def digest_of(data):
+    if isinstance(data, str):
+        data = data.encode()
+    return hashlib.sha256(data).hexdigest()
+
+
+class FaceStore:
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, digest):
+        return os.path.join(self.root, digest[:2], digest + ".bin")
+
+    def put(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        digest = digest_of(data)
+        path = self._path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        return digest
+
+    def get(self, digest):
+        if not digest:
+            return None
+        try:
+            with open(self._path(digest), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def get_text(self, digest):
+        data = self.get(digest)
+        return data.decode() if data is not None else None
+
+    def __contains__(self, digest):
+        return bool(digest) and os.path.exists(self._path(digest))
+
+
+def migrate_inline_faces(accounts, store):
+    # Move any base64 payloads still embedded in user records into the blob
+    # store, then compact so the snapshot file actually shrinks.
+    changes = {}
+    for u in accounts.all():
+        moved = {}
+        for field, ref_field in FACE_FIELDS.items():
+            payload = u.get(field)
+            if isinstance(payload, str) and payload:
+                moved[ref_field] = store.put(payload)
+        if moved:
+            changes[u["unique_id"]] = moved
+    if changes:
+        accounts.update_many(changes, remove=tuple(FACE_FIELDS))
+        accounts.compact()
+    return len(changes)
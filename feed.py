@@ -0,0 +1,113 @@
+# feed.py
+# Live feed of incoming payments for merchants, served as Server-Sent Events.
+#
+# FeedHub subscribes to the ledger, so every payment committed by this
+# worker (or by another one, once a ledger refresh picks it up) is pushed to
+# the payee's open streams. Each merchant keeps a small ring buffer of recent
+# events; a client that reconnects with Last-Event-ID is sent what it missed
+# from the buffer instead of reloading its whole history. Event ids are
+# transaction ids, so a client can resume on any worker.
+import json
+import queue
+import threading
+import time
+from collections import deque
+
+FEED_FIELDS = ("id", "date", "from", "from_name", "amount", "note")
+
+
+class FeedFull(Exception):
+    pass
+
+
+class FeedHub:
+    def __init__(self, ledger, buffer_size=100, max_subscribers=200, queue_size=100, poll_every=1.0):
+        self.ledger = ledger
+        self.buffer_size = buffer_size
+        self.max_subscribers = max_subscribers
+        self.queue_size = queue_size
+        self.poll_every = poll_every  # how often idle streams look for other workers' payments
+        self._lock = threading.Lock()
+        self._buffers = {}  # uid -> deque of (event_id, data)
+        self._subscribers = {}  # uid -> set of queues
+        self._count = 0
+        self._polled = 0.0
+        ledger.subscribe(self.publish)
+
+    def publish(self, record):
+        # Ledger listener: runs under the ledger lock, so only queue work here
+        uid = record.get("to")
+        if uid is None or record.get("kind"):
+            return
+        event = (str(record.get("id")), json.dumps({k: record.get(k) for k in FEED_FIELDS}))
+        with self._lock:
+            buf = self._buffers.get(uid)
+            if buf is None:
+                buf = self._buffers[uid] = deque(maxlen=self.buffer_size)
+            buf.append(event)
+            for q in self._subscribers.get(uid, ()):
+                try:
+                    q.put_nowait(event)
+                except queue.Full:
+                    q.overflowed = True  # slow client: cut it off, it resumes from the buffer
+
+    def poll(self):
+        # Picks up payments written by other workers, at most once per poll_every
+        now = time.monotonic()
+        with self._lock:
+            if now - self._polled < self.poll_every:
+                return
+            self._polled = now
+        self.ledger.refresh()
+
+    def subscribe(self, uid, last_id=None):
+        # Returns (queue, missed events). missed is None when last_id has
+        # already left the buffer and the client should reload instead.
+        with self._lock:
+            if self._count >= self.max_subscribers:
+                raise FeedFull("Too many live feeds open, try again shortly")
+            q = queue.Queue(self.queue_size)
+            q.overflowed = False
+            self._subscribers.setdefault(uid, set()).add(q)
+            self._count += 1
+            missed = []
+            if last_id:
+                buf = list(self._buffers.get(uid, ()))
+                ids = [event_id for event_id, _ in buf]
+                missed = buf[ids.index(last_id) + 1:] if last_id in ids else None
+        return q, missed
+
+    def unsubscribe(self, uid, q):
+        with self._lock:
+            subs = self._subscribers.get(uid)
+            if subs and q in subs:
+                subs.discard(q)
+                self._count -= 1
+                if not subs:
+                    del self._subscribers[uid]
+
+    def stream(self, uid, last_id=None, heartbeat=15.0):
+        # Generator of SSE frames for one client. It wakes at least every
+        # poll_every seconds, so a server that checks for disconnects between
+        # chunks (see asgi.py) notices a closed tab within a heartbeat.
+        q, missed = self.subscribe(uid, last_id)
+        try:
+            yield "retry: 3000\n\n"
+            if missed is None:
+                yield "event: reset\ndata: {}\n\n"
+            for event_id, data in missed or ():
+                yield f"id: {event_id}\nevent: payment\ndata: {data}\n\n"
+            quiet_since = time.monotonic()
+            while not q.overflowed:
+                try:
+                    event_id, data = q.get(timeout=self.poll_every)
+                except queue.Empty:
+                    self.poll()
+                    if time.monotonic() - quiet_since >= heartbeat:
+                        quiet_since = time.monotonic()
+                        yield ": ping\n\n"
+                    continue
+                quiet_since = time.monotonic()
+                yield f"id: {event_id}\nevent: payment\ndata: {data}\n\n"
+        finally:
+            self.unsubscribe(uid, q)
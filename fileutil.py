@@ -0,0 +1,159 @@
+# fileutil.py
+# File helpers shared by the on-disk stores.
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to in-process locking only
+    fcntl = None
+
+
+def file_sig(path):
+    # Cheap change detector: (inode, size, mtime), or None if missing
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+_thread_locks = {}
+_thread_locks_guard = threading.Lock()
+_held = threading.local()
+
+
+def _thread_lock(path):
+    with _thread_locks_guard:
+        return _thread_locks.setdefault(path, threading.RLock())
+
+
+@contextmanager
+def locked(path):
+    # Exclusive lock shared by threads and worker processes (flock on a side
+    # file). Re-entrant within a thread: only the outermost call takes flock.
+    with _thread_lock(path):
+        depth = getattr(_held, "depth", None)
+        if depth is None:
+            depth = _held.depth = {}
+        if fcntl is None or depth.get(path):
+            depth[path] = depth.get(path, 0) + 1
+            try:
+                yield
+            finally:
+                depth[path] -= 1
+            return
+        with open(path, "a") as lf:
+            fcntl.flock(lf, fcntl.LOCK_EX)
+            depth[path] = 1
+            try:
+                yield
+            finally:
+                depth[path] = 0
+                fcntl.flock(lf, fcntl.LOCK_UN)
+
+
+def atomic_write(path, data):
+    # Replace `path` with `data` (bytes or str) so a crash leaves either the
+    # old or the new file, never a torn one: write a temp file, fsync it,
+    # rename over the target and fsync the directory entry.
+    tmp = path + ".tmp"
+    with open(tmp, "wb" if isinstance(data, bytes) else "w") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    fsync_dir(os.path.dirname(os.path.abspath(path)))
+
+
+def fsync_file(path):
+    # Flushes whatever any process has written to `path` so far to disk
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def fsync_dir(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return  # e.g. Windows, where directories can't be opened
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class GroupCommitter:
+    # Durable appends with group commit. Callers queue lines and a background
+    # thread writes everything queued so far with one write() and one fsync()
+    # every `window` seconds, so N concurrent appends cost one disk flush
+    # instead of N. append() returns once its line is on disk. before_sync,
+    # if given, runs ahead of each group's write, so whatever callers wrote
+    # elsewhere before queueing their line is on disk first.
+    def __init__(self, path, lock_path, window=0.002, before_sync=None):
+        self.path = path
+        self.lock_path = lock_path
+        self.window = window
+        self.before_sync = before_sync
+        self._cond = threading.Condition()
+        self._pending = []
+        self._queued = 0    # sequence number of the last queued line
+        self._durable = 0   # sequence number of the last line written out
+        self._failed = []   # [(first_seq, last_seq, error)] of groups that failed
+        self._thread = None
+        self._pid = None
+
+    def _ensure_thread(self):
+        # Started lazily (and again after fork) so pre-forking servers work
+        if self._thread is None or self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="group-commit", daemon=True)
+            self._thread.start()
+
+    def append(self, line):
+        with self._cond:
+            self._ensure_thread()
+            self._pending.append(line)
+            self._queued += 1
+            seq = self._queued
+            self._cond.notify_all()
+            while self._durable < seq:
+                self._cond.wait()
+            for first, last, error in self._failed:
+                if first <= seq <= last:
+                    raise error
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+            time.sleep(self.window)  # let concurrent appenders join this group
+            with self._cond:
+                batch, self._pending = self._pending, []
+                first, seq = self._durable + 1, self._queued
+            try:
+                if self.before_sync is not None:
+                    self.before_sync()
+                with locked(self.lock_path):
+                    with open(self.path, "a") as f:
+                        f.write("".join(batch))
+                        f.flush()
+                        os.fsync(f.fileno())
+            except OSError as e:
+                # Everyone waiting on this group gets the error
+                with self._cond:
+                    self._failed = self._failed[-15:] + [(first, seq, e)]
+            with self._cond:
+                self._durable = seq
+                self._cond.notify_all()
@@ -0,0 +1,507 @@
+# ledger.py
+# Append-only transaction ledger with per-user offset indexes.
+#
+# Transactions are newline-delimited JSON records appended to one log file,
+# so a payment writes one line instead of re-serialising every transaction
+# ever made. An in-memory index maps each unique_id to the byte offsets of the
+# records it appears in (as sender or receiver). The index is saved to an
+# append-only file: every `snapshot_every` records, one small chunk covering
+# just those records is appended, so a restart only scans the tail of the log
+# and no payment ever rewrites the whole index. Closed months can be sealed into compressed segments
+# (see archive.py); reads transparently cover both.
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+from archive import LedgerArchive
+from fileutil import atomic_write, file_sig, fsync_dir, fsync_file, locked
+
+
+def matches_counterparty(record, uid, counterparty):
+    # counterparty may be the other side's unique_id or (case-insensitive) name
+    if str(record.get("from")) == str(uid):
+        other = (record.get("to"), record.get("to_name"))
+    else:
+        other = (record.get("from"), record.get("from_name"))
+    return str(counterparty) == str(other[0]) or str(counterparty).lower() == str(other[1]).lower()
+
+
+class Ledger:
+    def __init__(self, path, legacy_path=None, snapshot_every=1000, durable=False):
+        self.path = path
+        self.durable = durable  # fsync every append
+        base = os.path.splitext(path)[0]
+        self.index_path = base + ".idx"
+        self.lock_path = base + ".lock"
+        self.snapshot_every = snapshot_every
+        self._lock = threading.RLock()
+        self._by_user = {}
+        self._offsets = []
+        self._size = 0
+        self._sig = None
+        self._since_snapshot = 0
+        self._unsaved = []  # [(offset, uids)] indexed but not in the index file yet
+        self._idx_at = (None, 0, 0)  # index file: (inode, bytes read, log bytes it covers)
+        self._listeners = []
+        self.archive = LedgerArchive(base + ".archive")  # sealed months
+        if legacy_path:
+            self._import_legacy(legacy_path)
+        if self.archive.pending:
+            with locked(self.lock_path):
+                self._finish_seal()
+        with self._lock:
+            self._load()
+
+    # -----------------------------
+    # Setup / indexing
+    # -----------------------------
+    def _import_legacy(self, legacy_path):
+        # One-time conversion of the old transactions.json list
+        with locked(self.lock_path):
+            if os.path.exists(self.path) or not os.path.exists(legacy_path):
+                return
+            with open(legacy_path, "r") as f:
+                try:
+                    records = json.load(f)
+                except json.JSONDecodeError:
+                    records = []
+            atomic_write(self.path, "".join(json.dumps(t, separators=(",", ":")) + "\n" for t in records))
+
+    def _reset(self):
+        self._by_user = {}
+        self._offsets = []
+        self._size = 0
+        self._since_snapshot = 0
+        self._unsaved = []
+        self._idx_at = (None, 0, 0)
+
+    def _load(self):
+        self.archive.reload()  # the log is only replaced wholesale when months are sealed
+        self._reset()
+        self._sig = file_sig(self.path)
+        if self._sig:
+            self._read_index(merge=True)
+        self._scan_tail(notify=False)
+
+    # -----------------------------
+    # Index file
+    # -----------------------------
+    # One JSON line per chunk: {"ino", "start", "end", "offsets", "users"}
+    # lists the records whose offsets fall in [start, end) of the log with
+    # inode `ino`. Chunks are appended under the ledger's file lock, each
+    # starting where the file's coverage ends, so workers never duplicate
+    # one another. A chunk that doesn't follow on (a log replaced since, a
+    # torn write) ends the file; the next save rewrites it whole.
+    def _read_index(self, merge):
+        # Reads chunks past self._idx_at; merge=True adds the records beyond
+        # self._size to the in-memory index. Returns False if the file
+        # doesn't fit this log and needs rewriting.
+        sig = file_sig(self.index_path)
+        if sig is None:
+            self._idx_at = (None, 0, 0)
+            return False
+        ino, pos, covered = self._idx_at
+        if ino != sig[0] or sig[1] < pos:
+            pos, covered = 0, 0
+        ok = True
+        with open(self.index_path, "rb") as f:
+            f.seek(pos)
+            for line in f:
+                try:
+                    chunk = json.loads(line) if line.endswith(b"\n") else None
+                except json.JSONDecodeError:
+                    chunk = None
+                if chunk is None or chunk.get("ino") != self._sig[0] or chunk["start"] > covered:
+                    ok = False
+                    break
+                if merge and chunk["end"] > self._size:
+                    low = self._size
+                    self._offsets.extend(o for o in chunk["offsets"] if o >= low)
+                    for uid, offs in chunk["users"].items():
+                        offs = [o for o in offs if o >= low]
+                        if offs:
+                            self._by_user.setdefault(uid, []).extend(offs)
+                    self._size = chunk["end"]
+                pos += len(line)
+                covered = max(covered, chunk["end"])
+        self._idx_at = (sig[0], pos, covered)
+        return ok
+
+    def _save_index(self):
+        # Appends the records the index file doesn't cover yet. Needs the
+        # file lock. O(records since the last save), not O(ledger).
+        if not self._read_index(merge=False):
+            self._write_snapshot()
+            return
+        ino, pos, covered = self._idx_at
+        entries = [(o, uids) for o, uids in self._unsaved if o >= covered]
+        self._unsaved = []
+        self._since_snapshot = 0
+        if not entries:
+            return
+        if entries[0][0] != covered:
+            self._write_snapshot()  # a gap, e.g. an unreadable line: start over
+            return
+        users = {}
+        for offset, uids in entries:
+            for uid in uids:
+                users.setdefault(uid, []).append(offset)
+        line = (json.dumps({"ino": self._sig[0], "start": covered, "end": self._size,
+                            "offsets": [o for o, _ in entries], "users": users},
+                           separators=(",", ":")) + "\n").encode()
+        with open(self.index_path, "ab") as f:
+            f.write(line)  # no fsync: a lost chunk only means a longer tail scan
+        self._idx_at = (ino, pos + len(line), self._size)
+
+    def _write_snapshot(self):
+        # Rewrites the index file as one chunk covering the whole log. Needs
+        # the file lock; used after the log is replaced or reindexed.
+        atomic_write(self.index_path, json.dumps({
+            "ino": self._sig[0] if self._sig else None,
+            "start": 0,
+            "end": self._size,
+            "offsets": self._offsets,
+            "users": self._by_user,
+        }, separators=(",", ":")) + "\n")
+        self._unsaved = []
+        self._since_snapshot = 0
+        self._idx_at = (None, 0, 0)
+
+    def _index_record(self, offset, record):
+        self._offsets.append(offset)
+        uids = [str(uid) for uid in {record.get("from"), record.get("to")} if uid is not None]
+        for uid in uids:
+            self._by_user.setdefault(uid, []).append(offset)
+        self._unsaved.append((offset, uids))
+
+    def _scan_tail(self, notify=True):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as f:
+            f.seek(self._size)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # partially written record, pick it up next time
+                offset = self._size
+                self._size += len(line)
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                self._index_record(offset, record)
+                self._since_snapshot += 1
+                if notify:
+                    self._notify(record)
+
+    def _refresh(self):
+        sig = file_sig(self.path)
+        if sig == self._sig:
+            return
+        if sig is None or self._sig is None or sig[0] != self._sig[0] or sig[1] < self._size:
+            self._load()  # log was replaced (e.g. rewritten by another process)
+        else:
+            self._scan_tail()
+        self._sig = file_sig(self.path)
+        if self._since_snapshot >= self.snapshot_every:
+            # Workers that only read save what they've scanned too, so the
+            # unsaved list stays short
+            with locked(self.lock_path):
+                self._save_index()
+
+    def refresh(self):
+        with self._lock:
+            self._refresh()
+
+    @property
+    def lock(self):
+        # Held while records are appended and listeners notified; hold it to
+        # rebuild derived state without missing or double-counting a record.
+        return self._lock
+
+    def _notify(self, record):
+        for fn in self._listeners:
+            fn(record)
+
+    def subscribe(self, fn):
+        # fn(record) runs for every record appended after subscribing, by this
+        # process or (once picked up from the log) by another worker.
+        with self._lock:
+            self._listeners.append(fn)
+
+    # -----------------------------
+    # Writing
+    # -----------------------------
+    def append(self, record):
+        self.append_many([record])
+
+    def append_many(self, records):
+        if not records:
+            return
+        with self._lock, locked(self.lock_path):
+            self._refresh()
+            lines = [(json.dumps(r, separators=(",", ":")) + "\n").encode() for r in records]
+            with open(self.path, "ab") as f:
+                f.write(b"".join(lines))
+                if self.durable:
+                    f.flush()
+                    os.fsync(f.fileno())
+            for record, line in zip(records, lines):
+                self._index_record(self._size, record)
+                self._size += len(line)
+                self._notify(record)
+            self._sig = file_sig(self.path)
+            self._since_snapshot += len(records)
+            if self._since_snapshot >= self.snapshot_every:
+                self._save_index()  # one chunk of snapshot_every records
+
+    def sync(self):
+        # Puts every append so far (by any worker) on disk
+        fsync_file(self.path)
+
+    # -----------------------------
+    # Reading
+    # -----------------------------
+    def _read_at(self, f, offsets):
+        # f is opened while the offsets are taken, so a concurrent seal that
+        # replaces the log can't shift them
+        out = []
+        with f:
+            for off in offsets:
+                f.seek(off)
+                out.append(json.loads(f.readline()))
+        return out
+
+    def __len__(self):
+        with self._lock:
+            self._refresh()
+            return self.archive.count + len(self._offsets)
+
+    def for_user(self, uid):
+        # Records where uid is sender or receiver, oldest first
+        with self._lock:
+            self._refresh()
+            offsets = list(self._by_user.get(str(uid), ()))
+            archived = self.archive.for_user(uid)
+            f = open(self.path, "rb") if offsets else None
+        return archived + (self._read_at(f, offsets) if offsets else [])
+
+    def page_for_user(self, uid, cursor=None, limit=20, since=None, until=None, counterparty=None):
+        # Newest-first page of uid's records: the live log, then the sealed
+        # months. `cursor` is the opaque value returned as next_cursor by the
+        # previous page (None for the first).
+        def wanted(record):
+            # kind: non-payment events such as opening balances
+            return not record.get("kind") and not (counterparty and not matches_counterparty(record, uid, counterparty))
+
+        if cursor is not None and str(cursor).startswith("a"):
+            return self.archive.page_for_user(uid, cursor, limit, since, until, wanted)
+        with self._lock:
+            self._refresh()
+            # Live cursors count uid's records from its oldest archived one.
+            # Sealing moves the front of the live log to the end of the
+            # archive, so a cursor still means the same record afterwards.
+            archived = self.archive.count_for_user(uid)
+            offsets = self._by_user.get(str(uid), ())
+            pos = len(offsets) if cursor is None else min(int(cursor) - archived, len(offsets))
+            if pos < 0:  # sealed since the cursor was handed out
+                cursor = self.archive.cursor_at(uid, archived + pos)
+                if cursor is None:
+                    return [], None
+                return self.archive.page_for_user(uid, cursor, limit, since, until, wanted)
+            offsets = offsets[:pos]
+            f = open(self.path, "rb") if pos else None
+        rows = []
+        if f is not None:
+            with f:
+                while pos > 0 and len(rows) < limit:
+                    pos -= 1
+                    f.seek(offsets[pos])
+                    record = json.loads(f.readline())
+                    day = str(record.get("date", ""))[:10]
+                    if until and day > until:
+                        continue
+                    if since and day < since:
+                        return rows, None  # appended in date order, nothing older can match
+                    if wanted(record):
+                        rows.append(record)
+        if pos > 0:
+            return rows, str(archived + pos)
+        if len(rows) >= limit:
+            return rows, self.archive.next_cursor(uid)
+        older, next_cursor = self.archive.page_for_user(uid, None, limit - len(rows), since, until, wanted)
+        return rows + older, next_cursor
+
+    def count_for_user(self, uid):
+        with self._lock:
+            self._refresh()
+            return self.archive.count_for_user(uid) + len(self._by_user.get(str(uid), ()))
+
+    def iter_all(self):
+        # Streams every record present at the call, sealed months first,
+        # without materialising the whole ledger or holding its lock while
+        # reading. The cut-off is taken now, not on first next().
+        with self._lock:
+            self._refresh()
+            end = self._size
+            segments = list(self.archive.segments)
+            f = open(self.path, "rb") if os.path.exists(self.path) else None
+        return self._iter_records(segments, f, end)
+
+    def _iter_records(self, segments, f, end):
+        yield from self.archive.iter_all(segments)
+        if f is None:
+            return
+        with f:
+            pos = 0
+            for line in f:
+                pos += len(line)
+                if pos > end:
+                    break
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+
+    def all(self):
+        return list(self.iter_all())
+
+    def reindex(self):
+        # Rebuilds the offsets index from the log and rewrites the index file
+        with self._lock, locked(self.lock_path):
+            self._reset()
+            self._sig = file_sig(self.path)
+            self._scan_tail(notify=False)
+            self._write_snapshot()
+            return len(self._offsets)
+
+    # -----------------------------
+    # Sealing closed months
+    # -----------------------------
+    def seal(self, before):
+        # Moves every record dated before month `before` ("YYYY-MM") into
+        # per-month segments and rewrites the log without them. Appends wait
+        # on the file lock meanwhile; other workers notice the new log and
+        # reload. Returns {month: records sealed}.
+        with self._lock, locked(self.lock_path):
+            self._finish_seal()
+            self._refresh()
+            if not os.path.exists(self.path):
+                return {}
+            writers, tmp = {}, self.path + ".tmp"
+            with open(self.path, "rb") as src, open(tmp, "wb") as keep:
+                for line in src:
+                    record, month = None, None
+                    if line.endswith(b"\n"):
+                        try:
+                            record = json.loads(line)
+                            month = str(record.get("date", ""))[:7]
+                        except json.JSONDecodeError:
+                            pass
+                    if month and month < before:
+                        if month not in writers:
+                            writers[month] = self.archive.writer(month)
+                        writers[month].add(line, record)
+                    else:
+                        keep.write(line)
+                keep.flush()
+                os.fsync(keep.fileno())
+            if not writers:
+                os.remove(tmp)
+                return {}
+            for w in writers.values():
+                w.close()
+            self.archive.add(list(writers.values()), pending={"ino": self._sig[0], "months": sorted(writers)})
+            os.replace(tmp, self.path)
+            fsync_dir(os.path.dirname(os.path.abspath(self.path)))
+            self.archive.clear_pending()
+            self._load()
+            self._write_snapshot()
+            return {month: w.count for month, w in writers.items()}
+
+    def _finish_seal(self):
+        # A seal that stopped after listing its segments but before replacing
+        # the log: drop the sealed months from the log now. Needs the file lock.
+        pending = self.archive.pending
+        if not pending:
+            return
+        sig = file_sig(self.path)
+        if sig and sig[0] == pending["ino"]:
+            months = set(pending["months"])
+            tmp = self.path + ".tmp"
+            with open(self.path, "rb") as src, open(tmp, "wb") as keep:
+                for line in src:
+                    try:
+                        if str(json.loads(line).get("date", ""))[:7] in months:
+                            continue
+                    except json.JSONDecodeError:
+                        pass
+                    keep.write(line)
+                keep.flush()
+                os.fsync(keep.fileno())
+            os.replace(tmp, self.path)
+            fsync_dir(os.path.dirname(os.path.abspath(self.path)))
+        self.archive.clear_pending()
+
+
+class LedgerView:
+    # Base for state derived from the ledger (reward totals, rollups, ...).
+    # Subclasses implement _reset() and _apply(record); the view is rebuilt
+    # from the ledger on first use and then kept current by the listener.
+    # The rebuild replays the ledger without holding its lock, so payments
+    # keep committing meanwhile; what they append is queued and applied
+    # once the replay has caught up.
+    def __init__(self, ledger):
+        self.ledger = ledger
+        self._built = False
+        self._pending = None  # records appended during a rebuild
+        self._build_lock = threading.Lock()
+        self._reset()
+        ledger.subscribe(self.record)
+
+    def _reset(self):
+        raise NotImplementedError
+
+    def _apply(self, record):
+        raise NotImplementedError
+
+    def record(self, record):
+        # Ledger listener, called under the ledger lock
+        if self._built:
+            self._apply(record)
+        elif self._pending is not None:
+            self._pending.append(record)
+
+    def rebuild(self):
+        with self._build_lock:
+            self._rebuild()
+
+    def _rebuild(self):
+        with self.ledger.lock:
+            # iter_all fixes its cut-off here; everything after it reaches
+            # record() and is queued, so nothing is missed or counted twice
+            records = self.ledger.iter_all()
+            self._built = False
+            self._pending = []
+        self._reset()
+        for record in records:
+            self._apply(record)
+        with self.ledger.lock:
+            for record in self._pending:
+                self._apply(record)
+            self._pending = None
+            self._built = True
+
+    @contextmanager
+    def reading(self):
+        # Up-to-date (including other workers' payments) and stable while held
+        while True:
+            if not self._built:
+                with self._build_lock:
+                    if not self._built:
+                        self._rebuild()
+            self.ledger.refresh()
+            with self.ledger.lock:
+                if self._built:  # else a rebuild started meanwhile: wait for it
+                    yield
+                    return
@@ -0,0 +1,244 @@
+# manage.py
+# Maintenance commands: python manage.py <command> [options]
+import argparse
+import csv
+import json
+import os
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def cmd_migrate_sqlite(args):
+    from storage import migrate_json_to_sqlite
+    users, txns = migrate_json_to_sqlite(args.data_dir, args.db)
+    print(f"Migrated {users} users and {txns} transactions to {args.db or 'unipay.db'}")
+    print("Start the app with UNIPAY_STORAGE=sqlite to use it.")
+
+
+def read_transfers(path):
+    # CSV with a from,to,amount[,reward,note] header, or a JSON list of objects
+    with open(path, "r", newline="") as f:
+        if path.endswith(".json"):
+            return json.load(f)
+        return [{k: v for k, v in row.items() if v not in (None, "")} for row in csv.DictReader(f)]
+
+
+def cmd_batch_pay(args):
+    from payments import PaymentEngine, PaymentError
+    from storage import open_storage
+    storage = open_storage(args.backend, args.data_dir, durability="strict")
+    engine = PaymentEngine(storage.accounts, storage.ledger, os.path.join(args.data_dir, "payments.wal"),
+                           os.path.join(args.data_dir, "locks"), atomic=storage.atomic,
+                           sync=storage.sync)
+    engine.recover()
+    transfers = read_transfers(args.file)
+    try:
+        txns, _, errors = engine.transfer_batch(transfers, partial=args.partial)
+    except PaymentError as e:
+        where = f"transfer {e.index + 1}: " if e.index is not None else ""
+        raise SystemExit(f"Batch rejected, nothing applied: {where}{e.message}")
+    for e in errors:
+        print(f"skipped transfer {e['index'] + 1}: {e['error']}")
+    print(f"Applied {len(txns)} of {len(transfers)} transfers, "
+          f"total {sum(t['amount'] for t in txns):.2f}")
+
+
+def cmd_preregister(args):
+    # Bulk signup for an incoming batch: CSV with name,email,phone[,password,user_type]
+    from onboarding import IdAllocator, preregister
+    storage = _open(args)
+    allocator = IdAllocator(storage.accounts, os.path.join(args.data_dir, "unique_ids.seq"))
+    with open(args.file, "r", newline="") as f:
+        created, skipped = preregister(storage.accounts, allocator, csv.DictReader(f))
+    for row, reason in skipped:
+        print(f"skipped {row.get('email') or row.get('name')}: {reason}")
+    if args.out:
+        with open(args.out, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["unique_id", "name", "email", "phone", "password"])
+            for u, password in created:
+                writer.writerow([u["unique_id"], u["name"], u["email"], u["phone"], password])
+    print(f"Registered {len(created)} accounts, skipped {len(skipped)}"
+          + (f"; ids and passwords written to {args.out}" if args.out else ""))
+
+
+def _open(args):
+    from storage import open_storage
+    return open_storage(args.backend, args.data_dir, indexed_fields=("email", "phone", "face_id_ref"))
+
+
+def cmd_import_users(args):
+    from dataio import guess_format, import_users, open_path, read_records
+    from faces import FaceStore
+    from onboarding import IdAllocator
+    storage = _open(args)
+    allocator = IdAllocator(storage.accounts, os.path.join(args.data_dir, "unique_ids.seq"))
+    with open_path(args.file, "r") as f:
+        stats = import_users(storage.accounts, allocator, read_records(f, guess_format(args.file, args.format)),
+                             faces=FaceStore(os.path.join(args.data_dir, "faces")), chunk=args.chunk)
+    for where, reason in stats["skipped"]:
+        print(f"skipped {where}: {reason}")
+    print(f"Inserted {stats['inserted']}, updated {stats['updated']}, skipped {len(stats['skipped'])}")
+    if stats["balances_ignored"]:
+        print(f"Left {stats['balances_ignored']} existing balances unchanged; balances only move through payments")
+
+
+def cmd_export_users(args):
+    from dataio import export_users, guess_format, open_path
+    from faces import FaceStore
+    faces = FaceStore(os.path.join(args.data_dir, "faces")) if args.faces else None
+    with open_path(args.out, "w") as f:
+        n = export_users(_open(args).accounts, f, guess_format(args.out, args.format), faces=faces)
+    if args.out != "-":
+        print(f"Exported {n} accounts to {args.out}")
+
+
+def cmd_export_ledger(args):
+    from dataio import export_ledger, guess_format, open_path
+    with open_path(args.out, "w") as f:
+        n = export_ledger(_open(args).ledger, f, guess_format(args.out, args.format), uid=args.user)
+    if args.out != "-":
+        print(f"Exported {n} transactions to {args.out}")
+
+
+def cmd_reconcile(args):
+    from dataio import RecordWriter, guess_format, open_path
+    from payments import PaymentEngine
+    from reconcile import DRIFT_FIELDS, reconcile, repair
+    storage = _open(args)
+    engine = PaymentEngine(storage.accounts, storage.ledger, os.path.join(args.data_dir, "payments.wal"),
+                           os.path.join(args.data_dir, "locks"), atomic=storage.atomic,
+                           sync=storage.sync)
+    engine.recover()
+    if args.rebuild_index:
+        print(f"Re-indexed {storage.ledger.reindex()} ledger records")
+    report = reconcile(storage.accounts, storage.ledger, workers=args.workers, lock_accounts=engine.lock_accounts)
+    drift = report["drift"]
+    print(f"Replayed {report['records']} ledger records against {report['accounts']} accounts "
+          f"in {report['seconds']}s")
+    print(f"Balances {report['total_balances']:.2f} = opening {report['total_opening']:.2f} "
+          f"+ rewards {report['total_rewards']:.2f}? "
+          f"{'yes' if abs(report['total_balances'] - report['total_opening'] - report['total_rewards']) < 0.005 else 'no'}")
+    for uid in report["unknown_accounts"]:
+        print(f"ledger mentions unknown account {uid}")
+    for row in drift[:args.show]:
+        print(f"{row['unique_id']} {row['name']}: stored {row['stored']:.2f}, ledger {row['expected']:.2f} "
+              f"(drift {row['drift']:+.2f}{'' if row['has_opening'] else ', no opening balance'}"
+              f"{', %d duplicate rows' % row['duplicates'] if row['duplicates'] else ''})")
+    if len(drift) > args.show:
+        print(f"... and {len(drift) - args.show} more")
+    if args.out:
+        with open_path(args.out, "w") as f:
+            out = RecordWriter(f, guess_format(args.out, args.format), DRIFT_FIELDS)
+            for row in drift:
+                out.write(row)
+            out.close()
+    if drift and (args.backfill_openings or args.fix_balances):
+        done = repair(engine, storage.accounts, storage.ledger, drift,
+                      backfill_openings=args.backfill_openings, fix_balances=args.fix_balances)
+        print(f"Backfilled {done['backfilled']} opening balances, corrected {done['fixed']} balances")
+        drift = reconcile(storage.accounts, storage.ledger, workers=args.workers,
+                          lock_accounts=engine.lock_accounts)["drift"]
+    print(f"{len(drift)} accounts drifted" if drift else "All balances agree with the ledger")
+    if drift:
+        raise SystemExit(1)
+
+
+def cmd_archive_ledger(args):
+    from datetime import date
+    storage = _open(args)
+    if not hasattr(storage.ledger, "seal"):
+        raise SystemExit("archive-ledger is for the json backend; SQLite keeps old rows indexed in place")
+    before = args.before
+    if before is None:
+        months = date.today().year * 12 + date.today().month - 1 - (args.keep_months - 1)
+        before = f"{months // 12:04d}-{months % 12 + 1:02d}"
+    sealed = storage.ledger.seal(before)
+    for month, n in sorted(sealed.items()):
+        print(f"sealed {month}: {n} records")
+    archive = storage.ledger.archive
+    print(f"Archive holds {archive.count} records in {len(archive.segments)} segments; "
+          f"{len(storage.ledger) - archive.count} records stay in the live log")
+
+
+def cmd_build_assets(args):
+    from assets import build
+    stats = build(args.static)
+    print(f"Built {stats['files']} files into {os.path.join(args.static, 'dist')}: "
+          f"{stats['bytes_in']:,} -> {stats['bytes_out']:,} bytes ({stats['gzip_out']:,} gzipped)")
+    print("Restart the app to serve them.")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="manage.py", description="UniPay maintenance commands")
+    parser.add_argument("--data-dir", default=BASE_DIR, help="directory holding users.json etc.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("migrate-sqlite", help="copy users.json and the ledger into SQLite")
+    p.add_argument("--db", default=None, help="database path (default: <data-dir>/unipay.db)")
+    p.set_defaults(func=cmd_migrate_sqlite)
+
+    p = sub.add_parser("batch-pay", help="apply a CSV/JSON file of transfers as one commit")
+    p.add_argument("file", help="CSV (from,to,amount[,reward,note]) or .json list")
+    p.add_argument("--backend", choices=("json", "sqlite"), default=os.environ.get("UNIPAY_STORAGE", "json"))
+    p.add_argument("--partial", action="store_true", help="skip invalid transfers instead of rejecting the batch")
+    p.set_defaults(func=cmd_batch_pay)
+
+    p = sub.add_parser("preregister", help="create accounts in bulk from a CSV of students/merchants")
+    p.add_argument("file", help="CSV with name,email,phone[,password,user_type] columns")
+    p.add_argument("--out", help="write the assigned unique_ids and passwords to this CSV")
+    p.add_argument("--backend", choices=("json", "sqlite"), default=os.environ.get("UNIPAY_STORAGE", "json"))
+    p.set_defaults(func=cmd_preregister)
+
+    backend = dict(choices=("json", "sqlite"), default=os.environ.get("UNIPAY_STORAGE", "json"))
+    formats = dict(choices=("csv", "ndjson", "json"), help="default: from the file extension, else ndjson")
+
+    p = sub.add_parser("import-users", help="stream a CSV/NDJSON/JSON file of accounts into the store (upsert)")
+    p.add_argument("file", help="input file, or - for stdin")
+    p.add_argument("--format", **formats)
+    p.add_argument("--chunk", type=int, default=1000, help="records per store write")
+    p.add_argument("--backend", **backend)
+    p.set_defaults(func=cmd_import_users)
+
+    p = sub.add_parser("export-users", help="stream all accounts to CSV/NDJSON/JSON")
+    p.add_argument("out", help="output file, or - for stdout")
+    p.add_argument("--format", **formats)
+    p.add_argument("--faces", action="store_true", help="inline face images and vectors from the face store")
+    p.add_argument("--backend", **backend)
+    p.set_defaults(func=cmd_export_users)
+
+    p = sub.add_parser("export-ledger", help="stream the ledger (or one user's history) to CSV/NDJSON/JSON")
+    p.add_argument("out", help="output file, or - for stdout")
+    p.add_argument("--format", **formats)
+    p.add_argument("--user", help="only this unique_id's transactions")
+    p.add_argument("--backend", **backend)
+    p.set_defaults(func=cmd_export_ledger)
+
+    p = sub.add_parser("reconcile", help="replay the ledger and check every stored balance")
+    p.add_argument("--workers", type=int, default=None, help="replay processes (default: CPU count)")
+    p.add_argument("--out", help="write drifted accounts to this CSV/NDJSON/JSON file")
+    p.add_argument("--format", **formats)
+    p.add_argument("--show", type=int, default=20, help="drifted accounts to print")
+    p.add_argument("--backfill-openings", action="store_true",
+                   help="record opening_balance events for balances that predate them")
+    p.add_argument("--fix-balances", action="store_true", help="set drifted balances to the ledger's figure")
+    p.add_argument("--rebuild-index", action="store_true", help="rebuild the ledger's index before checking")
+    p.add_argument("--backend", **backend)
+    p.set_defaults(func=cmd_reconcile)
+
+    p = sub.add_parser("archive-ledger", help="seal closed months of the ledger into compressed segments")
+    p.add_argument("--keep-months", type=int, default=1, help="months kept in the live log, incl. this one")
+    p.add_argument("--before", help="seal everything dated before this month (YYYY-MM) instead")
+    p.add_argument("--backend", **backend)
+    p.set_defaults(func=cmd_archive_ledger)
+
+    p = sub.add_parser("build-assets", help="minify and fingerprint static files into static/dist")
+    p.add_argument("--static", default=os.path.join(BASE_DIR, "static"), help="static directory")
+    p.set_defaults(func=cmd_build_assets)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
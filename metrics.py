@@ -0,0 +1,167 @@
+# metrics.py
+# In-process latency histograms, a Prometheus text exporter and a sampling
+# profiler.
+#
+# timed("accounts.get") records how long a block took into a histogram
+# labelled with the operation and the Flask route currently being served
+# (set by the app in before_request). Nothing here imports Flask, so storage
+# and the face service can be instrumented too.
+import contextvars
+import functools
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+current_route = contextvars.ContextVar("current_route", default="-")
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        i = 0
+        while i < len(BUCKETS) and value > BUCKETS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}  # (metric, op, route) -> Histogram
+
+    def observe(self, metric, op, seconds, route=None):
+        key = (metric, op, route if route is not None else current_route.get())
+        with self._lock:
+            h = self._histograms.get(key)
+            if h is None:
+                h = self._histograms[key] = Histogram()
+            h.observe(seconds)
+
+    def render(self):
+        # Prometheus text exposition format
+        with self._lock:
+            items = sorted(self._histograms.items())
+            snapshot = [(k, list(h.counts), h.sum, h.count) for k, h in items]
+        lines, seen = [], set()
+        for (metric, op, route), counts, total, count in snapshot:
+            if metric not in seen:
+                seen.add(metric)
+                lines.append(f"# TYPE {metric} histogram")
+            labels = f'op="{op}",route="{route}"'
+            cumulative = 0
+            for bound, n in zip(BUCKETS + ("+Inf",), counts):
+                cumulative += n
+                lines.append(f'{metric}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"{metric}_sum{{{labels}}} {total:.6f}")
+            lines.append(f"{metric}_count{{{labels}}} {count}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+
+
+registry = Registry()
+OP_METRIC = "unipay_op_seconds"
+REQUEST_METRIC = "unipay_request_seconds"
+
+
+@contextmanager
+def timed(op, metric=OP_METRIC):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        registry.observe(metric, op, time.perf_counter() - start)
+
+
+def timed_fn(op):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timed(op):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def instrument(obj, prefix, methods):
+    # Wrap the given methods of one object (e.g. the account store) in place
+    for name in methods:
+        fn = getattr(obj, name, None)
+        if fn is not None:
+            setattr(obj, name, timed_fn(f"{prefix}.{name}")(fn))
+    return obj
+
+
+# -----------------------------
+# Sampling profiler
+# -----------------------------
+class SamplingProfiler:
+    # Samples every thread's stack every `interval` seconds and counts
+    # collapsed stacks ("a;b;c N", the flamegraph.pl input format).
+    def __init__(self, interval=0.005, max_depth=40):
+        self.interval = interval
+        self.max_depth = max_depth
+        self._stacks = Counter()
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self.samples = 0
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        with self._lock:
+            if self.running:
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                names = []
+                while frame is not None and len(names) < self.max_depth:
+                    code = frame.f_code
+                    names.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno})")
+                    frame = frame.f_back
+                with self._lock:
+                    self._stacks[";".join(reversed(names))] += 1
+                    self.samples += 1
+
+    def collapsed(self):
+        with self._lock:
+            return "\n".join(f"{stack} {n}" for stack, n in self._stacks.most_common()) + "\n"
+
+    def reset(self):
+        with self._lock:
+            self._stacks.clear()
+            self.samples = 0
+
+
+profiler = SamplingProfiler()
@@ -0,0 +1,167 @@
+# onboarding.py
+# Collision-free unique_id allocation and account creation.
+#
+# IDs are not drawn at random and retried. Each kind ("user", "merchant") has
+# a counter in unique_ids.seq; the n-th ID is the counter pushed through a
+# fixed permutation of the ID space (i -> a*i + b mod N with gcd(a, N) = 1),
+# so successive IDs look unrelated but can never repeat. Workers reserve
+# counter blocks under a file lock, so an allocation is usually a pure
+# in-memory step. The only check left is against IDs minted randomly before
+# this allocator existed.
+import json
+import math
+import os
+import secrets
+import threading
+
+from credentials import hash_many, make_hash
+from fileutil import atomic_write, locked
+
+ALPHABET = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789"
+USER_FIRST = ALPHABET.replace("M", "")  # user ids never start with "M"
+ID_LENGTH = 6
+
+
+def _multiplier(n):
+    # A multiplier coprime with n, near the golden ratio for good scatter
+    a = int(n * 0.6180339887) | 1
+    while math.gcd(a, n) != 1:
+        a += 2
+    return a
+
+
+class IdSpace:
+    def __init__(self, prefix_alphabet, fixed_prefix=""):
+        self.prefix_alphabet = prefix_alphabet
+        self.fixed_prefix = fixed_prefix
+        self.tail = ID_LENGTH - len(fixed_prefix) - (1 if prefix_alphabet else 0)
+        self.size = (len(prefix_alphabet) if prefix_alphabet else 1) * len(ALPHABET) ** self.tail
+        self.a = _multiplier(self.size)
+        self.b = self.size // 3
+
+    def encode(self, i):
+        k = (self.a * i + self.b) % self.size
+        chars = []
+        for _ in range(self.tail):
+            k, r = divmod(k, len(ALPHABET))
+            chars.append(ALPHABET[r])
+        head = self.fixed_prefix + (self.prefix_alphabet[k] if self.prefix_alphabet else "")
+        return head + "".join(reversed(chars))
+
+
+SPACES = {
+    "user": IdSpace(USER_FIRST),
+    "merchant": IdSpace("", fixed_prefix="M"),
+}
+
+
+class IdAllocator:
+    def __init__(self, accounts, path, block=64, reserved=()):
+        self.accounts = accounts
+        self.path = path
+        self.lock_path = path + ".lock"
+        self.block = block
+        self.reserved = set(reserved)
+        self._lock = threading.Lock()
+        self._blocks = {}  # kind -> [next, end)
+        self._pid = os.getpid()
+
+    def _reserve(self, kind, n):
+        # Claims counters [start, start + n) for this process
+        with locked(self.lock_path):
+            try:
+                with open(self.path, "r") as f:
+                    counters = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                counters = {}
+            start = counters.get(kind, 0)
+            counters[kind] = start + n
+            atomic_write(self.path, json.dumps(counters))
+        return start, start + n
+
+    def _next_index(self, kind):
+        if self._pid != os.getpid():  # forked: the parent's blocks aren't ours
+            self._blocks, self._pid = {}, os.getpid()
+        block = self._blocks.get(kind)
+        if block is None or block[0] >= block[1]:
+            block = self._blocks[kind] = list(self._reserve(kind, self.block))
+        i = block[0]
+        block[0] += 1
+        return i
+
+    def allocate(self, kind="user"):
+        return self.allocate_many(1, kind)[0]
+
+    def allocate_many(self, count, kind="user"):
+        space = SPACES["merchant" if kind == "merchant" else "user"]
+        out = []
+        with self._lock:
+            if count > self.block:
+                start, end = self._reserve(kind, count)
+                indexes = iter(range(start, end))
+            else:
+                indexes = None
+            while len(out) < count:
+                i = next(indexes, None) if indexes is not None else None
+                uid = space.encode(self._next_index(kind) if i is None else i)
+                # Legacy random ids may sit anywhere in the space
+                if uid not in self.reserved and uid not in self.accounts:
+                    out.append(uid)
+        return out
+
+
+def new_account(uid, name, email, phone, password, user_type="user", hashed=False):
+    # `password` is plaintext and is always hashed here, even if it looks like
+    # a hash, so a signup can't plant a stored credential. hashed=True is for
+    # the bulk paths that hash a whole batch themselves.
+    return {
+        "name": name,
+        "email": email,
+        "phone": phone,
+        "password": password if hashed else make_hash(password),
+        "unique_id": uid,
+        "balance": 0.0,
+        "bank_linked": False,
+        "pin": "",
+        "user_type": user_type  # store type
+    }
+
+
+def preregister(accounts, allocator, rows, chunk=1000):
+    # rows: dicts with name, email, phone and optionally password / user_type.
+    # Rows without a password get a random temporary one. Returns
+    # (created, skipped): created are (record, plaintext password) pairs,
+    # skipped are (row, reason) pairs for incomplete rows and duplicate
+    # emails/phones.
+    created, skipped, batch = [], [], []
+
+    def flush():
+        by_kind = {}
+        for row in batch:
+            by_kind.setdefault(row["user_type"], []).append(row)
+        records, passwords = [], {}
+        for kind, kind_rows in by_kind.items():
+            uids = allocator.allocate_many(len(kind_rows), kind)
+            hashes = hash_many([row["password"] for row in kind_rows])
+            for uid, password_hash, row in zip(uids, hashes, kind_rows):
+                records.append(new_account(uid, row["name"], row["email"], row["phone"], password_hash, kind,
+                                           hashed=True))
+                passwords[uid] = row["password"]
+        added, dupes = accounts.add_many(records, unique=("email", "phone"), skip_duplicates=True)
+        created.extend((u, passwords[u["unique_id"]]) for u in added)
+        skipped.extend((r, str(e.args[0])) for r, e in dupes)
+        batch.clear()
+
+    for row in rows:
+        row = {k: (v or "").strip() for k, v in row.items() if k}
+        if not all(row.get(k) for k in ("name", "email", "phone")):
+            skipped.append((row, "name, email and phone are required"))
+            continue
+        row["password"] = row.get("password") or secrets.token_urlsafe(8)
+        row["user_type"] = "merchant" if row.get("user_type") == "merchant" else "user"
+        batch.append(row)
+        if len(batch) >= chunk:
+            flush()
+    if batch:
+        flush()
+    return created, skipped
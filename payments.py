@@ -0,0 +1,343 @@
+# payments.py
+# Payment engine: atomic transfers with per-account locking.
+#
+# Each transfer locks only the accounts it touches (striped flock files,
+# always acquired in sorted order so two transfers can never deadlock), then
+# writes an intent record to a write-ahead log before touching balances or
+# the ledger. The intent holds the balances before and after plus the ledger
+# rows. An intent that never got its commit marker (its worker died, or
+# applying it failed) is settled by the next transfer that locks any of its
+# accounts, before that transfer reads a balance: rolled forward if its rows
+# reached the ledger, rolled back otherwise. Nothing can build on a half
+# applied intent, so writing the absolute balances it holds is always exact.
+import json
+import logging
+import math
+import os
+import random
+import string
+import threading
+import uuid
+import zlib
+from contextlib import ExitStack, contextmanager, nullcontext
+from datetime import datetime
+
+from fileutil import GroupCommitter, atomic_write, locked
+
+log = logging.getLogger(__name__)
+
+
+class PaymentError(Exception):
+    def __init__(self, message, status=400, index=None):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+        self.index = index  # position in a batch, if the error came from one
+
+
+def generate_txn_id(length=10):
+    chars = string.ascii_letters + string.digits
+    return ''.join(random.choices(chars, k=length))
+
+
+class PaymentEngine:
+    def __init__(self, accounts, ledger, wal_path, lock_dir, stripes=1024, rotate_bytes=1 << 20,
+                 atomic=nullcontext, sync=None, durability="strict", group_window=0.002):
+        self.accounts = accounts
+        self.ledger = ledger
+        self.atomic = atomic  # storage backend transaction, if it has one
+        self.sync = sync or (lambda: None)  # storage fsync of the account journal and ledger
+        self.wal_path = wal_path
+        self.wal_lock_path = wal_path + ".lock"
+        self.lock_dir = lock_dir
+        self.stripes = stripes
+        self.rotate_bytes = rotate_bytes
+        # "strict": every WAL record is fsynced on its own before returning
+        # (the storage fsyncs its own appends too). "group": WAL records from
+        # concurrent payments share one fsync every `group_window` seconds,
+        # preceded by one sync() of the storage, so a payment's journal and
+        # ledger writes are on disk once its commit marker is and
+        # transfer() returns.
+        if durability not in ("strict", "group"):
+            raise ValueError(f"Unknown durability mode: {durability}")
+        self.durability = durability
+        self._group = (GroupCommitter(wal_path, self.wal_lock_path, group_window, before_sync=self.sync)
+                       if durability == "group" else None)
+        self._wal_lock = threading.Lock()
+        self._wal_sig = None  # (inode, bytes read) of the WAL as last scanned
+        self._open = {}  # intents in the WAL without a commit or abort marker
+        os.makedirs(lock_dir, exist_ok=True)
+
+    # -----------------------------
+    # Locking
+    # -----------------------------
+    def _stripe(self, uid):
+        return zlib.crc32(str(uid).encode()) % self.stripes
+
+    @contextmanager
+    def lock_accounts(self, uids):
+        # Also settles any open intent on these stripes first. Its worker no
+        # longer holds them, so it died or failed; if the intent touches
+        # accounts outside our stripes, all of them are relocked in order.
+        uids = {str(uid) for uid in uids}
+        with ExitStack() as stack:
+            held = set()
+            while True:
+                stripes = {self._stripe(uid) for uid in uids}
+                if not stripes <= held:
+                    stack.close()
+                    for s in sorted(stripes):
+                        stack.enter_context(locked(os.path.join(self.lock_dir, f"acct-{s:04d}.lock")))
+                    held = stripes
+                stale = [e for e in self._open_intents()
+                         if any(self._stripe(uid) in held for uid in e["balances"])]
+                more = {uid for e in stale for uid in e["balances"]}
+                if {self._stripe(uid) for uid in more} <= held:
+                    break
+                uids |= more
+            self.accounts.refresh()
+            for entry in stale:
+                self._settle(entry)
+            yield
+
+    # -----------------------------
+    # Write-ahead log
+    # -----------------------------
+    def _wal_append(self, entry):
+        line = json.dumps(entry, separators=(",", ":")) + "\n"
+        if self._group is not None:
+            self._group.append(line)
+            return
+        with locked(self.wal_lock_path):
+            with open(self.wal_path, "a") as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _read_wal(self):
+        # (intents by id, ids with a commit or abort marker)
+        intents, closed = {}, set()
+        if not os.path.exists(self.wal_path):
+            return intents, closed
+        with open(self.wal_path, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # torn write from a crash
+                if "commit" in entry or "abort" in entry:
+                    closed.add(entry.get("commit", entry.get("abort")))
+                else:
+                    intents[entry["id"]] = entry
+        return intents, closed
+
+    def _open_intents(self):
+        # Intents with no marker yet. The WAL is read incrementally (only what
+        # was appended since the last call), and from the start again once
+        # rotation or recover() has replaced it.
+        with self._wal_lock:
+            try:
+                st = os.stat(self.wal_path)
+            except FileNotFoundError:
+                self._wal_sig, self._open = None, {}
+                return []
+            ino, pos = self._wal_sig or (None, 0)
+            if ino != st.st_ino or st.st_size < pos:
+                pos, self._open = 0, {}
+            if st.st_size > pos:
+                with open(self.wal_path, "rb") as f:
+                    f.seek(pos)
+                    for line in f:
+                        if not line.endswith(b"\n"):
+                            break  # being written, picked up next time
+                        pos += len(line)
+                        try:
+                            entry = json.loads(line)
+                        except json.JSONDecodeError:
+                            continue
+                        if "commit" in entry or "abort" in entry:
+                            self._open.pop(entry.get("commit", entry.get("abort")), None)
+                        else:
+                            self._open[entry["id"]] = entry
+            self._wal_sig = (st.st_ino, pos)
+            return list(self._open.values())
+
+    def _maybe_rotate(self):
+        # Keep only intents that have no commit marker yet (possibly in flight
+        # in another worker); everything else is already applied. Dropping an
+        # intent is only safe once what it applied is on disk, hence sync().
+        with locked(self.wal_lock_path):
+            if not os.path.exists(self.wal_path) or os.path.getsize(self.wal_path) < self.rotate_bytes:
+                return
+            intents, closed = self._read_wal()
+            self.sync()
+            atomic_write(self.wal_path, "".join(
+                json.dumps(entry, separators=(",", ":")) + "\n"
+                for wid, entry in intents.items() if wid not in closed))
+
+    def _apply(self, entry):
+        balances = entry["balances"]
+        with self.atomic():
+            self.accounts.update_many({uid: {"balance": b} for uid, b in balances.items()})
+            self.ledger.append_many(entry["txns"])
+
+    def _commit(self, before, balances, txns):
+        entry = {"id": uuid.uuid4().hex, "before": before, "balances": balances, "txns": txns}
+        self._wal_append(entry)
+        try:
+            self._apply(entry)
+        except Exception:
+            # Settle it while the accounts are still locked. If that fails
+            # too, the next transfer on these accounts settles it.
+            if not self._settle(entry):
+                raise
+            log.exception("Payment %s committed after an error while applying it", entry["id"])
+            return
+        self._wal_append({"commit": entry["id"]})
+        self._maybe_rotate()
+
+    def _settle(self, entry):
+        # Finishes an intent that has no marker. The caller holds the locks
+        # of every account in it and nothing has moved them since, so the
+        # absolute balances in the intent are exact. The ledger decides: if
+        # any of its rows reached it the payment happened and is rolled
+        # forward, otherwise balances go back to `before` and it is aborted.
+        # Returns True if the payment went through.
+        wid = entry["id"]
+        if wid in self._read_wal()[1]:
+            return True  # closed while we waited for the locks
+        ids = {t["id"] for t in entry["txns"]}
+        seen = set()
+        for uid in {t.get("from", t.get("to")) for t in entry["txns"]}:
+            seen.update(x.get("id") for x in self.ledger.for_user(uid) if x.get("id") in ids)
+        before = entry.get("before")
+        if seen or before is None:  # intents logged before `before` existed are redone
+            self._apply({"balances": entry["balances"], "txns": [t for t in entry["txns"] if t["id"] not in seen]})
+            self._wal_append({"commit": wid})
+            return True
+        with self.atomic():
+            self.accounts.update_many({uid: {"balance": b} for uid, b in before.items()})
+        self._wal_append({"abort": wid})
+        return False
+
+    def recover(self):
+        # Settles intents left open by a crash; run at start-up. Returns how
+        # many were found.
+        intents, closed = self._read_wal()
+        settled = 0
+        for wid, entry in intents.items():
+            if wid in closed:
+                continue
+            with self.lock_accounts(entry["balances"]):
+                settled += 1  # lock_accounts settles it
+        with locked(self.wal_lock_path):
+            intents, closed = self._read_wal()
+            if all(wid in closed for wid in intents):
+                self.sync()
+                atomic_write(self.wal_path, "")
+        return settled
+
+    # -----------------------------
+    # Transfers
+    # -----------------------------
+    def transfer(self, sender_uid, recipient_uid, amount, reward=0, note=None):
+        txns, balances, _ = self.transfer_batch([{
+            "from": sender_uid, "to": recipient_uid, "amount": amount, "reward": reward, "note": note
+        }])
+        return txns[0], balances[sender_uid]
+
+    def transfer_batch(self, transfers, partial=False):
+        # transfers: [{"from", "to", "amount", "reward"?, "note"?}, ...]
+        # All accounts are locked once, the transfers are checked in order
+        # against running balances, and every balance change plus every
+        # ledger row is committed as one WAL intent / storage transaction.
+        # By default one bad transfer rejects the whole batch; with
+        # partial=True bad ones are skipped and reported in `errors`.
+        # Returns (txns, balances, errors).
+        transfers = list(transfers)
+        if not transfers:
+            raise PaymentError("No transfers given")
+        uids = {str(t.get("from")) for t in transfers} | {str(t.get("to")) for t in transfers}
+        with self.lock_accounts(uids):
+            records = {uid: self.accounts.get(uid) for uid in uids}
+            running = {uid: r.get("balance", 0.0) for uid, r in records.items() if r}
+            start = dict(running)
+            touched, txns, errors = set(), [], []
+            now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            for index, t in enumerate(transfers):
+                try:
+                    txn = self._plan(t, records, running, now)
+                except PaymentError as e:
+                    if not partial:
+                        e.index = index
+                        raise
+                    errors.append({"index": index, "error": e.message})
+                    continue
+                touched.update((txn["from"], txn["to"]))
+                txns.append(txn)
+            balances = {uid: running[uid] for uid in touched}
+            if txns:
+                self._commit({uid: start[uid] for uid in touched}, balances, txns)
+        return txns, balances, errors
+
+    def open_balance(self, uid, amount, name=None, backfill=False):
+        # Credits a starting balance and records it in the ledger as an
+        # "opening_balance" event, so replaying the ledger accounts for every
+        # rupee (see reconcile.py). With backfill=True only the event is
+        # written, for money an older record already holds. The caller holds
+        # lock_accounts([uid]).
+        uid, amount = str(uid), round(float(amount), 2)
+        if not math.isfinite(amount):
+            raise PaymentError("Invalid amount")
+        record = self.accounts.get(uid)
+        if record is None:
+            raise PaymentError("Account not found", 404)
+        event = {
+            "id": generate_txn_id(),
+            "kind": "opening_balance",
+            "to": uid,
+            "to_name": name or record.get("name"),
+            "amount": amount,
+            "date": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        }
+        if backfill:
+            event["backfilled"] = True
+        before = record.get("balance", 0.0)
+        self._commit({uid: before}, {uid: round(before + (0 if backfill else amount), 2)}, [event])
+        return event
+
+    def _plan(self, t, records, running, now):
+        # Validates one transfer and applies it to the running balances
+        sender_uid, recipient_uid = str(t.get("from")), str(t.get("to"))
+        try:
+            amount = round(float(t.get("amount")), 2)
+            reward = round(float(t.get("reward") or 0), 2)
+        except (TypeError, ValueError):
+            raise PaymentError("Invalid amount")
+        if not (math.isfinite(amount) and math.isfinite(reward)) or amount <= 0 or reward < 0:
+            raise PaymentError("Invalid amount")
+        sender = records.get(sender_uid)
+        recipient = records.get(recipient_uid)
+        if not sender:
+            raise PaymentError("Sender not found", 404)
+        if not recipient:
+            raise PaymentError("Recipient not found", 404)
+        if running[sender_uid] < amount:
+            raise PaymentError("Insufficient balance")
+
+        # Sender first, so paying yourself nets out correctly
+        running[sender_uid] = round(running[sender_uid] + reward - amount, 2)
+        running[recipient_uid] = round(running[recipient_uid] + amount, 2)
+        txn = {
+            "id": generate_txn_id(),
+            "from": sender_uid,
+            "from_name": sender.get("name"),
+            "to": recipient_uid,
+            "to_name": recipient.get("name"),
+            "amount": amount,
+            "reward": reward,
+            "date": now
+        }
+        if t.get("note") is not None:
+            txn["note"] = t["note"]
+        return txn
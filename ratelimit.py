@@ -0,0 +1,151 @@
+# ratelimit.py
+# Token-bucket rate limits shared by every worker.
+#
+# A rule is (capacity, period): a bucket holds up to `capacity` tokens and
+# refills at capacity / period tokens per second. take() spends a token per
+# request (for lockouts, per attempt, refunded when it succeeds) and returns
+# how many seconds the caller has to wait when the bucket is empty. Buckets live in memory
+# (one worker) or in a small SQLite table every worker shares. A rejected
+# request only reads its bucket, so turning away a client that is hammering
+# an endpoint costs microseconds, not a PIN hash or a face model run.
+import os
+import sqlite3
+import threading
+import time
+
+from sessions import LRUCache
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after, message="Too many attempts, try again later"):
+        super().__init__(message)
+        self.retry_after = max(1, int(retry_after + 0.999))
+
+
+def _level(row, capacity, rate, now):
+    # Tokens in a bucket stored as (tokens, updated) after refilling to `now`
+    if row is None:
+        return float(capacity)
+    tokens, updated = row
+    return min(float(capacity), tokens + max(0.0, now - updated) * rate)
+
+
+# -----------------------------
+# Bucket stores
+# -----------------------------
+class MemoryLimitStore:
+    def __init__(self, maxsize=100000):
+        self._lock = threading.Lock()
+        self._buckets = LRUCache(maxsize)
+
+    def level(self, key, capacity, rate):
+        return _level(self._buckets.get(key), capacity, rate, time.time())
+
+    def take(self, key, capacity, rate, cost=1):
+        with self._lock:
+            now = time.time()
+            tokens = _level(self._buckets.get(key), capacity, rate, now)
+            if tokens < cost:
+                return (cost - tokens) / rate
+            tokens = min(float(capacity), tokens - cost)  # cost < 0 refunds
+            # Once full again the bucket is the same as a missing one
+            self._buckets.set(key, (tokens, now), ttl=(capacity - tokens) / rate)
+            return 0.0
+
+    def reset(self, key):
+        self._buckets.pop(key)
+
+
+class SQLiteLimitStore:
+    # Shared by all workers; buckets that have refilled are purged every `purge_every` writes
+    def __init__(self, path, purge_every=1000):
+        self.path = path
+        self.purge_every = purge_every
+        self._local = threading.local()
+        self._writes = 0
+        self._conn().execute(
+            "CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, "
+            "updated REAL NOT NULL, full_at REAL NOT NULL)")
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def _row(self, conn, key):
+        return conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+
+    def level(self, key, capacity, rate):
+        return _level(self._row(self._conn(), key), capacity, rate, time.time())
+
+    def take(self, key, capacity, rate, cost=1):
+        conn = self._conn()
+        tokens = _level(self._row(conn, key), capacity, rate, time.time())
+        if tokens < cost:
+            return (cost - tokens) / rate  # rejected without taking the write lock
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            tokens = _level(self._row(conn, key), capacity, rate, now)
+            if tokens < cost:
+                conn.execute("COMMIT")
+                return (cost - tokens) / rate
+            tokens = min(float(capacity), tokens - cost)
+            conn.execute("INSERT INTO buckets (key, tokens, updated, full_at) VALUES (?, ?, ?, ?) "
+                         "ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, "
+                         "updated = excluded.updated, full_at = excluded.full_at",
+                         (key, tokens, now, now + (capacity - tokens) / rate))
+            self._writes += 1
+            if self._writes % self.purge_every == 0:
+                conn.execute("DELETE FROM buckets WHERE full_at <= ?", (now,))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return 0.0
+
+    def reset(self, key):
+        self._conn().execute("DELETE FROM buckets WHERE key = ?", (key,))
+
+
+def open_limit_store(kind, path=None):
+    if kind == "memory":
+        return MemoryLimitStore()
+    if kind == "sqlite":
+        return SQLiteLimitStore(path)
+    raise ValueError(f"Unknown rate limit store: {kind}")
+
+
+# -----------------------------
+# Limiter
+# -----------------------------
+class RateLimiter:
+    # rules: {name: (capacity, period_seconds)}
+    def __init__(self, store, rules):
+        self.store = store
+        self.rules = dict(rules)
+
+    def _args(self, rule, key):
+        capacity, period = self.rules[rule]
+        return f"{rule}:{key}", capacity, capacity / period
+
+    def take(self, rule, key, cost=1):
+        # Spends `cost` tokens; returns 0 if allowed, else seconds to wait
+        return self.store.take(*self._args(rule, key), cost=cost)
+
+    def refund(self, rule, key, cost=1):
+        # Gives back tokens spent on an attempt that turned out fine
+        self.store.take(*self._args(rule, key), cost=-cost)
+
+    def wait(self, rule, key):
+        # Seconds until the bucket holds a token again, without spending one
+        name, capacity, rate = self._args(rule, key)
+        tokens = self.store.level(name, capacity, rate)
+        return 0.0 if tokens >= 1 else (1 - tokens) / rate
+
+    def reset(self, rule, key):
+        self.store.reset(self._args(rule, key)[0])
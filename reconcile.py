@@ -0,0 +1,237 @@
+# reconcile.py
+# Checks stored balances against a replay of the ledger.
+#
+# Every balance should equal the account's opening_balance events plus
+# money received, minus money sent, plus reward credits. The ledger is split
+# into sealed segments plus byte ranges of the live log (json backend) or
+# into seq ranges (SQLite), and each piece is
+# folded on a worker process into per-account totals kept in paise, so the
+# partial results merge by plain addition whatever order they finish in. An
+# account whose store balance disagrees is then replayed again on its own,
+# under its payment lock, so a payment that landed during the scan is not
+# reported as drift. The store and the service stay online throughout.
+import json
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+
+TOTALS = ("opening", "received", "sent", "rewards")
+INLINE_BYTES = 4 << 20  # smaller ledgers are folded in-process
+DRIFT_FIELDS = ("unique_id", "name", "stored", "expected", "drift", "opening", "received", "sent",
+                "rewards", "has_opening", "duplicates")
+
+
+def _cents(value):
+    return int(round(float(value or 0) * 100))
+
+
+def fold(totals, record):
+    # Adds one ledger record to {uid: {opening, received, sent, rewards}}
+    def acct(uid):
+        t = totals.get(uid)
+        if t is None:
+            t = totals[uid] = dict.fromkeys(TOTALS, 0)
+        return t
+    kind = record.get("kind")
+    amount = _cents(record.get("amount"))
+    if kind == "opening_balance":
+        acct(str(record["to"]))["opening"] += amount
+        return
+    if kind or record.get("from") is None or record.get("to") is None:
+        return
+    sender, receiver = str(record["from"]), str(record["to"])
+    s = acct(sender)
+    s["sent"] += amount
+    s["rewards"] += _cents(record.get("reward"))
+    acct(receiver)["received"] += amount
+
+
+def expected_cents(t):
+    return t["opening"] + t["received"] - t["sent"] + t["rewards"]
+
+
+def merge(into, part):
+    for uid, t in part.items():
+        mine = into.get(uid)
+        if mine is None:
+            into[uid] = t
+        else:
+            for k in TOTALS:
+                mine[k] += t[k]
+    return into
+
+
+# -----------------------------
+# Shards (run on worker processes)
+# -----------------------------
+def fold_file_range(path, start, end):
+    # Folds the records whose line starts in [start, end)
+    totals, records = {}, 0
+    with open(path, "rb") as f:
+        if start > 0:
+            f.seek(start - 1)
+            f.readline()  # finish the line the previous range owns
+        while f.tell() < end:
+            line = f.readline()
+            if not line.endswith(b"\n"):
+                break  # partially written tail
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            fold(totals, record)
+            records += 1
+    return totals, records
+
+
+def fold_segment(path):
+    from archive import Segment
+    totals, records = {}, 0
+    for record in Segment(path).records():
+        fold(totals, record)
+        records += 1
+    return totals, records
+
+
+def fold_sqlite_range(db_path, lo, hi):
+    # Folds the records with lo < seq <= hi
+    totals, records = {}, 0
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        for (data,) in conn.execute("SELECT data FROM transactions WHERE seq > ? AND seq <= ?", (lo, hi)):
+            fold(totals, json.loads(data))
+            records += 1
+    finally:
+        conn.close()
+    return totals, records
+
+
+def _shards(ledger, parts):
+    # [(fn, args)] covering the ledger as it is now
+    db = getattr(ledger, "db", None)
+    if db is not None:
+        conn = sqlite3.connect(db.path, timeout=30)
+        try:
+            top = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM transactions").fetchone()[0]
+        finally:
+            conn.close()
+        step = max(1, -(-top // parts))
+        return [(fold_sqlite_range, (db.path, lo, min(lo + step, top))) for lo in range(0, top, step)], top
+    shards = [(fold_segment, (s.path,)) for s in ledger.archive.segments]
+    extent = sum(os.path.getsize(s.path) for s in ledger.archive.segments)
+    if not os.path.exists(ledger.path):
+        return shards, extent
+    size = os.path.getsize(ledger.path)
+    step = max(1, -(-size // parts))
+    shards += [(fold_file_range, (ledger.path, lo, min(lo + step, size))) for lo in range(0, size, step)]
+    return shards, extent + size
+
+
+def replay(ledger, workers=None):
+    # ({uid: totals}, records folded) for the whole ledger
+    workers = workers or os.cpu_count() or 1
+    ledger.refresh()
+    shards, extent = _shards(ledger, workers * 4)
+    inline = workers == 1 or (getattr(ledger, "db", None) is None and extent < INLINE_BYTES)
+    totals, records = {}, 0
+    with (nullcontext() if inline else ProcessPoolExecutor(workers)) as pool:
+        if inline:
+            results = (fn(*args) for fn, args in shards)
+        else:
+            results = (f.result() for f in [pool.submit(fn, *args) for fn, args in shards])
+        for part, n in results:
+            merge(totals, part)
+            records += n
+    return totals, records
+
+
+# -----------------------------
+# Checking accounts
+# -----------------------------
+def check_account(accounts, ledger, uid):
+    # Exact replay of one account: a drift row, or None if it balances
+    user = accounts.get(uid)
+    if user is None:
+        return None
+    totals, seen, duplicates, has_opening = {}, set(), 0, False
+    for record in ledger.for_user(uid):
+        if record.get("id") in seen:
+            duplicates += 1
+        seen.add(record.get("id"))
+        has_opening = has_opening or (record.get("kind") == "opening_balance" and str(record.get("to")) == uid)
+        fold(totals, record)
+    t = totals.get(uid, dict.fromkeys(TOTALS, 0))
+    stored, expected = _cents(user.get("balance")), expected_cents(t)
+    if stored == expected:
+        return None
+    return {
+        "unique_id": uid,
+        "name": user.get("name"),
+        "stored": stored / 100,
+        "expected": expected / 100,
+        "drift": (stored - expected) / 100,
+        "opening": t["opening"] / 100,
+        "received": t["received"] / 100,
+        "sent": t["sent"] / 100,
+        "rewards": t["rewards"] / 100,
+        "has_opening": has_opening,
+        "duplicates": duplicates,
+    }
+
+
+def reconcile(accounts, ledger, workers=None, lock_accounts=None):
+    # Full check. lock_accounts (PaymentEngine.lock_accounts) makes the
+    # second look at a suspect account exact while payments keep running.
+    started = time.perf_counter()
+    totals, records = replay(ledger, workers)
+    opening = sum(t["opening"] for t in totals.values())
+    rewards = sum(t["rewards"] for t in totals.values())
+    suspects, n_accounts, balances = [], 0, 0
+    for u in accounts.iter_all():
+        uid = str(u["unique_id"])
+        n_accounts += 1
+        balances += _cents(u.get("balance"))
+        t = totals.pop(uid, None) or dict.fromkeys(TOTALS, 0)
+        if _cents(u.get("balance")) != expected_cents(t):
+            suspects.append(uid)
+    drift = []
+    for uid in suspects:
+        with lock_accounts([uid]) if lock_accounts else nullcontext():
+            row = check_account(accounts, ledger, uid)
+        if row:
+            drift.append(row)
+    return {
+        "records": records,
+        "accounts": n_accounts,
+        "drift": drift,
+        "unknown_accounts": sorted(totals),  # in the ledger but not in the store
+        # Payments only move money, so balances should add up to these two
+        "total_balances": balances / 100,
+        "total_opening": opening / 100,
+        "total_rewards": rewards / 100,
+        "seconds": round(time.perf_counter() - started, 3),
+    }
+
+
+def repair(engine, accounts, ledger, rows, backfill_openings=False, fix_balances=False):
+    # backfill_openings: an account with no opening_balance event whose
+    # balance is higher than the ledger explains predates those events; the
+    # difference is recorded as a backfilled opening balance. fix_balances:
+    # any remaining drift is resolved in the ledger's favour. Each account is
+    # re-checked under its lock first. Returns {"backfilled": n, "fixed": n}.
+    done = {"backfilled": 0, "fixed": 0}
+    for row in rows:
+        uid = row["unique_id"]
+        with engine.lock_accounts([uid]):
+            row = check_account(accounts, ledger, uid)
+            if row is None:
+                continue
+            if backfill_openings and not row["has_opening"] and row["drift"] > 0:
+                engine.open_balance(uid, row["drift"], backfill=True)
+                done["backfilled"] += 1
+            elif fix_balances:
+                accounts.update(uid, {"balance": row["expected"]})
+                done["fixed"] += 1
+    return done
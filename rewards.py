@@ -0,0 +1,54 @@
+# rewards.py
+# Running per-(payer, merchant) reward aggregates.
+#
+# Instead of rescanning the ledger on every /rewards view, each committed
+# payment updates count / total / qualifying count / discount for its
+# (payer, merchant) pair. The aggregates are rebuilt from the ledger the
+# first time they are needed in a process, or on demand via rebuild().
+from ledger import LedgerView
+
+REWARD_THRESHOLD = 5           # qualifying payments per discount step
+REWARD_MIN_AMOUNT = 50         # minimum amount for a payment to qualify
+DISCOUNT_PER_THRESHOLD = 25    # ₹ discount per step
+
+
+def new_stats():
+    return {'count': 0, 'total': 0, 'points': 0, 'qualifying': 0, 'discount': 0}
+
+
+def apply_payment(stats, amount, threshold=REWARD_THRESHOLD, min_amount=REWARD_MIN_AMOUNT,
+                  discount_per_threshold=DISCOUNT_PER_THRESHOLD):
+    stats['count'] += 1
+    stats['total'] = round(stats['total'] + amount, 2)
+    stats['points'] = stats['count']
+    if amount >= min_amount:
+        stats['qualifying'] += 1
+    stats['discount'] = (stats['qualifying'] // threshold) * discount_per_threshold
+
+
+def calculate_rewards(transactions, threshold=REWARD_THRESHOLD, min_amount=REWARD_MIN_AMOUNT,
+                      discount_per_threshold=DISCOUNT_PER_THRESHOLD):
+    # Single pass over a list of the payer's transactions
+    merchant_stats = {}
+    for t in transactions:
+        stats = merchant_stats.setdefault(t['to_name'], new_stats())  # reward applies per merchant
+        apply_payment(stats, t['amount'], threshold, min_amount, discount_per_threshold)
+    return merchant_stats.items()
+
+
+class RewardAggregates(LedgerView):
+    def _reset(self):
+        self._by_payer = {}
+
+    def _apply(self, txn):
+        if txn.get('kind') or txn.get('from') is None or txn.get('to_name') is None:
+            return
+        merchants = self._by_payer.setdefault(str(txn['from']), {})
+        stats = merchants.setdefault(txn['to_name'], new_stats())
+        apply_payment(stats, txn.get('amount', 0))
+
+    def for_payer(self, uid):
+        # [(merchant, stats)] for this payer; cost depends only on their merchants
+        with self.reading():
+            merchants = self._by_payer.get(str(uid), {})
+            return [(m, dict(stats)) for m, stats in merchants.items()]
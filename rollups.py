@@ -0,0 +1,115 @@
+# rollups.py
+# Materialised per-user spending rollups for /spendingsummary.
+#
+# Every committed payment is folded into the sender's and receiver's
+# all-time, monthly and daily buckets, so the summary page reads a handful of
+# small dicts instead of filtering the ledger. Buckets keep spend and rewards
+# per merchant; categories are derived from those at read time through the
+# merchant -> category table, so editing merchant_categories.json takes
+# effect without a rebuild.
+import json
+import os
+
+from ledger import LedgerView
+
+DEFAULT_CATEGORY = "Others"
+
+
+def load_category_table(path):
+    # {"Merchant name": "Category"}; names are matched case-insensitively
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        try:
+            table = json.load(f)
+        except json.JSONDecodeError:
+            return {}
+    return {str(k).lower(): v for k, v in table.items()}
+
+
+def new_bucket(detailed=True):
+    bucket = {"income": 0.0, "expense": 0.0, "count": 0}
+    if detailed:
+        bucket["merchant_spend"] = {}
+        bucket["merchant_rewards"] = {}
+    return bucket
+
+
+class SpendingRollups(LedgerView):
+    def __init__(self, ledger, category_path):
+        self.category_path = category_path
+        self._categories = load_category_table(category_path)
+        self._categories_mtime = None
+        super().__init__(ledger)
+
+    def _reset(self):
+        self._users = {}
+
+    def _user(self, uid):
+        u = self._users.get(uid)
+        if u is None:
+            u = self._users[uid] = {"total": new_bucket(), "monthly": {}, "daily": {}}
+        return u
+
+    def _add(self, uid, txn, outgoing, count=True):
+        date = str(txn.get("date", ""))
+        day, month = date[:10], date[:7]
+        u = self._user(uid)
+        buckets = [u["total"], u["monthly"].setdefault(month, new_bucket())]
+        daily = u["daily"].setdefault(day, new_bucket(detailed=False))
+        amount = txn.get("amount", 0)
+        for b in buckets + [daily]:
+            b["count"] += count
+            key = "expense" if outgoing else "income"
+            b[key] = round(b[key] + amount, 2)
+        if outgoing:
+            merchant = txn.get("to_name")
+            for b in buckets:
+                b["merchant_spend"][merchant] = round(b["merchant_spend"].get(merchant, 0) + amount, 2)
+                b["merchant_rewards"][merchant] = round(
+                    b["merchant_rewards"].get(merchant, 0) + txn.get("reward", 0), 2)
+
+    def _apply(self, txn):
+        if txn.get("kind"):
+            return  # opening balances etc. are not spending or income
+        sender, receiver = txn.get("from"), txn.get("to")
+        if sender is not None:
+            self._add(str(sender), txn, outgoing=True)
+        if receiver is not None:
+            # Paying yourself is both income and expense, as the summary has
+            # always shown it, but still one transaction
+            self._add(str(receiver), txn, outgoing=False, count=str(receiver) != str(sender))
+
+    def category_of(self, merchant):
+        try:
+            mtime = os.path.getmtime(self.category_path)
+        except OSError:
+            mtime = None
+        if mtime != self._categories_mtime:
+            self._categories = load_category_table(self.category_path)
+            self._categories_mtime = mtime
+        return self._categories.get(str(merchant).lower(), DEFAULT_CATEGORY)
+
+    def summary(self, uid, month=None):
+        # All-time (or one "YYYY-MM" month) totals plus the daily expense series
+        with self.reading():
+            u = self._users.get(str(uid))
+            if u is None:
+                bucket, daily = new_bucket(), {}
+            else:
+                bucket = u["total"] if month is None else u["monthly"].get(month, new_bucket())
+                daily = u["daily"]
+                if month is not None:
+                    daily = {d: b for d, b in daily.items() if d.startswith(month)}
+            category_map = {}
+            for merchant, spent in bucket["merchant_spend"].items():
+                cat = self.category_of(merchant)
+                category_map[cat] = round(category_map.get(cat, 0) + spent, 2)
+            return {
+                "total_income": bucket["income"],
+                "total_expense": bucket["expense"],
+                "transaction_count": bucket["count"],
+                "category_map": category_map,
+                "merchant_map": dict(bucket["merchant_rewards"]),
+                "daily_expense": [[d, b["expense"]] for d, b in sorted(daily.items())],
+            }
@@ -0,0 +1,211 @@
+# sessions.py
+# Server-side sessions and a cached per-user profile.
+#
+# The browser only holds a random session id; the session data lives in a
+# store on the server: an in-process LRU with a TTL (single worker), or a
+# small SQLite table shared by every worker. ProfileCache keeps the
+# logged-in user's record next to it so page navigation does not go to the
+# account store; the account store's change listener drops an entry as soon
+# as a payment, bank link or PIN change touches that account.
+import json
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+
+class LRUCache:
+    # Thread-safe LRU map whose entries also expire `ttl` seconds after set()
+    def __init__(self, maxsize=10000, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._items = OrderedDict()  # key -> (expires, value)
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            if item[0] < time.time():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return item[1]
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._items[key] = (time.time() + (self.ttl if ttl is None else ttl), value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
+# -----------------------------
+# Session stores
+# -----------------------------
+class MemorySessionStore:
+    def __init__(self, maxsize=10000):
+        self._cache = LRUCache(maxsize)
+
+    def get(self, sid):
+        return self._cache.get(sid)
+
+    def set(self, sid, data, ttl):
+        self._cache.set(sid, dict(data), ttl)
+
+    def delete(self, sid):
+        self._cache.pop(sid)
+
+
+class SQLiteSessionStore:
+    # Shared by all workers; expired rows are purged every `purge_every` writes
+    def __init__(self, path, purge_every=1000):
+        self.path = path
+        self.purge_every = purge_every
+        self._local = threading.local()
+        self._writes = 0
+        self._conn().execute(
+            "CREATE TABLE IF NOT EXISTS sessions (sid TEXT PRIMARY KEY, data TEXT NOT NULL, expires REAL NOT NULL)")
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def get(self, sid):
+        row = self._conn().execute("SELECT data FROM sessions WHERE sid = ? AND expires > ?",
+                                   (sid, time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, sid, data, ttl):
+        conn = self._conn()
+        conn.execute("INSERT INTO sessions (sid, data, expires) VALUES (?, ?, ?) "
+                     "ON CONFLICT(sid) DO UPDATE SET data = excluded.data, expires = excluded.expires",
+                     (sid, json.dumps(dict(data), separators=(",", ":")), time.time() + ttl))
+        self._writes += 1
+        if self._writes % self.purge_every == 0:
+            conn.execute("DELETE FROM sessions WHERE expires <= ?", (time.time(),))
+
+    def delete(self, sid):
+        self._conn().execute("DELETE FROM sessions WHERE sid = ?", (sid,))
+
+
+def open_session_store(kind, path=None):
+    if kind == "memory":
+        return MemorySessionStore()
+    if kind == "sqlite":
+        return SQLiteSessionStore(path)
+    raise ValueError(f"Unknown session store: {kind}")
+
+
+# -----------------------------
+# Flask integration
+# -----------------------------
+class ServerSideSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        self.replaced_sid = None
+
+    def regenerate(self):
+        # New id for the same data, e.g. at login, so an id planted in the
+        # browser beforehand (session fixation) never becomes authenticated
+        if not self.new:
+            self.replaced_sid = self.sid
+        self.sid = secrets.token_urlsafe(32)
+        self.new = True
+        self.modified = True
+
+
+class ServerSessionInterface(SessionInterface):
+    # Stores session data server-side; the cookie only carries the id. The
+    # store is written when the session changes, or at most once per
+    # `touch_every` seconds to slide the expiry of an active session.
+    def __init__(self, store, ttl=12 * 3600, touch_every=300):
+        self.store = store
+        self.ttl = ttl
+        self.touch_every = touch_every
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            data = self.store.get(sid)
+            if data is not None:
+                session = ServerSideSession(data.get("d", {}), sid=sid)
+                session.touched = data.get("t", 0)
+                return session
+        return ServerSideSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.replaced_sid:
+            self.store.delete(session.replaced_sid)
+        if not session:
+            if not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        now = time.time()
+        stale = now - getattr(session, "touched", 0) > self.touch_every
+        if session.modified or session.new or stale:
+            self.store.set(session.sid, {"d": dict(session), "t": now}, self.ttl)
+        if session.new:
+            response.set_cookie(name, session.sid, domain=domain, path=path,
+                                httponly=self.get_cookie_httponly(app),
+                                secure=self.get_cookie_secure(app),
+                                samesite=self.get_cookie_samesite(app))
+
+
+# -----------------------------
+# Profile cache
+# -----------------------------
+class ProfileCache:
+    # uid -> account record. Fill with get(uid, loader); subscribe
+    # invalidate() to the account store so any change to the record, in this
+    # worker or picked up from another one, evicts it. The TTL bounds how
+    # long another worker's change can go unseen by an idle worker.
+    def __init__(self, maxsize=10000, ttl=30):
+        self._cache = LRUCache(maxsize, ttl)
+        self._generation = 0  # bumped on every invalidation
+
+    def get(self, uid, loader):
+        user = self._cache.get(uid)
+        if user is None:
+            generation = self._generation
+            user = loader(uid)
+            if user is None:
+                return None
+            if generation == self._generation:  # nothing changed while loading
+                self._cache.set(uid, user)
+        return dict(user)
+
+    def invalidate(self, record):
+        self._generation += 1
+        self._cache.pop(record.get("unique_id"))
@@ -0,0 +1,467 @@
+# storage.py
+# Pluggable storage backends for accounts and the ledger.
+#
+# A backend provides an `accounts` store (AccountStore interface), a `ledger`
+# (Ledger interface) and `atomic()`, a context manager that makes the balance
+# update and ledger append of one payment commit together. "json" is the
+# flat-file pair from accounts.py/ledger.py; "sqlite" keeps both in one
+# SQLite database in WAL mode, so readers never block the writer and lookups
+# are index seeks instead of in-memory copies of the whole user base.
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager, nullcontext
+
+from accounts import AccountStore, DuplicateAccount
+from fileutil import fsync_file
+from ledger import Ledger, matches_counterparty
+
+# Fields stored as real, indexed columns on the users table
+USER_COLUMNS = ("email", "phone", "face_id_ref")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    unique_id   TEXT PRIMARY KEY,
+    email       TEXT,
+    phone       TEXT,
+    face_id_ref TEXT,
+    rev         INTEGER NOT NULL,
+    data        TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS users_email ON users(email);
+CREATE INDEX IF NOT EXISTS users_phone ON users(phone);
+CREATE INDEX IF NOT EXISTS users_face_id_ref ON users(face_id_ref);
+CREATE INDEX IF NOT EXISTS users_rev ON users(rev);
+
+CREATE TABLE IF NOT EXISTS transactions (
+    seq      INTEGER PRIMARY KEY AUTOINCREMENT,
+    id       TEXT,
+    from_uid TEXT,
+    to_uid   TEXT,
+    date     TEXT,
+    data     TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tx_id ON transactions(id);
+-- (uid, seq): history pages walk one user's rows newest-first by seq
+CREATE INDEX IF NOT EXISTS tx_from_seq ON transactions(from_uid, seq);
+CREATE INDEX IF NOT EXISTS tx_to_seq ON transactions(to_uid, seq);
+DROP INDEX IF EXISTS tx_from_date;
+DROP INDEX IF EXISTS tx_to_date;
+"""
+
+
+def _dumps(record):
+    return json.dumps(record, separators=(",", ":"))
+
+
+# -----------------------------
+# SQLite
+# -----------------------------
+class SQLiteDatabase:
+    def __init__(self, path, synchronous="NORMAL"):
+        self.path = path
+        self.synchronous = synchronous  # FULL: fsync every commit; NORMAL: at checkpoints
+        self._local = threading.local()
+        self.conn().executescript(SCHEMA)
+
+    def conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(f"PRAGMA synchronous={self.synchronous}")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+            self._local.depth = 0
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        # Re-entrant: nested calls join the outermost BEGIN IMMEDIATE
+        conn = self.conn()
+        if self._local.depth:
+            self._local.depth += 1
+            try:
+                yield conn
+            finally:
+                self._local.depth -= 1
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        self._local.depth = 1
+        try:
+            yield conn
+        except BaseException:
+            self._local.depth = 0
+            conn.execute("ROLLBACK")
+            raise
+        self._local.depth = 0
+        conn.execute("COMMIT")
+
+
+class SQLiteAccountStore:
+    def __init__(self, db, indexed_fields=("email", "phone")):
+        self.db = db
+        self.indexed_fields = tuple(indexed_fields)
+        self._lock = threading.RLock()
+        self._listeners = []
+        self._last_rev = 0
+
+    def _row_values(self, record, rev):
+        return (record["unique_id"],) + tuple(
+            None if record.get(c) in (None, "") else str(record.get(c)) for c in USER_COLUMNS
+        ) + (rev, _dumps(record))
+
+    def _write(self, conn, records):
+        # Called inside db.transaction(), so the SQLite write lock orders revs
+        with self._lock:
+            self._catch_up(conn)
+            rev = conn.execute("SELECT COALESCE(MAX(rev), 0) FROM users").fetchone()[0]
+            rows = []
+            for record in records:
+                rev += 1
+                rows.append(self._row_values(record, rev))
+            conn.executemany(
+                "INSERT INTO users (unique_id, email, phone, face_id_ref, rev, data) "
+                "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(unique_id) DO UPDATE SET "
+                "email = excluded.email, phone = excluded.phone, "
+                "face_id_ref = excluded.face_id_ref, rev = excluded.rev, data = excluded.data",
+                rows)
+            self._last_rev = rev
+            for record in records:
+                self._notify(record)
+
+    def _notify(self, record):
+        for fn in self._listeners:
+            fn(record)
+
+    def _catch_up(self, conn):
+        # Deliver rows changed by other connections/processes to listeners
+        if not self._listeners:
+            self._last_rev = conn.execute("SELECT COALESCE(MAX(rev), 0) FROM users").fetchone()[0]
+            return
+        rows = conn.execute(
+            "SELECT rev, data FROM users WHERE rev > ? ORDER BY rev", (self._last_rev,)).fetchall()
+        for rev, data in rows:
+            self._last_rev = rev
+            self._notify(json.loads(data))
+
+    def refresh(self):
+        with self._lock:
+            self._catch_up(self.db.conn())
+
+    def subscribe(self, fn, replay=True):
+        with self._lock:
+            self._listeners.append(fn)
+            if replay:
+                for u in self.all():
+                    fn(u)
+                self._last_rev = self.db.conn().execute(
+                    "SELECT COALESCE(MAX(rev), 0) FROM users").fetchone()[0]
+
+    def compact(self):
+        self.db.conn().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    # Reads
+    def get(self, uid):
+        if uid is None:
+            return None
+        row = self.db.conn().execute(
+            "SELECT data FROM users WHERE unique_id = ?", (str(uid),)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def __contains__(self, uid):
+        return self.db.conn().execute(
+            "SELECT 1 FROM users WHERE unique_id = ?", (str(uid),)).fetchone() is not None
+
+    def __len__(self):
+        return self.db.conn().execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def find_by(self, field, value):
+        if field in USER_COLUMNS:
+            sql = f"SELECT data FROM users WHERE {field} = ? LIMIT 1"
+            row = self.db.conn().execute(sql, (str(value),)).fetchone()
+        else:
+            row = self.db.conn().execute(
+                "SELECT data FROM users WHERE json_extract(data, ?) = ? LIMIT 1",
+                ("$." + field, value)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def find_by_email(self, email):
+        return self.find_by("email", email)
+
+    def find_by_phone(self, phone):
+        return self.find_by("phone", phone)
+
+    def all(self):
+        return [json.loads(d) for (d,) in self.db.conn().execute(
+            "SELECT data FROM users ORDER BY rowid")]
+
+    def iter_all(self):
+        # Own connection, so the cursor isn't disturbed by writes made while
+        # the caller is still iterating
+        conn = sqlite3.connect(self.db.path, timeout=30)
+        try:
+            for (d,) in conn.execute("SELECT data FROM users ORDER BY rowid"):
+                yield json.loads(d)
+        finally:
+            conn.close()
+
+    # Writes
+    def _taken(self, conn, field, value):
+        if field == "unique_id" or field in USER_COLUMNS:
+            sql = f"SELECT 1 FROM users WHERE {field} = ? LIMIT 1"
+            return conn.execute(sql, (value,)).fetchone() is not None
+        return conn.execute("SELECT 1 FROM users WHERE json_extract(data, ?) = ? LIMIT 1",
+                            ("$." + field, value)).fetchone() is not None
+
+    def add(self, user, unique=()):
+        return self.add_many([user], unique)[0][0]
+
+    def add_many(self, users, unique=(), skip_duplicates=False):
+        # Same contract as AccountStore.add_many; checks are index seeks
+        added, skipped = [], []
+        with self.db.transaction() as conn:
+            claimed = {field: set() for field in ("unique_id",) + tuple(unique)}
+            for user in users:
+                record = dict(user)
+                try:
+                    for field, seen in claimed.items():
+                        value = str(record.get(field, ""))
+                        if value and (value in seen or self._taken(conn, field, value)):
+                            raise DuplicateAccount(field, value)
+                except DuplicateAccount as e:
+                    if not skip_duplicates:
+                        raise
+                    skipped.append((record, e))
+                    continue
+                for field, seen in claimed.items():
+                    seen.add(str(record.get(field, "")))
+                added.append(record)
+            self._write(conn, added)
+        return [dict(r) for r in added], skipped
+
+    def update(self, uid, fields, remove=()):
+        return self.update_many({uid: fields}, remove).get(uid)
+
+    def update_many(self, changes, remove=()):
+        updated = {}
+        with self.db.transaction() as conn:
+            for uid, fields in changes.items():
+                row = conn.execute("SELECT data FROM users WHERE unique_id = ?", (uid,)).fetchone()
+                if row is None:
+                    continue
+                record = json.loads(row[0])
+                record.update(fields)
+                for field in remove:
+                    record.pop(field, None)
+                updated[uid] = record
+            self._write(conn, list(updated.values()))
+        return updated
+
+    def replace_all(self, users):
+        with self.db.transaction() as conn:
+            changed = [dict(u) for u in users if self.get(u.get("unique_id")) != u]
+            self._write(conn, changed)
+
+
+class SQLiteLedger:
+    def __init__(self, db):
+        self.db = db
+        self._lock = threading.RLock()
+        self._listeners = []
+        self._last_seq = self._max_seq(db.conn())
+
+    def _max_seq(self, conn):
+        return conn.execute("SELECT COALESCE(MAX(seq), 0) FROM transactions").fetchone()[0]
+
+    def _notify(self, record):
+        for fn in self._listeners:
+            fn(record)
+
+    def _catch_up(self, conn):
+        if not self._listeners:
+            self._last_seq = self._max_seq(conn)
+            return
+        for seq, data in conn.execute(
+                "SELECT seq, data FROM transactions WHERE seq > ? ORDER BY seq",
+                (self._last_seq,)).fetchall():
+            self._last_seq = seq
+            self._notify(json.loads(data))
+
+    def refresh(self):
+        with self._lock:
+            self._catch_up(self.db.conn())
+
+    @property
+    def lock(self):
+        return self._lock
+
+    def subscribe(self, fn):
+        with self._lock:
+            self._listeners.append(fn)
+
+    def append(self, record):
+        self.append_many([record])
+
+    def append_many(self, records):
+        if not records:
+            return
+        with self.db.transaction() as conn:
+            with self._lock:
+                self._catch_up(conn)
+                conn.executemany(
+                    "INSERT INTO transactions (id, from_uid, to_uid, date, data) VALUES (?, ?, ?, ?, ?)",
+                    [(r.get("id"), r.get("from"), r.get("to"), r.get("date"), _dumps(r)) for r in records])
+                self._last_seq = self._max_seq(conn)
+                for r in records:
+                    self._notify(r)
+
+    def __len__(self):
+        return self.db.conn().execute("SELECT COUNT(*) FROM transactions").fetchone()[0]
+
+    def for_user(self, uid):
+        # Records where uid is sender or receiver, oldest first (two index seeks)
+        uid = str(uid)
+        rows = self.db.conn().execute(
+            "SELECT data FROM transactions WHERE seq IN ("
+            "SELECT seq FROM transactions WHERE from_uid = ? "
+            "UNION SELECT seq FROM transactions WHERE to_uid = ?) ORDER BY seq", (uid, uid))
+        return [json.loads(d) for (d,) in rows]
+
+    def page_for_user(self, uid, cursor=None, limit=20, since=None, until=None, counterparty=None):
+        # Newest-first page; the cursor is the seq of the last row returned.
+        # Each branch walks its own (uid, seq) index from the cursor and
+        # stops after `limit` rows, so a page reads O(limit) rows however
+        # long the history is. Another batch is read only if filtered-out
+        # rows left the page short.
+        uid = str(uid)
+        before = int(cursor) if cursor is not None else 2 ** 62
+        cond, params = "", []
+        if since:
+            cond += " AND date >= ?"
+            params.append(since)
+        if until:
+            cond += " AND substr(date, 1, 10) <= ?"
+            params.append(until)
+        sql = (f"SELECT * FROM (SELECT seq, data FROM transactions WHERE from_uid = ? AND seq < ?{cond} "
+               "ORDER BY seq DESC LIMIT ?) "
+               f"UNION ALL SELECT * FROM (SELECT seq, data FROM transactions WHERE to_uid = ? AND seq < ?{cond} "
+               "AND from_uid IS NOT ? ORDER BY seq DESC LIMIT ?) "
+               "ORDER BY seq DESC LIMIT ?")
+        conn, rows = self.db.conn(), []
+        while True:
+            fetched = conn.execute(sql, [uid, before] + params + [limit, uid, before] + params + [uid, limit, limit])
+            n = 0
+            for seq, data in fetched:
+                n += 1
+                before = seq
+                record = json.loads(data)
+                if record.get("kind") or (counterparty and not matches_counterparty(record, uid, counterparty)):
+                    continue  # kind: non-payment events such as opening balances
+                rows.append(record)
+                if len(rows) >= limit:
+                    return rows, str(seq)
+            if n < limit:
+                return rows, None  # ran out of rows: no further page
+
+    def count_for_user(self, uid):
+        uid = str(uid)
+        return self.db.conn().execute(
+            "SELECT COUNT(*) FROM (SELECT seq FROM transactions WHERE from_uid = ? "
+            "UNION SELECT seq FROM transactions WHERE to_uid = ?)", (uid, uid)).fetchone()[0]
+
+    def reindex(self):
+        conn = self.db.conn()
+        conn.execute("REINDEX transactions")
+        return conn.execute("SELECT COUNT(*) FROM transactions").fetchone()[0]
+
+    def iter_all(self, batch=5000):
+        # Every record present at the call, read in seq batches so no long
+        # read transaction is held open
+        with self._lock:
+            self._catch_up(self.db.conn())
+            last = self._last_seq
+        return self._iter_records(last, batch)
+
+    def _iter_records(self, last, batch):
+        seq = 0
+        while seq < last:
+            rows = self.db.conn().execute(
+                "SELECT seq, data FROM transactions WHERE seq > ? AND seq <= ? ORDER BY seq LIMIT ?",
+                (seq, last, batch)).fetchall()
+            if not rows:
+                return
+            for seq, d in rows:
+                yield json.loads(d)
+
+    def all(self):
+        return list(self.iter_all())
+
+
+# -----------------------------
+# Backend selection
+# -----------------------------
+class JSONStorage:
+    name = "json"
+
+    def __init__(self, base_dir, indexed_fields=("email", "phone"), durability="group"):
+        # "strict" fsyncs every journal and ledger append; "group" leaves that
+        # to sync(), which the payment engine calls before it relies on them
+        durable = durability == "strict"
+        self.accounts = AccountStore(os.path.join(base_dir, "users.json"), indexed_fields=indexed_fields,
+                                     durable=durable)
+        self.ledger = Ledger(os.path.join(base_dir, "transactions.ndjson"),
+                             legacy_path=os.path.join(base_dir, "transactions.json"), durable=durable)
+
+    def atomic(self):
+        # Atomicity comes from the payment engine's write-ahead log
+        return nullcontext()
+
+    def sync(self):
+        self.accounts.sync()
+        self.ledger.sync()
+
+
+class SQLiteStorage:
+    name = "sqlite"
+
+    def __init__(self, path, indexed_fields=("email", "phone"), durability="group"):
+        self.db = SQLiteDatabase(path, synchronous="FULL" if durability == "strict" else "NORMAL")
+        self.accounts = SQLiteAccountStore(self.db, indexed_fields=indexed_fields)
+        self.ledger = SQLiteLedger(self.db)
+
+    def atomic(self):
+        return self.db.transaction()
+
+    def sync(self):
+        # With synchronous=NORMAL commits reach the -wal file unsynced
+        fsync_file(self.db.path + "-wal")
+
+
+def open_storage(backend, base_dir, indexed_fields=("email", "phone"), durability="group"):
+    if backend == "sqlite":
+        return SQLiteStorage(os.path.join(base_dir, "unipay.db"), indexed_fields=indexed_fields,
+                             durability=durability)
+    if backend == "json":
+        return JSONStorage(base_dir, indexed_fields=indexed_fields, durability=durability)
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+
+def migrate_json_to_sqlite(base_dir, db_path=None):
+    # One-shot copy of users.json(+journal) and the ledger into SQLite
+    source = JSONStorage(base_dir)
+    target = SQLiteStorage(db_path or os.path.join(base_dir, "unipay.db"))
+    users = source.accounts.all()
+    with target.atomic():
+        target.accounts.replace_all(users)
+        if len(target.ledger) == 0:
+            batch = []
+            for t in source.ledger.iter_all():
+                batch.append(t)
+                if len(batch) >= 5000:
+                    target.ledger.append_many(batch)
+                    batch = []
+            target.ledger.append_many(batch)
+    return len(users), len(target.ledger)